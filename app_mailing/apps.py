@@ -1,6 +1,24 @@
 from django.apps import AppConfig
+from django.db import connection
+from django.db.models.signals import post_migrate
+
+
+def create_breakdown_view(sender, **kwargs) -> None:
+    """View создается после migrate, если таблицы, на которых она построена, уже есть"""
+    if connection.vendor != 'postgresql':
+        return
+    from .models import Message
+    from app_user.models import Client, OperatorCode, Tag
+
+    tables = set(connection.introspection.table_names())
+    if all(model._meta.db_table in tables for model in (Message, Client, OperatorCode, Tag)):
+        from .services import MailingBreakdownDB
+        MailingBreakdownDB.create_view()
 
 
 class AppMailingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app_mailing'
+
+    def ready(self):
+        post_migrate.connect(create_breakdown_view, sender=self)
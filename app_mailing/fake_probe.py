@@ -0,0 +1,145 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import collections
+import json
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def parse_latency(value: str) -> Callable[[random.Random], float]:
+    """Распределение задержки ответа в мс: fixed:<ms>, uniform:<min>:<max>, exp:<mean>,
+    lognormal:<median>:<sigma>"""
+    name, *args = value.split(':')
+    try:
+        args = [float(arg) for arg in args]
+    except ValueError:
+        raise ValueError(f'Invalid latency "{value}"')
+
+    if name == 'fixed' and len(args) == 1:
+        return lambda rnd: args[0]
+    if name == 'uniform' and len(args) == 2:
+        return lambda rnd: rnd.uniform(args[0], args[1])
+    if name == 'exp' and len(args) == 1:
+        return lambda rnd: rnd.expovariate(1 / args[0]) if args[0] else 0.0
+    if name == 'lognormal' and len(args) == 2:
+        return lambda rnd: args[0] * rnd.lognormvariate(0, args[1])
+    raise ValueError(f'Invalid latency "{value}"')
+
+
+class FakeProbeServer:
+    """Локальная замена стороннего API для нагрузочного тестирования:
+    задержка, ошибки 400/500, обрывы соединения и периодические серии 5xx"""
+    outcomes = ('ok', 'error', 'server_error', 'burst', 'drop')
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: str = 'fixed:0',
+                 error_rate: float = 0, server_error_rate: float = 0, drop_rate: float = 0,
+                 burst_every: float = 0, burst_duration: float = 0, seed: int = None):
+        self.__latency = parse_latency(latency)
+        self.__error_rate = error_rate
+        self.__server_error_rate = server_error_rate
+        self.__drop_rate = drop_rate
+        self.__burst_every = burst_every
+        self.__burst_duration = burst_duration
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__counters = collections.Counter()
+        self.__service_times: List[float] = []
+        self.__started_at = None
+        self.__thread = None
+        self.__server = ThreadingHTTPServer((host, port), self._get_handler())
+        self.__server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f'http://{host}:{port}/v1/send/'
+
+    def __enter__(self) -> 'FakeProbeServer':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self.__started_at = time.monotonic()
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name='fake-probe', daemon=True)
+        self.__thread.start()
+        logger.info(f'fake probe server started on {self.url}')
+
+    def stop(self) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+
+    def stats(self) -> Tuple[Dict[str, int], List[float]]:
+        """Количество ответов по исходам и время обработки запросов сервером, мс"""
+        with self.__lock:
+            return {name: self.__counters[name] for name in self.outcomes}, list(self.__service_times)
+
+    def _choose(self) -> Tuple[str, float]:
+        """Исход и задержка очередного запроса"""
+        with self.__lock:
+            rnd = self.__random
+            latency = max(self.__latency(rnd), 0.0) / 1000
+            if self.__burst_every and \
+                    (time.monotonic() - self.__started_at) % self.__burst_every < self.__burst_duration:
+                return 'burst', latency
+            value = rnd.random()
+            for outcome, rate in (('drop', self.__drop_rate), ('server_error', self.__server_error_rate),
+                                  ('error', self.__error_rate)):
+                if value < rate:
+                    return outcome, latency
+                value -= rate
+            return 'ok', latency
+
+    def _record(self, outcome: str, started_at: float) -> None:
+        with self.__lock:
+            self.__counters[outcome] += 1
+            self.__service_times.append((time.monotonic() - started_at) * 1000)
+
+    def _get_handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело пишутся отдельно: без TCP_NODELAY на keep-alive соединении
+            # алгоритм Нейгла и отложенный ACK задерживают каждый ответ на ~40 мс
+            disable_nagle_algorithm = True
+            responses_by_outcome = {
+                'ok': (200, {'code': 0, 'message': 'OK'}),
+                'error': (400, {'code': 1, 'message': 'Bad Request'}),
+                'server_error': (500, {'code': 2, 'message': 'Internal Server Error'}),
+                'burst': (503, {'code': 3, 'message': 'Service Unavailable'}),
+            }
+
+            def do_POST(self):
+                started_at = time.monotonic()
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                outcome, latency = server._choose()
+                if latency:
+                    time.sleep(latency)
+
+                if outcome == 'drop':
+                    # Соединение закрывается без ответа
+                    self.close_connection = True
+                    server._record(outcome, started_at)
+                    return
+
+                status_code, data = self.responses_by_outcome[outcome]
+                body = json.dumps(data).encode()
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                server._record(outcome, started_at)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,234 @@
+from django.conf import settings
+import logging
+import redis
+import threading
+import time
+from typing import Dict, List, Tuple
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+redis_client = redis.Redis.from_url(settings.REDIS_URL, socket_timeout=settings.PROBE_LIMITER_REDIS_TIMEOUT,
+                                    socket_connect_timeout=settings.PROBE_LIMITER_REDIS_TIMEOUT)
+
+# Ошибки Redis пишутся в лог не чаще раза в интервал (сек), иначе запись на каждое сообщение
+error_log_interval = 60
+_error_logged_at: Dict[str, float] = {}
+
+
+def on_redis_error(limiter: str, ex: redis.RedisError) -> None:
+    """Недоступность Redis не останавливает рассылку: запрос пропускается без ограничения (fail open)"""
+    metrics.limiter_errors_total.labels(limiter).inc()
+    now = time.monotonic()
+    if limiter not in _error_logged_at or now - _error_logged_at[limiter] >= error_log_interval:
+        _error_logged_at[limiter] = now
+        logger.warning(f'{limiter}: redis error, request is not limited - {ex}')
+
+
+class RateLimiter:
+    """Распределенный token bucket в Redis: общий лимит и лимиты по кодам оператора"""
+    key_prefix = 'probe_rate_limit'
+
+    # Токен списывается сразу из всех бакетов или ни из одного, время берется у Redis,
+    # чтобы лимит был общим для всех воркеров. Возвращает время ожидания в мс
+    script = """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+    local wait = 0
+    local tokens = {}
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[i * 2 - 1])
+        local burst = tonumber(ARGV[i * 2])
+        local state = redis.call('HMGET', key, 'tokens', 'ts')
+        local value = tonumber(state[1]) or burst
+        local ts = tonumber(state[2]) or now
+        value = math.min(burst, value + math.max(now - ts, 0) * rate / 1000)
+        tokens[i] = value
+        if value < 1 then
+            wait = math.max(wait, math.ceil((1 - value) * 1000 / rate))
+        end
+    end
+    if wait > 0 then
+        return wait
+    end
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[i * 2 - 1])
+        local burst = tonumber(ARGV[i * 2])
+        redis.call('HSET', key, 'tokens', tokens[i] - 1, 'ts', now)
+        redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)
+    end
+    return 0
+    """
+
+    def __init__(self, rate: float = None, burst: int = None,
+                 rates_by_code: Dict[str, float] = None, client: redis.Redis = None):
+        self.__rate = settings.PROBE_RATE_LIMIT if rate is None else rate
+        self.__burst = burst or settings.PROBE_RATE_LIMIT_BURST or max(int(self.__rate), 1)
+        self.__rates_by_code = settings.PROBE_RATE_LIMITS_BY_CODE if rates_by_code is None else rates_by_code
+        self.__client = client or redis_client
+        self.__script = None
+        self.__lock = threading.Lock()
+        self.__wait_time = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.__rate > 0 or bool(self.__rates_by_code)
+
+    @property
+    def wait_time(self) -> float:
+        """Суммарное время ожидания токенов в процессе, сек"""
+        return self.__wait_time
+
+    def acquire(self, code: str) -> float:
+        """Дождаться токена для отправки на код оператора, вернуть время ожидания"""
+        keys, args = self._get_buckets(code)
+        if not keys:
+            return 0.0
+
+        if self.__script is None:
+            self.__script = self.__client.register_script(self.script)
+
+        waited = 0.0
+        try:
+            while True:
+                wait_ms = self.__script(keys=keys, args=args)
+                if not wait_ms:
+                    break
+                time.sleep(wait_ms / 1000)
+                waited += wait_ms / 1000
+        except redis.RedisError as ex:
+            on_redis_error('rate_limiter', ex)
+
+        if waited:
+            with self.__lock:
+                self.__wait_time += waited
+            metrics.rate_limit_wait_seconds_total.inc(waited)
+        return waited
+
+    def _get_buckets(self, code: str) -> Tuple[List[str], List[float]]:
+        """Ключи и параметры (скорость, емкость) бакетов для кода оператора"""
+        keys, args = [], []
+        if self.__rate > 0:
+            keys.append(f'{self.key_prefix}:global')
+            args.extend((self.__rate, self.__burst))
+        code_rate = self.__rates_by_code.get(code)
+        if code_rate:
+            keys.append(f'{self.key_prefix}:code:{code}')
+            args.extend((code_rate, max(int(code_rate), 1)))
+        return keys, args
+
+
+rate_limiter = RateLimiter()
+
+
+class CircuitBreaker:
+    """Общий для воркеров circuit breaker стороннего API (closed/open/half_open) в Redis"""
+    key = 'probe_circuit'
+
+    # Возвращает 0, если запрос разрешен, иначе время ожидания в мс.
+    # В состоянии half_open пропускается не больше max_probes пробных запросов
+    acquire_script = """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+    local open_timeout = tonumber(ARGV[1])
+    local max_probes = tonumber(ARGV[2])
+    local state = redis.call('HMGET', KEYS[1], 'state', 'until', 'probes')
+    local name = state[1] or 'closed'
+    if name == 'closed' then
+        return 0
+    end
+    local deadline = tonumber(state[2]) or 0
+    local probes = tonumber(state[3]) or 0
+    if name == 'open' then
+        if now < deadline then
+            return deadline - now
+        end
+        name = 'half_open'
+    end
+    if name == 'half_open' and now >= deadline then
+        deadline = now + open_timeout
+        probes = 0
+        redis.call('HSET', KEYS[1], 'state', name, 'until', deadline, 'probes', 0, 'successes', 0)
+    end
+    if probes < max_probes then
+        redis.call('HINCRBY', KEYS[1], 'probes', 1)
+        return 0
+    end
+    return math.min(deadline - now, 1000)
+    """
+
+    # Учитывает результат запроса, возвращает новое состояние при переходе
+    record_script = """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+    local success = tonumber(ARGV[1])
+    local threshold = tonumber(ARGV[2])
+    local open_timeout = tonumber(ARGV[3])
+    local max_probes = tonumber(ARGV[4])
+    local name = redis.call('HGET', KEYS[1], 'state') or 'closed'
+    if success == 1 then
+        if name == 'half_open' then
+            if redis.call('HINCRBY', KEYS[1], 'successes', 1) >= max_probes then
+                redis.call('DEL', KEYS[1])
+                return 'closed'
+            end
+        elseif name == 'closed' then
+            redis.call('HDEL', KEYS[1], 'failures')
+        end
+        return false
+    end
+    if name == 'closed' and redis.call('HINCRBY', KEYS[1], 'failures', 1) < threshold then
+        return false
+    end
+    if name == 'open' then
+        return false
+    end
+    redis.call('DEL', KEYS[1])
+    redis.call('HSET', KEYS[1], 'state', 'open', 'until', now + open_timeout)
+    return 'open'
+    """
+
+    def __init__(self, failure_threshold: int = None, open_timeout: int = None,
+                 half_open_probes: int = None, client: redis.Redis = None):
+        self.__failure_threshold = settings.PROBE_CIRCUIT_FAILURE_THRESHOLD \
+            if failure_threshold is None else failure_threshold
+        self.__open_timeout = (open_timeout or settings.PROBE_CIRCUIT_OPEN_TIMEOUT) * 1000
+        self.__half_open_probes = half_open_probes or settings.PROBE_CIRCUIT_HALF_OPEN_PROBES
+        self.__client = client or redis_client
+        self.__acquire = None
+        self.__record = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.__failure_threshold > 0
+
+    def acquire(self) -> float:
+        """Разрешение на запрос: 0 или время ожидания в секундах"""
+        if not self.enabled:
+            return 0.0
+        if self.__acquire is None:
+            self.__acquire = self.__client.register_script(self.acquire_script)
+        try:
+            wait_ms = self.__acquire(keys=[self.key], args=[self.__open_timeout, self.__half_open_probes])
+        except redis.RedisError as ex:
+            on_redis_error('circuit_breaker', ex)
+            return 0.0
+        return wait_ms / 1000
+
+    def record(self, success: bool) -> None:
+        """Учесть результат запроса к API"""
+        if not self.enabled:
+            return
+        if self.__record is None:
+            self.__record = self.__client.register_script(self.record_script)
+        try:
+            state = self.__record(keys=[self.key], args=[int(success), self.__failure_threshold,
+                                                          self.__open_timeout, self.__half_open_probes])
+        except redis.RedisError as ex:
+            on_redis_error('circuit_breaker', ex)
+            return
+        if state:
+            logger.info(f'probe server circuit {state.decode() if isinstance(state, bytes) else state}')
+
+
+circuit_breaker = CircuitBreaker()
@@ -0,0 +1,248 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from contextlib import nullcontext
+from itertools import islice
+import io
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+from app_user.models import Client, OperatorCode, Tag
+from app_user.serializers import ClientSerializer
+from app_mailing.models import Mailing, Message
+from app_mailing.serializers import StatisticsSerializer
+from app_mailing.services import TaskMailingDB, Statistic, generation_csv
+
+
+class Command(BaseCommand):
+    help = 'micro-benchmarks of service-layer hot paths on fixture datasets: wall time, query count, ' \
+           'peak memory; JSON results and comparison with a baseline'
+    # Клиенты, исторические рассылки и сообщения на рассылку
+    scales = {
+        '10k': {'clients': 10_000, 'mailings': 100, 'messages': 100},
+        '1m': {'clients': 1_000_000, 'mailings': 1_000, 'messages': 1_000},
+        '10m': {'clients': 10_000_000, 'mailings': 10_000, 'messages': 1_000},
+    }
+    pending_text = 'benchmark pending'
+    page_size = 100
+    client_batch = 1000
+    max_repeat = 1000
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=self.scales, default='10k', help='fixture dataset')
+        parser.add_argument('--ops', nargs='*', help='operations to run (default: all)')
+        parser.add_argument('--repeat', type=int, default=10, help='min timed runs of every operation')
+        parser.add_argument('--min-time', type=float, default=0.5,
+                            help='fast operations are repeated until their timed runs take this long, seconds')
+        parser.add_argument('--label', default='', help='label of the results, e.g. commit hash')
+        parser.add_argument('--output', type=Path, help='save results as JSON')
+        parser.add_argument('--compare', type=Path, help='baseline results JSON')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='relative growth of min time or peak memory reported as regression')
+        parser.add_argument('--noise', type=float, default=1.0,
+                            help='time differences below this many ms (or 3 stdev of runs) are ignored')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('PostgreSQL is required')
+
+        operations = self._get_operations()
+        names = options['ops'] or list(operations)
+        unknown = set(names) - operations.keys()
+        if unknown:
+            raise CommandError(f'Unknown operations: {", ".join(sorted(unknown))}, '
+                               f'available: {", ".join(operations)}')
+
+        dataset = self._setup(options['scale'])
+        results = {
+            'label': options['label'],
+            'scale': options['scale'],
+            'dataset': dataset,
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'repeat': options['repeat'],
+            'results': {},
+        }
+        self.stdout.write(self.style.MIGRATE_HEADING(f'scale {options["scale"]}: {dataset}'))
+        for name in names:
+            result = self._measure(operations[name], options['repeat'], options['min_time'])
+            results['results'][name] = result
+            self.stdout.write(f'  {name}: {result["time_ms"]:.2f} ms (min {result["min_ms"]:.2f}, '
+                              f'stdev {result["stdev_ms"]:.2f}, {result["repeat"]} runs), '
+                              f'{result["queries"]} queries, peak {result["peak_kb"]:.1f} KB')
+
+        if options['output']:
+            options['output'].write_text(json.dumps(results, indent=2))
+            self.stdout.write(self.style.SUCCESS(f'Saved results to {options["output"]}'))
+        if options['compare']:
+            self._compare(json.loads(options['compare'].read_text()), results, options['threshold'],
+                          options['noise'])
+
+    def _setup(self, scale: str) -> Dict[str, int]:
+        """Фикстура создается один раз через add_data и переиспользуется при следующих запусках"""
+        params = self.scales[scale]
+        synthetic = Mailing.objects.filter(text__startswith='Synthetic mailing')
+        missing_clients = max(params['clients'] - Client.objects.count(), 0)
+        missing_mailings = max(params['mailings'] - synthetic.count(), 0)
+        if missing_clients or missing_mailings:
+            self.stdout.write(f'Generate fixture: {missing_clients} clients, {missing_mailings} mailings')
+            # Seed зависит от числа клиентов, чтобы догенерация не повторяла номера
+            call_command('add_data', clients=missing_clients, tags=50, codes=20, code_distribution='zipf:1.1',
+                         mailings=missing_mailings, messages=params['messages'],
+                         status_mix='sent:0.9,failed:0.05,pending:0.05',
+                         seed=Client.objects.count(), stdout=io.StringIO())
+
+        if not Mailing.objects.filter(text=self.pending_text).exists():
+            mailing = self._create_mailing(self.pending_text)
+            TaskMailingDB(mailing).create_messages()
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        return {'clients': Client.objects.count(), 'mailings': Mailing.objects.count(),
+                'messages': Message.objects.count()}
+
+    @staticmethod
+    def _create_mailing(text: str) -> Mailing:
+        now = timezone.now()
+        mailing = Mailing.objects.create(start_date=now, finish_date=now + timezone.timedelta(days=1), text=text)
+        mailing.tag.set(Tag.objects.all())
+        mailing.code.set(OperatorCode.objects.all())
+        return mailing
+
+    def _get_operations(self) -> Dict[str, Callable[[], Callable[[], Any]]]:
+        """Подготовка операции (не замеряется) возвращает замеряемую функцию"""
+        return {
+            'create_messages': self._create_messages,
+            'get_queryset_messages': self._get_queryset_messages,
+            'get_queryset_list': lambda: lambda: list(Statistic.get_queryset_list()[:self.page_size]),
+            'get_queryset_to_date': lambda: lambda: list(
+                Statistic.get_queryset_to_date(timezone.now() - timezone.timedelta(days=1))),
+            'generation_csv': self._generation_csv,
+            'statistics_serializer': self._statistics_serializer,
+            'client_serializer': self._client_serializer,
+            'client_serializer_validate': self._client_serializer_validate,
+        }
+
+    def _create_messages(self) -> Callable[[], int]:
+        """Сообщения по всем клиентам для новой рассылки"""
+        return TaskMailingDB(self._create_mailing('benchmark create_messages')).create_messages
+
+    def _get_queryset_messages(self) -> Callable[[], List]:
+        """Первое окно сообщений к отправке и проверка наличия пустых сообщений"""
+        task_mailing_db = TaskMailingDB(Mailing.objects.get(text=self.pending_text))
+
+        def run():
+            task_mailing_db.get_queryset_messages().exists()
+            return list(islice(task_mailing_db.iter_messages(), 1000))
+        return run
+
+    @staticmethod
+    def _generation_csv() -> Callable[[], None]:
+        """Статистика рассылок за 30 дней в сжатый CSV"""
+        data = Statistic.get_queryset_period(timezone.now() - timezone.timedelta(days=30))
+
+        def run():
+            generation_csv(data, 'benchmark').unlink()
+        return run
+
+    def _statistics_serializer(self) -> Callable[[], List]:
+        rows = list(Statistic.get_queryset_list()[:self.page_size])
+        return lambda: StatisticsSerializer(rows, many=True).data
+
+    def _client_serializer(self) -> Callable[[], List]:
+        clients = list(Client.objects.order_by('-id')[:self.client_batch])
+        return lambda: ClientSerializer(clients, many=True).data
+
+    def _client_serializer_validate(self) -> Callable[[], bool]:
+        """Проверка новых клиентов (в том числе уникальности телефона)"""
+        data = [{'phone': f'7999{i:07d}', 'tag': None, 'time_zone': 'Europe/Minsk'}
+                for i in range(self.client_batch)]
+        return lambda: ClientSerializer(data=data, many=True).is_valid()
+
+    def _measure(self, operation: Callable[[], Callable[[], Any]], repeat: int,
+                 min_time: float = 0) -> Dict[str, float]:
+        """Прогрев, запуск с подсчетом запросов и пика памяти (tracemalloc), затем замеры времени
+        без tracemalloc: не меньше repeat запусков, быстрые операции повторяются до min_time.
+        Каждый запуск в транзакции с откатом"""
+        queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        def run(trace: bool) -> Tuple[float, int]:
+            with transaction.atomic():
+                func = operation()
+                if trace:
+                    tracemalloc.start()
+                start = time.perf_counter()
+                with connection.execute_wrapper(count_queries) if trace else nullcontext():
+                    func()
+                elapsed = (time.perf_counter() - start) * 1000
+                peak = 0
+                if trace:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                transaction.set_rollback(True)
+            return elapsed, peak
+
+        run(trace=False)
+        _, peak = run(trace=True)
+        timings = []
+        deadline = time.perf_counter() + min_time
+        while len(timings) < max(repeat, 1) or \
+                (time.perf_counter() < deadline and len(timings) < self.max_repeat):
+            timings.append(run(trace=False)[0])
+        return {'time_ms': round(statistics.median(timings), 3), 'min_ms': round(min(timings), 3),
+                'stdev_ms': round(statistics.stdev(timings), 3) if len(timings) > 1 else 0.0,
+                'repeat': len(timings), 'queries': queries, 'peak_kb': round(peak / 1024, 1)}
+
+    def _compare(self, baseline: Dict[str, Any], results: Dict[str, Any], threshold: float,
+                 noise: float = 1.0) -> None:
+        self.stdout.write(self.style.MIGRATE_HEADING(f'compare with {baseline.get("label") or "baseline"} '
+                                                     f'(threshold {threshold:.0%}, noise {noise} ms)'))
+        if baseline.get('scale') != results['scale'] or baseline.get('dataset') != results['dataset']:
+            self.stdout.write(self.style.WARNING(f'Datasets differ: {baseline.get("scale")} '
+                                                 f'{baseline.get("dataset")}'))
+
+        regressions = []
+        for name, result in results['results'].items():
+            base = baseline.get('results', {}).get(name)
+            if base is None:
+                self.stdout.write(f'  {name}: no baseline')
+                continue
+            problems = []
+            # Минимальное время меньше зависит от шума, чем медиана. Для операций в несколько мс
+            # относительный порог меньше разброса запусков: разница должна превышать и шум
+            spread = 3 * max(base.get('stdev_ms', 0), result['stdev_ms'])
+            if result['min_ms'] > base['min_ms'] * (1 + threshold) and \
+                    result['min_ms'] - base['min_ms'] > max(noise, spread):
+                problems.append('time')
+            if result['peak_kb'] > base['peak_kb'] * (1 + threshold):
+                problems.append('memory')
+            if result['queries'] > base['queries']:
+                problems.append('queries')
+            line = f'  {name}: time {self._delta(base["min_ms"], result["min_ms"])}, ' \
+                   f'queries {base["queries"]} -> {result["queries"]}, ' \
+                   f'peak {self._delta(base["peak_kb"], result["peak_kb"])}'
+            if problems:
+                regressions.append(f'{name} ({", ".join(problems)})')
+                self.stdout.write(self.style.ERROR(f'{line} REGRESSION'))
+            else:
+                self.stdout.write(line)
+
+        if regressions:
+            raise CommandError(f'Regressions: {"; ".join(regressions)}')
+        self.stdout.write(self.style.SUCCESS('No regressions'))
+
+    @staticmethod
+    def _delta(before: float, after: float) -> str:
+        change = f'{(after - before) / before:+.0%}' if before else 'n/a'
+        return f'{before} -> {after} ({change})'
+
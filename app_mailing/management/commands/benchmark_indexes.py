@@ -0,0 +1,137 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.db.models.query import QuerySet
+from django.utils import timezone
+import re
+import statistics
+from typing import Dict, List, Tuple
+from app_mailing.models import Mailing, Message
+from app_mailing.services import TaskMailingDB, Statistic
+
+
+class Command(BaseCommand):
+    help = 'benchmark hot Message queries with and without Message indexes (EXPLAIN ANALYZE)'
+    mailing_text = 'benchmark_indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=3000000, help='messages to generate')
+        parser.add_argument('--mailings', type=int, default=30, help='mailings to spread messages over')
+        parser.add_argument('--repeat', type=int, default=5, help='runs of every query')
+        parser.add_argument('--keep', action='store_true', help='keep generated data')
+        parser.add_argument('--plans', action='store_true', help='print query plans')
+        parser.add_argument('--seed', type=int, default=0, help='random seed of generated data')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('PostgreSQL is required')
+
+        index_names = [index.name for index in Message._meta.indexes]
+        missing = set(index_names) - self._get_existing_indexes()
+        if missing:
+            raise CommandError(f'Indexes {", ".join(sorted(missing))} not found, '
+                               f'run makemigrations and migrate')
+
+        mailing_ids = self._add_data(options['rows'], options['mailings'], options['seed'])
+        try:
+            queries = self._get_queries(mailing_ids[0])
+
+            # Исходная схема: вместо индексов Message только индекс внешнего ключа mailing_id
+            with transaction.atomic():
+                qn = connection.ops.quote_name
+                with connection.cursor() as cursor:
+                    for name in index_names:
+                        cursor.execute(f'DROP INDEX {qn(name)}')
+                    cursor.execute(f'CREATE INDEX {qn("benchmark_message_mailing_id")} '
+                                   f'ON {qn(Message._meta.db_table)} '
+                                   f'({qn(Message._meta.get_field("mailing").column)})')
+                    cursor.execute(f'ANALYZE {qn(Message._meta.db_table)}')
+                before = self._run(queries, options['repeat'], options['plans'], 'without indexes (FK index only)')
+                transaction.set_rollback(True)
+
+            after = self._run(queries, options['repeat'], options['plans'], 'with indexes')
+            self._report(before, after)
+        finally:
+            if not options['keep']:
+                Mailing.objects.filter(id__in=mailing_ids).delete()
+                self.stdout.write(self.style.SUCCESS('Deleted generated data'))
+
+    @staticmethod
+    def _get_existing_indexes() -> set:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s',
+                           [Message._meta.db_table])
+            return {row[0] for row in cursor.fetchall()}
+
+    def _add_data(self, rows: int, mailings: int, seed: int = 0) -> List[int]:
+        """Сообщения генерируются на стороне БД: ~10% пустых, ~10% не отправленных.
+        random() инициализируется seed, данные повторяются между запусками"""
+        now = timezone.now()
+        mailing_objs = Mailing.objects.bulk_create(
+            Mailing(start_date=now - timezone.timedelta(days=30), finish_date=now + timezone.timedelta(days=1),
+                    text=self.mailing_text, status=1)
+            for _ in range(mailings)
+        )
+        mailing_ids = [mailing.id for mailing in mailing_objs]
+
+        qn = connection.ops.quote_name
+        opts = Message._meta
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT setseed(%s)', [(seed % 2 ** 31) / 2 ** 31])
+            cursor.execute(
+                f'INSERT INTO {qn(opts.db_table)} '
+                f'({qn(opts.get_field("send_date").column)}, {qn(opts.get_field("status").column)}, '
+                f'{qn(opts.get_field("mailing").column)}, {qn(opts.get_field("attempts").column)}) '
+                f'SELECT now() - s.r * interval \'30 days\', '
+                f'CASE WHEN s.r < 0.1 THEN NULL WHEN s.r < 0.2 THEN 0 ELSE 1 END, '
+                f'(%s::bigint[])[1 + s.g %% %s], 0 '
+                f'FROM (SELECT g, random() AS r FROM generate_series(1, %s) AS g) AS s',
+                [mailing_ids, len(mailing_ids), rows]
+            )
+            cursor.execute(f'VACUUM ANALYZE {qn(opts.db_table)}')
+        self.stdout.write(self.style.SUCCESS(f'Added {rows} messages for {mailings} mailings'))
+        return mailing_ids
+
+    @staticmethod
+    def _get_queries(mailing_id: int) -> Dict[str, QuerySet]:
+        task_mailing_db = TaskMailingDB(Mailing.objects.get(pk=mailing_id))
+        pending = task_mailing_db.get_queryset_messages()
+        return {
+            'pending window': task_mailing_db.get_queryset_due_messages().filter(id__gt=0).order_by('id').
+            values_list('id', 'client_id', 'client__phone', 'attempts')[:1000],
+            'pending exists': pending.order_by().values('id')[:1],
+            'pending count': pending.order_by().values('mailing').annotate(cnt=Count('id')),
+            'statistics page': Statistic.get_queryset_list()[:10],
+            'messages page': Statistic.get_queryset_messages(mailing_id).order_by('-id')[:100],
+            'messages by status page': Statistic.get_queryset_messages(mailing_id, status='0').order_by('-id')[:100],
+            'statistics to date': Statistic.get_queryset_to_date(timezone.now() - timezone.timedelta(days=1)),
+        }
+
+    def _run(self, queries: Dict[str, QuerySet], repeat: int, plans: bool, title: str) -> Dict[str, float]:
+        self.stdout.write(self.style.MIGRATE_HEADING(title))
+        result = {}
+        for name, queryset in queries.items():
+            timings, plan = [], ''
+            for _ in range(repeat):
+                execution_time, plan = self._explain(queryset)
+                timings.append(execution_time)
+            result[name] = statistics.median(timings)
+            self.stdout.write(f'  {name}: {result[name]:.2f} ms')
+            if plans:
+                self.stdout.write(plan)
+        return result
+
+    @staticmethod
+    def _explain(queryset: QuerySet) -> Tuple[float, str]:
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS) {sql}', params)
+            plan = '\n'.join(f'    {row[0]}' for row in cursor.fetchall())
+        execution_time = float(re.search(r'Execution Time: ([\d.]+) ms', plan).group(1))
+        return execution_time, plan
+
+    def _report(self, before: Dict[str, float], after: Dict[str, float]) -> None:
+        self.stdout.write(self.style.MIGRATE_HEADING('summary (median execution time)'))
+        for name in before:
+            speedup = before[name] / after[name] if after[name] else float('inf')
+            self.stdout.write(f'  {name}: {before[name]:.2f} ms -> {after[name]:.2f} ms (x{speedup:.1f})')
@@ -0,0 +1,241 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+import json
+import resource
+import statistics
+import time
+from typing import Any, Dict, List
+from app_user.models import Client, Tag
+from app_user.services import OperatorCodeDB
+from app_mailing.fake_probe import FakeProbeServer
+from app_mailing.models import Mailing, MailingStats
+from app_mailing.services import MsgAPI, TaskMailing
+from app_mailing.tasks import send_mailing
+from app_mailing.transport import transport
+from config import celery_app
+
+
+class Command(BaseCommand):
+    help = 'load test of send_mailing against a local fake probe server: throughput, send latency, ' \
+           'DB queries per message and worker RSS. The default eager run is a reduced approximation: ' \
+           'one process, MAILING_WORKERS=1, no broker, worker pool or multi-part claiming (use --celery)'
+    tag_name = 'loadtest'
+    mailing_text = 'loadtest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=10000, help='audience size')
+        parser.add_argument('--codes', type=int, default=5, help='operator codes of the audience')
+        parser.add_argument('--code-start', type=int, default=990, help='first operator code')
+        parser.add_argument('--latency', default='exp:20',
+                            help='response latency, ms: fixed:<ms>, uniform:<min>:<max>, exp:<mean>, '
+                                 'lognormal:<median>:<sigma>')
+        parser.add_argument('--error-rate', type=float, default=0, help='share of HTTP 400 responses')
+        parser.add_argument('--server-error-rate', type=float, default=0, help='share of HTTP 500 responses')
+        parser.add_argument('--drop-rate', type=float, default=0, help='share of connections closed without response')
+        parser.add_argument('--burst', default='0:0',
+                            help='HTTP 503 bursts <every>:<duration>, seconds (0:0 - no bursts)')
+        parser.add_argument('--concurrency', type=int, help='MAILING_CONCURRENCY for the eager run')
+        parser.add_argument('--celery', action='store_true',
+                            help='send through the broker to running workers, their PROBE_SERVER_URL '
+                                 'must point to the fake server (see --host, --port); latency is measured '
+                                 'by the fake server, DB queries are not counted')
+        parser.add_argument('--host', default='127.0.0.1', help='fake server host')
+        parser.add_argument('--port', type=int, default=0, help='fake server port (0 - any free port)')
+        parser.add_argument('--timeout', type=int, default=3600, help='max mailing duration, seconds')
+        parser.add_argument('--seed', type=int, default=0, help='random seed of the fake server')
+        parser.add_argument('--keep', action='store_true', help='keep generated data')
+        parser.add_argument('--json', action='store_true', help='print report as JSON')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('PostgreSQL is required')
+        try:
+            burst_every, burst_duration = (float(value) for value in options['burst'].split(':'))
+            server = FakeProbeServer(options['host'], options['port'], options['latency'],
+                                     options['error_rate'], options['server_error_rate'], options['drop_rate'],
+                                     burst_every, burst_duration, options['seed'])
+        except ValueError as ex:
+            raise CommandError(ex)
+
+        mailing = None
+        with server:
+            try:
+                mailing = self._add_data(options['clients'], options['codes'], options['code_start'],
+                                         options['timeout'])
+                if options['celery']:
+                    report = {'mode': 'celery', **self._run_celery(mailing, server, options['timeout'])}
+                else:
+                    report = {'mode': 'eager', **self._run_eager(mailing, server, options['concurrency'])}
+            finally:
+                if mailing is not None and not options['keep']:
+                    self._delete_data(mailing)
+
+        report['server'] = server.stats()[0]
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self._report(report)
+
+    def _add_data(self, clients: int, codes: int, code_start: int, timeout: int) -> Mailing:
+        """Аудитория генерируется на стороне БД, повторный запуск не создает дубликатов"""
+        if codes < 1 or code_start < 100 or code_start + codes > 1000:
+            raise CommandError('Operator codes must be three digits')
+        tag, _ = Tag.objects.get_or_create(name=self.tag_name, defaults={'description': 'Load test audience'})
+        code_objs = OperatorCodeDB.get_or_create_codes(str(code) for code in range(code_start, code_start + codes))
+        code_names = sorted(code_objs)
+
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {qn(Client._meta.db_table)} '
+                f'({qn("phone")}, {qn("code_id")}, {qn("tag_id")}, {qn("time_zone")}) '
+                f'SELECT \'7\' || (%s::text[])[1 + g %% %s] || lpad((g / %s)::text, 7, \'0\'), '
+                f'(%s::bigint[])[1 + g %% %s], %s, %s '
+                f'FROM generate_series(0, %s) AS g ON CONFLICT (phone) DO NOTHING',
+                [code_names, codes, codes, [code_objs[code].id for code in code_names], codes,
+                 tag.id, settings.TIME_ZONE, clients - 1]
+            )
+
+        now = timezone.now()
+        mailing = Mailing.objects.create(start_date=now, finish_date=now + timezone.timedelta(seconds=timeout),
+                                         text=self.mailing_text)
+        mailing.tag.set([tag])
+        mailing.code.set(code_objs.values())
+        self.stdout.write(self.style.SUCCESS(f'Audience: {Client.objects.filter(tag=tag).count()} clients, '
+                                             f'mailing_id={mailing.id}'))
+        return mailing
+
+    def _delete_data(self, mailing: Mailing) -> None:
+        mailing.delete()
+        Client.objects.filter(tag__name=self.tag_name).delete()
+        Tag.objects.filter(name=self.tag_name).delete()
+        self.stdout.write(self.style.SUCCESS('Deleted generated data'))
+
+    def _run_eager(self, mailing: Mailing, server: FakeProbeServer, concurrency: int = None) -> Dict[str, Any]:
+        """Рассылка в текущем процессе: задержка по ответам клиента, запросы к БД по текущему соединению.
+        Приближение: брокер, пул воркеров и совместный захват сообщений частями не участвуют"""
+        latencies: List[float] = []
+        queries = 0
+
+        def on_response(response, *args, **kwargs):
+            latencies.append(response.elapsed.total_seconds() * 1000)
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        url, MsgAPI.url = MsgAPI.url, server.url
+        hooks = transport.session.hooks['response']
+        hooks.append(on_response)
+        rss_before = self._get_rss()
+        try:
+            # Части рассылки в eager-режиме не запускаются: отправка в одном процессе
+            with override_settings(MAILING_WORKERS=1,
+                                   MAILING_CONCURRENCY=concurrency or settings.MAILING_CONCURRENCY), \
+                    connection.execute_wrapper(count_queries):
+                start = time.monotonic()
+                send_mailing.apply(kwargs={'mailing_id': mailing.id})
+                elapsed = time.monotonic() - start
+        finally:
+            hooks.remove(on_response)
+            MsgAPI.url = url
+
+        rss = self._get_rss()
+        report = self._get_result(mailing, elapsed, latencies, 'client')
+        report['queries_per_message'] = round(queries / report['messages'], 2) if report['messages'] else None
+        report['rss_kb'] = {'before': rss_before['current'], 'after': rss['current'], 'peak': rss['peak']}
+        return report
+
+    def _run_celery(self, mailing: Mailing, server: FakeProbeServer, timeout: int) -> Dict[str, Any]:
+        """Рассылка воркерами через брокер: задержка по данным fake-сервера, RSS процессов пула"""
+        if not settings.PROBE_SERVER_URL.startswith(server.url):
+            self.stdout.write(self.style.WARNING(f'PROBE_SERVER_URL is {settings.PROBE_SERVER_URL}, '
+                                                 f'workers must send to {server.url}'))
+        start = time.monotonic()
+        mailing.task_uuid = TaskMailing(mailing).create_task()
+        mailing.save(update_fields=['task_uuid'])
+
+        while Mailing.objects.filter(pk=mailing.pk, status__lte=1).exists():
+            if time.monotonic() - start > timeout:
+                raise CommandError(f'Mailing is not finished in {timeout} s')
+            time.sleep(0.5)
+        elapsed = time.monotonic() - start
+
+        report = self._get_result(mailing, elapsed, server.stats()[1], 'server')
+        report['queries_per_message'] = None
+        report['rss_kb'] = self._get_workers_rss()
+        return report
+
+    @staticmethod
+    def _get_result(mailing: Mailing, elapsed: float, latencies: List[float], source: str) -> Dict[str, Any]:
+        mailing.refresh_from_db()
+        stats = MailingStats.objects.filter(mailing=mailing).values('sent', 'failed', 'pending').first() or \
+            {'sent': 0, 'failed': 0, 'pending': 0}
+        messages = stats['sent'] + stats['failed']
+        if len(latencies) > 1:
+            cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+            latency = {'p50': round(cuts[49], 2), 'p95': round(cuts[94], 2), 'p99': round(cuts[98], 2)}
+        else:
+            latency = {'p50': None, 'p95': None, 'p99': None}
+        return {
+            'mailing_id': mailing.id,
+            'status': mailing.get_status_display(),
+            'messages': messages,
+            **stats,
+            'elapsed': round(elapsed, 3),
+            'throughput': round(messages / elapsed, 1) if elapsed else None,
+            'latency_ms': {'source': source, 'responses': len(latencies), **latency},
+        }
+
+    @staticmethod
+    def _get_rss(pid: str = 'self') -> Dict[str, int] | None:
+        """Текущий и пиковый RSS процесса, КБ"""
+        try:
+            with open(f'/proc/{pid}/status') as file:
+                values = dict(line.split(':', 1) for line in file)
+        except OSError:
+            if pid != 'self':
+                return None
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return {'current': None, 'peak': peak}
+        return {'current': int(values['VmRSS'].split()[0]), 'peak': int(values['VmHWM'].split()[0])}
+
+    def _get_workers_rss(self) -> Dict[str, Any]:
+        """RSS процессов пула воркеров (на этом хосте), иначе maxrss главного процесса воркера"""
+        result = {}
+        for worker, stats in (celery_app.control.inspect(timeout=2).stats() or {}).items():
+            processes = [self._get_rss(str(pid)) for pid in stats.get('pool', {}).get('processes', [])]
+            processes = [rss for rss in processes if rss]
+            if processes:
+                result[worker] = {'current': sum(rss['current'] for rss in processes),
+                                  'peak': max(rss['peak'] for rss in processes)}
+            else:
+                result[worker] = {'current': None, 'peak': stats.get('rusage', {}).get('maxrss')}
+        return result
+
+    def _report(self, report: Dict[str, Any]) -> None:
+        self.stdout.write(self.style.MIGRATE_HEADING(f'mailing_id={report["mailing_id"]}: {report["status"]} '
+                                                     f'({report["mode"]})'))
+        if report['mode'] == 'eager':
+            self.stdout.write(self.style.WARNING('  eager run: one process without broker, worker pool and '
+                                                 'multi-part claiming, use --celery for the full pipeline'))
+        self.stdout.write(f'  messages: {report["messages"]} (sent {report["sent"]}, failed {report["failed"]}, '
+                          f'pending {report["pending"]})')
+        self.stdout.write(f'  elapsed: {report["elapsed"]:.1f} s')
+        self.stdout.write(f'  throughput: {report["throughput"]} messages/s')
+        latency = report['latency_ms']
+        self.stdout.write(f'  send latency ({latency["source"]}, {latency["responses"]} responses): '
+                          f'p50 {latency["p50"]} ms, p95 {latency["p95"]} ms, p99 {latency["p99"]} ms')
+        if report['queries_per_message'] is not None:
+            self.stdout.write(f'  DB queries per message: {report["queries_per_message"]}')
+        if 'before' in report['rss_kb']:
+            rss = report['rss_kb']
+            self.stdout.write(f'  RSS: {rss["before"]} KB -> {rss["after"]} KB, peak {rss["peak"]} KB')
+        else:
+            for worker, rss in report['rss_kb'].items():
+                self.stdout.write(f'  RSS {worker}: {rss["current"]} KB, peak {rss["peak"]} KB')
+        self.stdout.write(f'  fake server: {", ".join(f"{key} {value}" for key, value in report["server"].items())}')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from app_mailing.services import MailingStatsDB
+
+
+class Command(BaseCommand):
+    help = 'rebuild MailingStats counters from the message table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('mailing_ids', nargs='*', type=int, help='mailings to rebuild (default: all)')
+
+    def handle(self, *args, **options):
+        count = MailingStatsDB.rebuild(options['mailing_ids'] or None)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt counters for {count} mailings'))
@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.db import DatabaseError
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, multiprocess, \
+    start_http_server
+from prometheus_client.core import GaugeMetricFamily
+import logging
+import os
+import time
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+messages_total = Counter('mailing_messages_total', 'Processed messages by final status',
+                         ['mailing_id', 'code', 'status'])
+message_retries_total = Counter('mailing_message_retries_total', 'Failed attempts postponed for retry',
+                                ['mailing_id', 'code'])
+task_retries_total = Counter('mailing_task_retries_total', 'Mailing task restarts', ['task'])
+task_duration_seconds = Histogram('mailing_task_duration_seconds', 'Task duration', ['task'],
+                                  buckets=(1, 5, 15, 60, 300, 900, 3600, 4 * 3600, 24 * 3600))
+probe_request_seconds = Histogram('probe_request_duration_seconds', 'Probe API request latency', ['outcome'],
+                                  buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 20))
+probe_requests_in_flight = Gauge('probe_requests_in_flight', 'Probe API requests in flight',
+                                 multiprocess_mode='livesum')
+probe_connections_total = Counter('probe_connections_total', 'Probe API connections: opened and reused (keep-alive)',
+                                  ['kind'])
+rate_limit_wait_seconds_total = Counter('probe_rate_limit_wait_seconds_total', 'Time waiting for rate limit tokens')
+limiter_errors_total = Counter('probe_limiter_errors_total', 'Redis errors in rate limiter and circuit breaker '
+                               '(request is let through)', ['limiter'])
+status_flush_seconds = Histogram('message_status_flush_duration_seconds', 'Message status buffer flush latency',
+                                 buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+create_messages_seconds = Histogram('mailing_create_messages_duration_seconds', 'Pending messages creation',
+                                    buckets=(.1, .5, 1, 5, 15, 60, 300))
+statistics_reports_total = Counter('statistics_reports_total', 'Daily statistics reports', ['result'])
+
+
+class BacklogCollector:
+    """Пустые сообщения запущенных рассылок по счетчикам MailingStats, читаются при сборе метрик"""
+
+    def describe(self):
+        # Без describe реестр вызывает collect (запрос к БД) при регистрации
+        yield self._family()
+
+    def collect(self):
+        from .models import MailingStats
+
+        family = self._family()
+        try:
+            rows = list(MailingStats.objects.filter(mailing__status=1).values_list('mailing_id', 'pending'))
+        except DatabaseError as ex:
+            # Остальные метрики отдаются и без БД
+            logger.exception(f'metrics: pending backlog - {ex}', exc_info=None)
+            rows = []
+        for mailing_id, pending in rows:
+            family.add_metric([str(mailing_id)], pending)
+        yield family
+
+    @staticmethod
+    def _family() -> GaugeMetricFamily:
+        return GaugeMetricFamily('mailing_pending_messages', 'Pending messages of started mailings',
+                                 labels=['mailing_id'])
+
+
+def observe_probe_request(outcome: str, start: float) -> None:
+    probe_request_seconds.labels(outcome).observe(time.perf_counter() - start)
+
+
+def observe_connections(stats: Dict[str, int]) -> None:
+    """Прирост открытых и повторно использованных соединений пула (ProbeTransport.pop_stats)"""
+    for kind in ('opened', 'reused'):
+        if stats.get(kind):
+            probe_connections_total.labels(kind).inc(stats[kind])
+
+
+def get_registry() -> CollectorRegistry:
+    """Реестр для выдачи метрик: в multiprocess-режиме значения собираются из файлов всех процессов"""
+    if not settings.PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(BacklogCollector())
+    return registry
+
+
+def start_worker_server() -> None:
+    """HTTP-сервер метрик в главном процессе воркера"""
+    if settings.PROMETHEUS_WORKER_PORT:
+        start_http_server(settings.PROMETHEUS_WORKER_PORT, registry=get_registry())
+        logger.info(f'[pid={os.getpid()}]: metrics server on port {settings.PROMETHEUS_WORKER_PORT}')
+
+
+def mark_process_dead() -> None:
+    """Удалить live-gauge завершившегося процесса (multiprocess-режим)"""
+    if settings.PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+if not settings.PROMETHEUS_MULTIPROC_DIR:
+    REGISTRY.register(BacklogCollector())
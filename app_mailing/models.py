@@ -15,6 +15,8 @@ class Mailing(models.Model):
     code = models.ManyToManyField(OperatorCode, blank=True, related_name='mailing')
     status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, default=0)
     task_uuid = models.UUIDField(null=True, editable=False)
+    # Профилирование задач рассылки (см. PROFILE_SAMPLE_RATE)
+    profile = models.BooleanField(default=False)
 
     def __str__(self):
         return f'{self.id}: {self.start_date}-{self.finish_date}'
@@ -29,11 +31,92 @@ class Message(models.Model):
 
     send_date = models.DateTimeField(default=timezone.now)
     status = models.IntegerField(choices=STATUS_CHOICES, blank=True, null=True)
-    mailing = models.ForeignKey(Mailing, on_delete=models.CASCADE, related_name='message')
+    # Индекс по рассылке заменяет message_mailing_id_idx
+    mailing = models.ForeignKey(Mailing, on_delete=models.CASCADE, related_name='message', db_index=False)
     client = models.ForeignKey(Client, on_delete=models.SET_NULL, null=True, related_name='message')
+    lease_until = models.DateTimeField(blank=True, null=True, editable=False)
+    attempts = models.PositiveSmallIntegerField(default=0, editable=False)
+    next_attempt_at = models.DateTimeField(blank=True, null=True, editable=False)
+    # Время записи статуса в БД, по нему rollup учитывает и запоздавшие записи
+    processed_at = models.DateTimeField(blank=True, null=True, editable=False)
 
     def __str__(self):
         return f'{self.id}: {self.status}'
 
     class Meta:
         ordering = ['-id']
+        indexes = [
+            # Пустые сообщения рассылки в порядке id (отправка, захват, остановка по времени)
+            models.Index(fields=['mailing', 'id'], include=['next_attempt_at', 'lease_until'],
+                         condition=models.Q(status__isnull=True), name='message_pending_idx'),
+            # Сообщения рассылки в порядке id (keyset-пагинация)
+            models.Index(fields=['mailing', 'id'], name='message_mailing_id_idx'),
+            # Счетчики по статусам и сообщения со статусом в порядке id (index-only scan)
+            models.Index(fields=['mailing', 'status', 'id'], name='message_mailing_status_idx'),
+            # Сообщения по времени записи статуса (инкрементальный rollup статистики)
+            models.Index(fields=['processed_at'], condition=models.Q(processed_at__isnull=False),
+                         name='message_processed_at_idx'),
+        ]
+
+
+class MailingStats(models.Model):
+    """Счетчики сообщений рассылки"""
+    mailing = models.OneToOneField(Mailing, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    pending = models.IntegerField(default=0)
+    sent = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    last_update = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'{self.mailing_id}: {self.sent}/{self.failed}/{self.pending}'
+
+
+class MailingStatsHourly(models.Model):
+    """Почасовая статистика рассылки по коду оператора и тэгу клиента"""
+    mailing = models.ForeignKey(Mailing, on_delete=models.CASCADE, related_name='stats_hourly')
+    hour = models.DateTimeField()
+    code = models.CharField(max_length=3, blank=True)
+    tag = models.CharField(max_length=100, blank=True)
+    sent = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    # Сумма задержек от начала рассылки до отправки (send_date - start_date) по отправленным, сек
+    delay_sum = models.FloatField(default=0)
+
+    def __str__(self):
+        return f'{self.mailing_id}: {self.hour} {self.code} {self.tag}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['mailing', 'hour', 'code', 'tag'], name='stats_hourly_key'),
+        ]
+        indexes = [
+            models.Index(fields=['hour'], name='stats_hourly_hour_idx'),
+        ]
+
+
+class StatsWatermark(models.Model):
+    """Отметка, до которой сообщения учтены в агрегатах статистики"""
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.name}: {self.value}'
+
+
+class MailingBreakdown(models.Model):
+    """Сообщения рассылки по коду оператора и тэгу (materialized view, см. MailingBreakdownDB)"""
+    key = models.CharField(max_length=200, primary_key=True)
+    mailing = models.ForeignKey(Mailing, on_delete=models.DO_NOTHING, related_name='breakdown', db_constraint=False)
+    code = models.CharField(max_length=3)
+    tag = models.CharField(max_length=100)
+    total = models.IntegerField()
+    sent = models.IntegerField()
+    failed = models.IntegerField()
+    pending = models.IntegerField()
+
+    def __str__(self):
+        return self.key
+
+    class Meta:
+        managed = False
+        db_table = 'app_mailing_breakdown'
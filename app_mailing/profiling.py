@@ -0,0 +1,179 @@
+from django.conf import settings
+from django.utils import timezone
+from collections import Counter
+from pathlib import Path
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+from .models import Mailing
+
+logger = logging.getLogger(__name__)
+
+
+class TaskProfiler:
+    """Семплирующий профилировщик задачи: фоновый поток с интервалом PROFILE_INTERVAL снимает стеки
+    потока задачи и потоков отправки (sys._current_frames) и раскладывает время по группам.
+    Включается для доли запусков (PROFILE_SAMPLE_RATE) или для рассылки с флагом profile,
+    иначе start и stop ничего не делают"""
+    # Группа определяется по файлам кадров стека, порядок задает приоритет
+    buckets = (
+        ('http', ('/requests/', '/urllib3/', '/http/client.py', '/socket.py', '/ssl.py')),
+        ('db', ('/django/db/', '/psycopg2/')),
+        ('redis', ('/redis/',)),
+        ('serialization', ('/json/', '/rest_framework/', '/csv.py', '/gzip.py')),
+        ('wait', ('/threading.py', '/queue.py', '/concurrent/futures/', '/app_mailing/limiters.py')),
+    )
+    logging_files = ('/logging/', '/config/log.py')
+    dispatch_thread_prefix = 'mailing-dispatch'
+    max_depth = 64
+
+    def __init__(self, task_name: str, task_id: str = None, mailing: Mailing = None):
+        self.__task_name = task_name
+        self.__task_id = task_id or ''
+        self.__mailing_id = mailing.id if mailing else None
+        self.__enabled = bool(mailing and mailing.profile) or \
+            (settings.PROFILE_SAMPLE_RATE > 0 and random.random() < settings.PROFILE_SAMPLE_RATE)
+        self.__thread = None
+        self.__stop = threading.Event()
+        self.__target = None
+        self.__samples = 0
+        self.__task_buckets = Counter()
+        self.__dispatch_buckets = Counter()
+        self.__stacks = Counter()
+        self.__started_at = None
+        self.__start = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.__enabled
+
+    def __enter__(self) -> 'TaskProfiler':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        if not self.__enabled or self.__thread is not None:
+            return
+        self.__target = threading.get_ident()
+        self.__started_at = timezone.now()
+        self.__start = time.perf_counter()
+        self.__thread = threading.Thread(target=self._run, name='task-profiler', daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> Path | None:
+        """Остановить семплирование и сохранить отчет, возвращает путь к JSON"""
+        if self.__thread is None:
+            return None
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
+        try:
+            return self._save(self.get_report(time.perf_counter() - self.__start))
+        except OSError as ex:
+            # Ошибка записи отчета не должна ронять задачу
+            logger.exception(f'{self._log_prefix()}: profile is not saved - {ex}', exc_info=None,
+                             extra={'mailing_id': self.__mailing_id, 'task_id': self.__task_id})
+            return None
+
+    def get_report(self, elapsed: float) -> Dict[str, Any]:
+        """Время задачи по группам (share - доля семплов потока задачи) и суммарное время
+        занятых потоков отправки (threads - среднее число занятых потоков)"""
+        samples = self.__samples or 1
+
+        def breakdown(counter: Counter, key: str) -> Dict[str, Dict[str, float]]:
+            return {bucket: {'seconds': round(count / samples * elapsed, 3), key: round(count / samples, 3)}
+                    for bucket, count in counter.most_common()}
+
+        return {
+            'task': self.__task_name,
+            'task_id': self.__task_id,
+            'mailing_id': self.__mailing_id,
+            'started_at': self.__started_at.isoformat(),
+            'elapsed': round(elapsed, 3),
+            'interval': settings.PROFILE_INTERVAL,
+            'samples': self.__samples,
+            'wall': breakdown(self.__task_buckets, 'share'),
+            'dispatch_threads': breakdown(self.__dispatch_buckets, 'threads'),
+        }
+
+    def _run(self) -> None:
+        while not self.__stop.wait(settings.PROFILE_INTERVAL):
+            self._sample()
+
+    def _sample(self) -> None:
+        frames = sys._current_frames()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        self.__samples += 1
+        for ident, frame in frames.items():
+            if ident == self.__target:
+                kind = 'task'
+            elif names.get(ident, '').startswith(self.dispatch_thread_prefix):
+                kind = 'dispatch'
+            else:
+                continue
+            stack = self._get_stack(frame)
+            bucket = self.classify(stack)
+            if kind == 'task':
+                self.__task_buckets[bucket] += 1
+            elif bucket == 'idle':
+                # Свободные потоки пула отправки не учитываются
+                continue
+            else:
+                self.__dispatch_buckets[bucket] += 1
+            self.__stacks[';'.join([kind] + [f'{Path(filename).name}:{name}'
+                                            for filename, name in reversed(stack)])] += 1
+
+    def _get_stack(self, frame) -> List[Tuple[str, str]]:
+        """Кадры от вложенного к внешнему: файл и функция"""
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            stack.append((frame.f_code.co_filename.replace('\\', '/'), frame.f_code.co_name))
+            frame = frame.f_back
+        return stack
+
+    @classmethod
+    def classify(cls, stack: List[Tuple[str, str]]) -> str:
+        """Группа по самому вложенному узнаваемому кадру. Логирование учитывается по всему стеку
+        (внутри него json, очередь и т.д.), ожидание - только по самому вложенному кадру"""
+        if any(part in filename for filename, _ in stack for part in cls.logging_files):
+            return 'logging'
+        matches = [cls._match(filename) for filename, _ in stack]
+        if matches and all(match == 'wait' for match in matches):
+            return 'idle'
+        for index, match in enumerate(matches):
+            if match and (match != 'wait' or index == 0):
+                return match
+        return 'other'
+
+    @classmethod
+    def _match(cls, filename: str) -> str | None:
+        for bucket, parts in cls.buckets:
+            if any(part in filename for part in parts):
+                return bucket
+        return None
+
+    def _save(self, report: Dict[str, Any]) -> Path:
+        """JSON с разбивкой времени и свернутые стеки (формат flamegraph.pl / speedscope)"""
+        folder = settings.FOLDER_PROFILES
+        folder.mkdir(parents=True, exist_ok=True)
+        name = f'{self.__task_name}_{self.__mailing_id or ""}_{self.__started_at:%Y%m%d%H%M%S}_' \
+               f'{self.__task_id[:8]}'
+        file = folder / f'{name}.json'
+        file.write_text(json.dumps(report, indent=2))
+        (folder / f'{name}.folded').write_text(
+            ''.join(f'{stack} {count}\n' for stack, count in self.__stacks.most_common()))
+
+        wall = ', '.join(f'{bucket}={value["share"]:.0%}' for bucket, value in report['wall'].items())
+        logger.info(f'{self._log_prefix()}: profile {wall}, samples={report["samples"]}, file={file.name}',
+                    extra={'mailing_id': self.__mailing_id, 'task_id': self.__task_id})
+        return file
+
+    def _log_prefix(self) -> str:
+        return f'[mailing_id={self.__mailing_id}]' if self.__mailing_id else f'[task={self.__task_name}]'
@@ -3,7 +3,7 @@ from django.forms import model_to_dict
 from rest_framework import serializers
 import logging
 from .models import Mailing, Message
-from .services import TaskMailing
+from .services import TaskMailing, StatisticRollup, MailingBreakdownDB
 
 logger = logging.getLogger(__name__)
 
@@ -11,7 +11,7 @@ logger = logging.getLogger(__name__)
 class MailingSerializer(serializers.ModelSerializer):
     class Meta:
         model = Mailing
-        fields = ('id', 'start_date', 'finish_date', 'text', 'tag', 'code', 'status')
+        fields = ('id', 'start_date', 'finish_date', 'text', 'tag', 'code', 'status', 'profile')
         read_only_fields = ('status',)
 
     def validate_finish_date(self, value):
@@ -81,15 +81,85 @@ class MessageSerializer(serializers.ModelSerializer):
 class StatisticsSerializer(serializers.ModelSerializer):
     send_success = serializers.IntegerField()
     send_failed = serializers.IntegerField()
+    send_pending = serializers.IntegerField()
 
     class Meta:
         model = Mailing
         fields = ('id', 'start_date', 'finish_date', 'text', 'status',
-                  'send_success', 'send_failed')
+                  'send_success', 'send_failed', 'send_pending')
 
 
 class StatisticsDetailSerializer(StatisticsSerializer):
-    message = MessageSerializer(many=True, read_only=True)
-
     class Meta(StatisticsSerializer.Meta):
-        fields = StatisticsSerializer.Meta.fields + ('tag', 'code', 'message',)
+        fields = StatisticsSerializer.Meta.fields + ('tag', 'code')
+
+
+class MessageFilterSerializer(serializers.Serializer):
+    """Фильтры списка сообщений рассылки"""
+    status = serializers.ChoiceField(choices=('0', '1', 'pending'), required=False)
+    send_date_after = serializers.DateTimeField(required=False)
+    send_date_before = serializers.DateTimeField(required=False)
+
+    def validate(self, data):
+        send_date_after = data.get('send_date_after')
+        send_date_before = data.get('send_date_before')
+
+        if send_date_after and send_date_before and send_date_after >= send_date_before:
+            raise serializers.ValidationError(
+                'send_date_before must be greater than the send_date_after'
+            )
+        return data
+
+
+class StatisticsExportSerializer(serializers.Serializer):
+    """Период выгрузки статистики"""
+    date_from = serializers.DateTimeField()
+    date_to = serializers.DateTimeField(required=False)
+
+    def validate(self, data):
+        date_to = data.get('date_to')
+
+        if date_to and data['date_from'] >= date_to:
+            raise serializers.ValidationError(
+                'date_to must be greater than the date_from'
+            )
+        return data
+
+
+class TimeseriesFilterSerializer(serializers.Serializer):
+    """Период и группировка почасовой статистики"""
+    date_from = serializers.DateTimeField(required=False)
+    date_to = serializers.DateTimeField(required=False)
+    group_by = serializers.ChoiceField(choices=StatisticRollup.timeseries_groups, required=False)
+
+    def validate(self, data):
+        date_from = data.get('date_from')
+        date_to = data.get('date_to')
+
+        if date_from and date_to and date_from >= date_to:
+            raise serializers.ValidationError(
+                'date_to must be greater than the date_from'
+            )
+        return data
+
+
+class TimeseriesSerializer(serializers.Serializer):
+    hour = serializers.DateTimeField()
+    code = serializers.CharField(required=False)
+    tag = serializers.CharField(required=False)
+    sent = serializers.IntegerField()
+    failed = serializers.IntegerField()
+    avg_delay = serializers.FloatField()
+
+
+class BreakdownFilterSerializer(serializers.Serializer):
+    group_by = serializers.ChoiceField(choices=MailingBreakdownDB.groups, required=False)
+
+
+class BreakdownSerializer(serializers.Serializer):
+    code = serializers.CharField(required=False)
+    tag = serializers.CharField(required=False)
+    total = serializers.IntegerField()
+    sent = serializers.IntegerField()
+    failed = serializers.IntegerField()
+    pending = serializers.IntegerField()
@@ -1,23 +1,35 @@
 from django.utils import timezone
 from django.db.models.query import QuerySet
-from django.db.models import Sum, Case, When
-from django.db.models.functions import Coalesce
+from django.db import connection, transaction
+from django.db.models import F, Q, Count, Sum, Min, Max
+from django.db.models.functions import Coalesce, NullIf
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 from rest_framework import status
 from config import celery_app
 
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from itertools import islice
 import logging
-import requests
+import threading
 from requests.exceptions import Timeout, ConnectionError, HTTPError
 from uuid import UUID
-from typing import Tuple, Dict
+from typing import Any, Tuple, Dict, Iterable, Iterator, Set, List, NamedTuple
+from weakref import WeakSet
 import datetime
+import random
+import time
 import csv
+import gzip
+import io
+from pathlib import Path
 
-from .models import Mailing, Message
-from app_user.models import Client
+from .models import Mailing, MailingBreakdown, MailingStats, MailingStatsHourly, Message, StatsWatermark
+from .limiters import rate_limiter, circuit_breaker
+from .transport import transport
+from . import metrics
+from app_user.models import Client, OperatorCode, Tag
+from app_user.services import OperatorCodeDB
 
 logger = logging.getLogger(__name__)
 
@@ -39,7 +51,8 @@ class TaskMailing:
             soft_time_limit=self.get_time_life()
         )
 
-        logger.info(f'[mailing_id={self.__mailing.id}]: created task, task_id={task.id}')
+        logger.info(f'[mailing_id={self.__mailing.id}]: created task, task_id={task.id}',
+                    extra={'mailing_id': self.__mailing.id})
         return task.id
 
     def update_task(self) -> UUID:
@@ -55,7 +68,7 @@ class TaskMailing:
     def revoke_task_by_task_uuid(task_uuid: UUID, mailing_id: int) -> None:
         """Отменить/остановить задачу по параметрам"""
         celery_app.control.revoke(task_uuid, terminate=True)
-        logger.info(f'[mailing_id={mailing_id}]: revoke task, task_id={task_uuid}')
+        logger.info(f'[mailing_id={mailing_id}]: revoke task, task_id={task_uuid}', extra={'mailing_id': mailing_id})
 
     def get_time_life(self) -> int:
         """Получить время жизни задачи в секундах"""
@@ -81,7 +94,8 @@ class MailingDB:
         try:
             mailing = Mailing.objects.get(pk=self.__mailing_id)
         except ObjectDoesNotExist as ex:
-            logger.exception(f'[mailing_id={self.__mailing_id}]: {ex}', exc_info=None)
+            logger.exception(f'[mailing_id={self.__mailing_id}]: {ex}', exc_info=None,
+                             extra={'mailing_id': self.__mailing_id})
             return None
         return mailing
 
@@ -92,7 +106,161 @@ class MailingDB:
         if statuses[status_name] > 1:
             self.__mailing.finish_date = timezone.now()
         self.__mailing.save()
-        logger.info(f'[mailing_id={self.__mailing_id}]: set status {status_name}')
+        logger.info(f'[mailing_id={self.__mailing_id}]: set status {status_name}',
+                    extra={'mailing_id': self.__mailing_id})
+
+    def set_status_if_started(self, status_name: str) -> bool:
+        """Изменить статус, если рассылка еще выполняется (для нескольких воркеров)"""
+        statuses = dict((key, value) for (value, key) in self.__mailing.STATUS_CHOICES)
+        updated = Mailing.objects.filter(pk=self.__mailing_id, status=statuses['STARTED']). \
+            update(status=statuses[status_name], finish_date=timezone.now())
+        if updated:
+            logger.info(f'[mailing_id={self.__mailing_id}]: set status {status_name}',
+                        extra={'mailing_id': self.__mailing_id})
+        return bool(updated)
+
+    def is_started(self) -> bool:
+        """Рассылка выполняется (не остановлена и не удалена)"""
+        return Mailing.objects.filter(pk=self.__mailing_id, status=1).exists()
+
+    def has_status(self, status_name: str) -> bool:
+        """Статус рассылки в БД (мог измениться другим воркером)"""
+        statuses = dict((key, value) for (value, key) in Mailing.STATUS_CHOICES)
+        return Mailing.objects.filter(pk=self.__mailing_id, status=statuses[status_name]).exists()
+
+
+class MailingStatsDB:
+    """Счетчики сообщений рассылки (таблица mailingstats)"""
+
+    def __init__(self, mailing_id: int):
+        self.__mailing_id = mailing_id
+
+    def add(self, pending: int = 0, sent: int = 0, failed: int = 0) -> None:
+        """Атомарно изменить счетчики (INSERT ... ON CONFLICT DO UPDATE)"""
+        qn = connection.ops.quote_name
+        table = qn(MailingStats._meta.db_table)
+        columns = [qn(MailingStats._meta.get_field(name).column)
+                   for name in ('mailing', 'pending', 'sent', 'failed', 'last_update')]
+        updates = ', '.join(f'{column} = {table}.{column} + EXCLUDED.{column}' for column in columns[1:4])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} ({", ".join(columns)}) VALUES (%s, %s, %s, %s, %s) '
+                f'ON CONFLICT ({columns[0]}) DO UPDATE SET {updates}, '
+                f'{columns[4]} = EXCLUDED.{columns[4]}',
+                (self.__mailing_id, pending, sent, failed, timezone.now())
+            )
+
+    @staticmethod
+    def rebuild(mailing_ids: Iterable[int] = None) -> int:
+        """Пересчитать счетчики по таблице сообщений"""
+        queryset = Mailing.objects.all()
+        if mailing_ids is not None:
+            queryset = queryset.filter(id__in=mailing_ids)
+        rows = queryset.order_by().values('id').annotate(
+            pending=Count('message', filter=Q(message__status__isnull=True)),
+            sent=Count('message', filter=Q(message__status=1)),
+            failed=Count('message', filter=Q(message__status=0)),
+        )
+        now = timezone.now()
+        stats = [MailingStats(mailing_id=row['id'], pending=row['pending'], sent=row['sent'],
+                              failed=row['failed'], last_update=now) for row in rows.iterator()]
+        # unique_fields по имени столбца: Django 4.1 подставляет их в ON CONFLICT как есть
+        MailingStats.objects.bulk_create(stats, batch_size=1000, update_conflicts=True,
+                                         unique_fields=['mailing_id'],
+                                         update_fields=['pending', 'sent', 'failed', 'last_update'])
+        return len(stats)
+
+
+class PendingMessage(NamedTuple):
+    """Поля сообщения, необходимые для отправки"""
+    id: int
+    client_id: int
+    phone: str
+    attempts: int
+
+
+class MessageStatusBuffer:
+    """Буфер статусов сообщений, записывается в БД пакетами"""
+    fields = ('status', 'send_date', 'attempts', 'next_attempt_at')
+    _active = WeakSet()
+
+    def __init__(self, mailing: Mailing, size: int = None, interval: int = None):
+        self.__mailing = mailing
+        self.__size = size or settings.MESSAGE_STATUS_BUFFER_SIZE
+        self.__interval = (interval or settings.MESSAGE_STATUS_FLUSH_INTERVAL) / 1000
+        self.__messages: List[Message] = []
+        self.__flushed_at = time.monotonic()
+        self._active.add(self)
+
+    def __len__(self) -> int:
+        return len(self.__messages)
+
+    def add(self, message_id: int, status: int | None, send_date: datetime,
+            attempts: int = 1, next_attempt_at: datetime = None) -> None:
+        """Добавить статус, при заполнении буфера или по таймауту записать в БД"""
+        self.__messages.append(Message(id=message_id, status=status, send_date=send_date,
+                                       attempts=attempts, next_attempt_at=next_attempt_at))
+        if len(self.__messages) >= self.__size or \
+                time.monotonic() - self.__flushed_at >= self.__interval:
+            self.flush()
+
+    def flush(self) -> int:
+        """Записать накопленные статусы одним пакетом"""
+        messages, self.__messages = self.__messages, []
+        self.__flushed_at = time.monotonic()
+        if not messages:
+            return 0
+
+        try:
+            with metrics.status_flush_seconds.time(), transaction.atomic():
+                statuses = self._update(messages)
+                sent, failed = statuses.count(1), statuses.count(0)
+                if sent or failed:
+                    MailingStatsDB(self.__mailing.id).add(pending=-(sent + failed), sent=sent, failed=failed)
+        except BaseException:
+            self.__messages = messages + self.__messages
+            raise
+        logger.info(f'[mailing_id={self.__mailing.id}]: save status send, count={len(messages)}',
+                    extra={'mailing_id': self.__mailing.id})
+        return len(messages)
+
+    def _update(self, messages: List[Message]) -> List[int | None]:
+        """UPDATE ... FROM (VALUES ...) только для еще пустых сообщений, возвращает новые статусы.
+        Аренда снимается: отложенное сообщение захватывается снова после задержки повтора,
+        а не после MESSAGE_LEASE_TIMEOUT. processed_at - время записи (для rollup статистики)"""
+        qn = connection.ops.quote_name
+        opts = Message._meta
+        columns = [qn(opts.get_field(name).column) for name in self.fields]
+        casts = ('integer', 'timestamp with time zone', 'integer', 'timestamp with time zone')
+        assignments = ', '.join(f'{column} = v.{column}' for column in columns)
+        assignments += f', {qn(opts.get_field("lease_until").column)} = NULL, ' \
+                       f'{qn(opts.get_field("processed_at").column)} = %s'
+        row_sql = '(%s, ' + ', '.join(f'%s::{cast}' for cast in casts) + ')'
+        statuses = []
+
+        with connection.cursor() as cursor:
+            for start in range(0, len(messages), self.__size):
+                batch = messages[start:start + self.__size]
+                params = [timezone.now()]
+                params.extend(value for message in batch
+                              for value in (message.id, message.status, message.send_date,
+                                            message.attempts, message.next_attempt_at))
+                cursor.execute(
+                    f'UPDATE {qn(opts.db_table)} AS m SET {assignments} '
+                    f'FROM (VALUES {", ".join([row_sql] * len(batch))}) '
+                    f'AS v (id, {", ".join(columns)}) '
+                    f'WHERE m.id = v.id AND m.{qn(opts.get_field("status").column)} IS NULL '
+                    f'RETURNING m.{qn(opts.get_field("status").column)}',
+                    params
+                )
+                statuses.extend(row[0] for row in cursor.fetchall())
+        return statuses
+
+    @classmethod
+    def flush_all(cls) -> None:
+        """Записать статусы всех буферов процесса (при остановке воркера)"""
+        for buffer in list(cls._active):
+            buffer.flush()
 
 
 class TaskMailingDB:
@@ -100,50 +268,164 @@ class TaskMailingDB:
 
     def __init__(self, mailing: Mailing):
         self.__mailing = mailing
+        self.__status_buffer = MessageStatusBuffer(mailing)
+        self.__claimed_ids: List[int] = []
 
     def _get_queryset_clients(self) -> QuerySet:
         """Получить клиентов по критериям"""
+        # id кодов и тэгов константами: условие целиком ложится на client_code_tag_idx
         queryset = Client.objects.all()
         if self.__mailing.code:
-            queryset = queryset.filter(code__in=self.__mailing.code.all())
+            queryset = queryset.filter(code__in=list(self.__mailing.code.values_list('id', flat=True)))
         if self.__mailing.tag:
-            queryset = queryset.filter(tag__in=self.__mailing.tag.all())
+            queryset = queryset.filter(tag__in=list(self.__mailing.tag.values_list('id', flat=True)))
         return queryset
 
-    def create_messages(self) -> None:
-        """Создание пустых сообщений"""
-        client = self._get_queryset_clients()
-        if client.exists():
-            batch_size = 500
-            message_objs = (Message(mailing=self.__mailing, client=client)
-                            for client in client.iterator())
-            while True:
-                batch = list(islice(message_objs, batch_size))
-                if not batch:
-                    break
-                Message.objects.bulk_create(batch, batch_size)
-            logger.info(f'[mailing_id={self.__mailing.id}]: create message for clients')
+    @metrics.create_messages_seconds.time()
+    def create_messages(self) -> int:
+        """Создание пустых сообщений запросом INSERT ... SELECT частями по id клиентов (keyset).
+        Каждая часть - отдельная транзакция вместе со счетчиком pending: блокировки и WAL
+        не копятся на всю рассылку, после сбоя создание продолжается с последнего клиента"""
+        clients = self._get_queryset_clients().order_by('id')
+        qn = connection.ops.quote_name
+        opts = Message._meta
+        insert_sql = 'INSERT INTO {table} ({send_date}, {attempts}, {mailing}, {client}) ' \
+                     'SELECT %s, 0, %s, clients.id FROM ({select}) AS clients'
+        chunk_size = settings.MESSAGE_CREATE_CHUNK_SIZE
+        send_date = timezone.now()
+        last_id = Message.objects.filter(mailing=self.__mailing).aggregate(last_id=Max('client_id'))['last_id'] or 0
+        if not clients.filter(id__gt=last_id).exists():
+            return 0
+        created = 0
+
+        while True:
+            # Граница части - id клиента на позиции chunk_size после последнего обработанного
+            chunk = clients.filter(id__gt=last_id)
+            bound = list(chunk.values_list('id', flat=True)[chunk_size - 1:chunk_size])
+            bound_id = bound[0] if bound else None
+            if bound_id is not None:
+                chunk = chunk.filter(id__lte=bound_id)
+            select_sql, params = chunk.order_by().values('id').query.sql_with_params()
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    insert_sql.format(table=qn(opts.db_table),
+                                      send_date=qn(opts.get_field('send_date').column),
+                                      attempts=qn(opts.get_field('attempts').column),
+                                      mailing=qn(opts.get_field('mailing').column),
+                                      client=qn(opts.get_field('client').column),
+                                      select=select_sql),
+                    (send_date, self.__mailing.id, *params)
+                )
+                if cursor.rowcount:
+                    MailingStatsDB(self.__mailing.id).add(pending=cursor.rowcount)
+                created += cursor.rowcount
+            if bound_id is None:
+                break
+            last_id = bound_id
+
+        logger.info(f'[mailing_id={self.__mailing.id}]: create message for clients, count={created}',
+                    extra={'mailing_id': self.__mailing.id})
+        return created
+
+    def set_sent_status_message(self, message: PendingMessage, send_date: datetime) -> None:
+        """Обновить статус на отправленный (запись в БД через буфер)"""
+        self.__status_buffer.add(message.id, 1, send_date, message.attempts + 1)
+        metrics.messages_total.labels(self.__mailing.id, OperatorCodeDB.get_code(message.phone), 'sent').inc()
+
+    def set_failed_attempt_message(self, message: PendingMessage, send_date: datetime) -> bool:
+        """Учесть неудачную попытку: отложить повтор или перевести в не отправленные (True)"""
+        attempts = message.attempts + 1
+        code = OperatorCodeDB.get_code(message.phone)
+        if attempts >= settings.MESSAGE_MAX_ATTEMPTS:
+            self.__status_buffer.add(message.id, 0, send_date, attempts)
+            metrics.messages_total.labels(self.__mailing.id, code, 'failed').inc()
+            logger.warning(f'{MsgAPI.log_prefix}: save status not send, attempts=%s',
+                           self.__mailing.id, message.id, message.client_id, attempts,
+                           extra={'mailing_id': self.__mailing.id, 'message_id': message.id,
+                                  'client_id': message.client_id})
+            return True
+        next_attempt_at = send_date + timezone.timedelta(seconds=self.get_retry_delay(attempts))
+        self.__status_buffer.add(message.id, None, send_date, attempts, next_attempt_at)
+        metrics.message_retries_total.labels(self.__mailing.id, code).inc()
+        return False
+
+    @staticmethod
+    def get_retry_delay(attempts: int) -> float:
+        """Экспоненциальная задержка повтора с джиттером, сек"""
+        delay = min(settings.MESSAGE_RETRY_BACKOFF_MAX,
+                    settings.MESSAGE_RETRY_BACKOFF * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
 
-    def set_sent_status_message(self, message: Message, send_date: datetime) -> None:
-        """Обновить статус на отправленный"""
-        message.status = 1
-        message.send_date = send_date
-        message.save()
-        logger.info(f'[mailing_id={self.__mailing.id}]-[message_id={message.id}]-'
-                    f'[client_id={message.client_id}]: save status send')
+    def flush_status_messages(self) -> None:
+        """Записать в БД накопленные статусы"""
+        self.__status_buffer.flush()
 
     def set_not_sent_status_message(self) -> None:
-        """Обновить статус на не отправленный"""
-        Message.objects.filter(mailing=self.__mailing, status__isnull=True). \
-            update(status=0, send_date=timezone.now())
-        logger.info(f'[mailing_id={self.__mailing.id}]: save status not send')
+        """Обновить статус на не отправленный для сообщений без действующей аренды и захваченных
+        этой задачей. Сообщения, арендованные другими частями рассылки, они переводят сами"""
+        self.flush_status_messages()
+        now = timezone.now()
+        with transaction.atomic():
+            failed = self.get_queryset_messages(). \
+                filter(Q(lease_until__isnull=True) | Q(lease_until__lt=now) | Q(id__in=self.__claimed_ids)). \
+                update(status=0, send_date=now, processed_at=now)
+            MailingStatsDB(self.__mailing.id).add(pending=-failed, failed=failed)
+        # Код оператора не известен без чтения сообщений
+        metrics.messages_total.labels(self.__mailing.id, '', 'failed').inc(failed)
+        logger.info(f'[mailing_id={self.__mailing.id}]: save status not send', extra={'mailing_id': self.__mailing.id})
 
     def get_queryset_messages(self) -> QuerySet:
         """Получить пустые сообщения для рассылки"""
-        queryset = Message.objects.select_related('client'). \
-            filter(mailing=self.__mailing, status__isnull=True). \
-            defer('client__code', 'client__tag', 'client__time_zone')
-        return queryset
+        return Message.objects.filter(mailing=self.__mailing, status__isnull=True)
+
+    def get_queryset_due_messages(self) -> QuerySet:
+        """Получить пустые сообщения, время попытки отправки которых наступило"""
+        return self.get_queryset_messages(). \
+            filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now()))
+
+    def get_next_attempt_date(self) -> datetime.datetime | None:
+        """Время ближайшей попытки отправки, None - пустых сообщений нет"""
+        messages = self.get_queryset_messages()
+        if messages.filter(next_attempt_at__isnull=True).exists():
+            return timezone.now()
+        return messages.aggregate(next_attempt_at=Min('next_attempt_at'))['next_attempt_at']
+
+    def iter_messages(self, window: int = None) -> Iterator[PendingMessage]:
+        """Обход сообщений к отправке окнами по id (keyset), без кеширования queryset"""
+        window = window or settings.MESSAGE_STREAM_WINDOW
+        queryset = self.get_queryset_due_messages().order_by('id'). \
+            values_list('id', 'client_id', 'client__phone', 'attempts')
+        last_id = 0
+
+        while True:
+            rows = list(queryset.filter(id__gt=last_id)[:window])
+            for row in rows:
+                yield PendingMessage(*row)
+            if len(rows) < window:
+                break
+            last_id = rows[-1][0]
+
+    def claim_messages(self, size: int = None) -> List[PendingMessage]:
+        """Захватить пакет пустых сообщений (SELECT ... FOR UPDATE SKIP LOCKED и аренда)"""
+        size = size or settings.MESSAGE_CLAIM_SIZE
+        now = timezone.now()
+        lease_until = now + timezone.timedelta(seconds=settings.MESSAGE_LEASE_TIMEOUT)
+
+        with transaction.atomic():
+            message_ids = list(
+                self.get_queryset_due_messages().
+                filter(Q(lease_until__isnull=True) | Q(lease_until__lt=now)).
+                order_by('id').select_for_update(skip_locked=True).
+                values_list('id', flat=True)[:size]
+            )
+            self.__claimed_ids = message_ids
+            if not message_ids:
+                return []
+            Message.objects.filter(id__in=message_ids).update(lease_until=lease_until)
+
+        rows = Message.objects.filter(id__in=message_ids).order_by('id'). \
+            values_list('id', 'client_id', 'client__phone', 'attempts')
+        return [PendingMessage(*row) for row in rows]
 
 
 class MsgAPI:
@@ -156,72 +438,400 @@ class MsgAPI:
     }
     timeout = settings.PROBE_SERVER_TIMEOUT
     except_names = ('Timeout', 'HTTPError', 'ConnectionError')
+    # Аргументы подставляются при записи (ленивое форматирование), записи
+    # по отдельным сообщениям проходят выборку MessageSamplingFilter
+    log_prefix = '[mailing_id=%s]-[message_id=%s]-[client_id=%s]'
 
     def __init__(self, mailing: Mailing):
         self.__mailing = mailing
 
-    def post(self, message: Message) -> Tuple[bool, str | Dict]:
-        phone = message.client.phone
-        log_msg = f'[mailing_id={self.__mailing.id}]-[message_id={message.id}]-' \
-                  f'[client_id={message.client_id}]'
+    def post(self, message: PendingMessage) -> Tuple[bool, str | Dict]:
+        phone = message.phone
+        log_args = (self.__mailing.id, message.id, message.client_id)
+        log_extra = dict(zip(('mailing_id', 'message_id', 'client_id'), log_args))
         data = {'id': message.id, 'phone': phone, 'text': self.__mailing.text}
 
         try:
-            response = requests.post(f'{self.url}{message.id}', headers=self.headers,
-                                     json=data, timeout=self.timeout)
+            rate_limiter.acquire(OperatorCodeDB.get_code(phone))
+            start = time.perf_counter()
+            with metrics.probe_requests_in_flight.track_inprogress():
+                response = transport.post(f'{self.url}{message.id}', headers=self.headers,
+                                          json=data, timeout=self.timeout)
             response.raise_for_status()
         except Timeout as time_ex:
             except_msg = time_ex
             except_name = self.except_names[0]
+            circuit_breaker.record(success=False)
         except HTTPError as http_ex:
             except_msg = http_ex
             except_name = self.except_names[1]
+            status_code = getattr(http_ex.response, 'status_code', None) or 0
+            circuit_breaker.record(success=status_code < status.HTTP_500_INTERNAL_SERVER_ERROR)
         except ConnectionError as conn_ex:
             except_msg = conn_ex
             except_name = self.except_names[2]
+            circuit_breaker.record(success=False)
         else:
+            metrics.observe_probe_request('ok' if response.status_code == status.HTTP_200_OK else 'not_sent', start)
+            circuit_breaker.record(success=True)
+            # Отправленные сообщения учитываются в итогах рассылки, по сообщению - только DEBUG
             if response.status_code == status.HTTP_200_OK:
-                logger.info(f'{log_msg}: send on phone {phone}')
+                logger.debug(f'{self.log_prefix}: send on phone %s', *log_args, phone, extra=log_extra)
                 return True, response.json()
-            logger.info(f"{log_msg}: didn't send on phone {phone}")
+            logger.warning(f"{self.log_prefix}: didn't send on phone %s", *log_args, phone, extra=log_extra)
             return False, "Not send"
 
-        logger.exception(f'{log_msg}: {except_name} - {except_msg}', exc_info=None)
+        metrics.observe_probe_request(except_name, start)
+        logger.warning(f'{self.log_prefix}: %s - %s', *log_args, except_name, except_msg, extra=log_extra)
         return False, except_name
 
 
+class MailingDispatcher:
+    """Параллельная отправка сообщений с ограничением числа запросов в полёте"""
+
+    def __init__(self, msg_api: MsgAPI, concurrency: int = None):
+        self.__msg_api = msg_api
+        self.__concurrency = max(1, concurrency or settings.MAILING_CONCURRENCY)
+        self.__executor = None
+        self.__stopped = False
+        self.__closed = threading.Event()
+        self.__in_flight: Set[Future] = set()
+        self.__drained: List[Tuple[PendingMessage, datetime, bool, str | Dict]] = []
+
+    def __enter__(self) -> 'MailingDispatcher':
+        self.__executor = ThreadPoolExecutor(max_workers=self.__concurrency,
+                                             thread_name_prefix='mailing-dispatch')
+        self.__closed.clear()
+        self.__in_flight = set()
+        self.__drained = []
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        # При выходе по исключению (остановка по времени) запросы в полёте дожидаются
+        # не дольше таймаута запроса, их результаты забираются через drain.
+        # Не завершившиеся запросы не учитываются: сообщение остается пустым и может
+        # быть отправлено повторно (at-least-once) или переведено в не отправленные
+        self.__closed.set()
+        done, _ = wait(self.__in_flight, timeout=self.__msg_api.timeout)
+        self.__drained.extend(future.result() for future in done
+                              if not future.cancelled() and future.exception() is None)
+        self.__in_flight = set()
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+        self.__executor = None
+        metrics.observe_connections(transport.pop_stats())
+
+    def stop(self) -> None:
+        """Прекратить отправку новых сообщений, дождаться запросов в полёте"""
+        self.__stopped = True
+
+    def drain(self) -> List[Tuple[PendingMessage, datetime, bool, str | Dict]]:
+        """Результаты запросов, завершившихся при выходе из dispatch по исключению"""
+        drained, self.__drained = self.__drained, []
+        return drained
+
+    def dispatch(self, messages: Iterable[PendingMessage]) -> \
+            Iterator[Tuple[PendingMessage, datetime, bool, str | Dict]]:
+        """Отправить сообщения, результаты отдаются по мере готовности"""
+        messages = iter(messages)
+
+        while True:
+            if not self.__stopped:
+                for message in islice(messages, self.__concurrency - len(self.__in_flight)):
+                    self.__in_flight.add(self.__executor.submit(self._send, message))
+            if not self.__in_flight:
+                break
+            done, _ = wait(self.__in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Не отданные результаты остаются в полёте до drain
+                self.__in_flight.discard(future)
+                yield future.result()
+
+    def _send(self, message: PendingMessage) -> Tuple[PendingMessage, datetime, bool, str | Dict]:
+        # Пока circuit breaker открыт, запросы к API не выполняются
+        wait_time = circuit_breaker.acquire()
+        while wait_time:
+            if self.__closed.wait(wait_time):
+                return message, timezone.now(), False, self.__msg_api.except_names[2]
+            wait_time = circuit_breaker.acquire()
+
+        send_date = timezone.now()
+        status, data = self.__msg_api.post(message)
+        return message, send_date, status, data
+
+
 class Statistic:
     """Статистика по рассылкам"""
+    list_fields = ('id', 'status', 'send_success', 'send_failed', 'send_pending',
+                   'text', 'start_date', 'finish_date')
+    message_fields = ('id', 'send_date', 'status', 'client_id')
 
     @staticmethod
     def get_queryset() -> QuerySet:
-        queryset = Mailing.objects.prefetch_related('message')
+        queryset = Mailing.objects.prefetch_related('tag', 'code')
         queryset = queryset.annotate(
-            send_success=Coalesce(Sum('message__status'), 0),
-            send_failed=Sum(Case(When(message__status=0, then=1), default=0))
+            send_success=Coalesce(F('stats__sent'), 0),
+            send_failed=Coalesce(F('stats__failed'), 0),
+            send_pending=Coalesce(F('stats__pending'), 0)
         )
         queryset = queryset.order_by('-id')
         return queryset
 
     @classmethod
     def get_queryset_list(cls) -> QuerySet:
-        return cls.get_queryset().values('id', 'status', 'send_success', 'send_failed',
-                                         'text', 'start_date', 'finish_date')
+        return cls.get_queryset().values(*cls.list_fields)
 
     @classmethod
     def get_queryset_to_date(cls, date: datetime) -> QuerySet:
         """Активные и завершенные рассылки с выбранной по текущую дату"""
         return cls.get_queryset_list().filter(finish_date__gte=date)
 
+    @classmethod
+    def get_queryset_period(cls, date_from: datetime.datetime, date_to: datetime.datetime = None) -> QuerySet:
+        """Рассылки, активные в периоде [date_from, date_to)"""
+        queryset = cls.get_queryset_to_date(date_from)
+        if date_to is not None:
+            queryset = queryset.filter(start_date__lt=date_to)
+        return queryset
+
+    @staticmethod
+    def get_queryset_messages(mailing_id: int, status: str = None, send_date_after: datetime.datetime = None,
+                              send_date_before: datetime.datetime = None) -> QuerySet:
+        """Сообщения рассылки с фильтрами по статусу и дате отправки"""
+        queryset = Message.objects.filter(mailing_id=mailing_id)
+        if status == 'pending':
+            queryset = queryset.filter(status__isnull=True)
+        elif status is not None:
+            queryset = queryset.filter(status=int(status))
+        if send_date_after is not None:
+            queryset = queryset.filter(send_date__gte=send_date_after)
+        if send_date_before is not None:
+            queryset = queryset.filter(send_date__lt=send_date_before)
+        return queryset.values(*Statistic.message_fields)
+
+    @staticmethod
+    def iter_messages(queryset: QuerySet, window: int = None) -> Iterator[dict]:
+        """Сообщения окнами по id (keyset), без серверного курсора на все время ответа"""
+        window = window or settings.MESSAGE_STREAM_WINDOW
+        last_id = None
+        while True:
+            page = queryset.order_by('-id')
+            if last_id is not None:
+                page = page.filter(id__lt=last_id)
+            rows = list(page[:window])
+            yield from rows
+            if len(rows) < window:
+                break
+            last_id = rows[-1]['id']
+
+
+class StatisticRollup:
+    """Инкрементальная почасовая статистика (MailingStatsHourly) от отметки StatsWatermark"""
+    watermark_name = 'stats_hourly'
+    daily_fields = ('mailing_id', 'mailing__text', 'mailing__status', 'mailing__start_date',
+                    'mailing__finish_date', 'sent', 'failed', 'avg_delay')
+    timeseries_groups = ('code', 'tag')
+
+    def __init__(self, lag: int = None, window: int = None):
+        self.__lag = timezone.timedelta(seconds=settings.STATISTICS_ROLLUP_LAG if lag is None else lag)
+        self.__window = timezone.timedelta(hours=window or settings.STATISTICS_ROLLUP_WINDOW)
+
+    def run(self) -> int:
+        """Учесть сообщения, статус которых записан после отметки (processed_at), окнами не больше window.
+        Час статистики определяется по send_date: запоздавшая запись увеличивает счетчики прошлого часа"""
+        date_to = timezone.now() - self.__lag
+        rows = 0
+        while True:
+            with transaction.atomic():
+                watermark = self._lock_watermark()
+                if watermark is None or watermark.value >= date_to:
+                    break
+                window_to = min(watermark.value + self.__window, date_to)
+                rows += self._rollup(watermark.value, window_to)
+                watermark.value = window_to
+                watermark.save(update_fields=['value'])
+        logger.info(f'statistics rollup, rows={rows}, date_to={date_to}')
+        return rows
+
+    def _lock_watermark(self) -> StatsWatermark | None:
+        """Отметка под блокировкой: параллельный запуск ждет и не учитывает окно повторно"""
+        watermark = StatsWatermark.objects.select_for_update().filter(name=self.watermark_name).first()
+        if watermark is not None:
+            return watermark
+
+        first_date = Message.objects.filter(processed_at__isnull=False).aggregate(date=Min('processed_at'))['date']
+        if first_date is None:
+            return None
+        StatsWatermark.objects.bulk_create(
+            [StatsWatermark(name=self.watermark_name, value=first_date.replace(minute=0, second=0, microsecond=0))],
+            ignore_conflicts=True
+        )
+        return StatsWatermark.objects.select_for_update().get(name=self.watermark_name)
+
+    @staticmethod
+    def _rollup(date_from: datetime.datetime, date_to: datetime.datetime) -> int:
+        """INSERT ... SELECT ... ON CONFLICT DO UPDATE: счетчики часа увеличиваются на дельту окна,
+        возвращает количество измененных строк rollup"""
+        qn = connection.ops.quote_name
+        table = qn(MailingStatsHourly._meta.db_table)
+        counters = ('sent', 'failed', 'delay_sum')
+        updates = ', '.join(f'{qn(name)} = {table}.{qn(name)} + EXCLUDED.{qn(name)}' for name in counters)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (mailing_id, hour, code, tag, sent, failed, delay_sum) '
+                f'SELECT m.mailing_id, date_trunc(\'hour\', m.send_date), COALESCE(oc.code, \'\'), '
+                f'COALESCE(t.name, \'\'), COUNT(*) FILTER (WHERE m.status = 1), '
+                f'COUNT(*) FILTER (WHERE m.status = 0), '
+                f'COALESCE(SUM(EXTRACT(EPOCH FROM m.send_date - ml.start_date)) FILTER (WHERE m.status = 1), 0) '
+                f'FROM {qn(Message._meta.db_table)} AS m '
+                f'JOIN {qn(Mailing._meta.db_table)} AS ml ON ml.id = m.mailing_id '
+                f'LEFT JOIN {qn(Client._meta.db_table)} AS c ON c.id = m.client_id '
+                f'LEFT JOIN {qn(OperatorCode._meta.db_table)} AS oc ON oc.id = c.code_id '
+                f'LEFT JOIN {qn(Tag._meta.db_table)} AS t ON t.id = c.tag_id '
+                f'WHERE m.status IS NOT NULL AND m.processed_at >= %s AND m.processed_at < %s '
+                f'GROUP BY 1, 2, 3, 4 '
+                f'ON CONFLICT (mailing_id, hour, code, tag) DO UPDATE SET {updates}',
+                (date_from, date_to)
+            )
+            return cursor.rowcount
+
+    @classmethod
+    def get_timeseries(cls, date_from: datetime.datetime = None, date_to: datetime.datetime = None,
+                       mailing_id: int = None, group_by: str = None) -> QuerySet:
+        """Отправлено/не отправлено и средняя задержка от начала рассылки по часам"""
+        queryset = MailingStatsHourly.objects.all()
+        if mailing_id is not None:
+            queryset = queryset.filter(mailing_id=mailing_id)
+        if date_from is not None:
+            queryset = queryset.filter(hour__gte=date_from)
+        if date_to is not None:
+            queryset = queryset.filter(hour__lt=date_to)
+
+        fields = ('hour', group_by) if group_by else ('hour',)
+        return queryset.values(*fields).annotate(**cls._get_aggregates()).order_by(*fields)
+
+    @staticmethod
+    def get_queryset_daily(date: datetime.datetime) -> QuerySet:
+        """Итоги рассылок за сутки, начиная с date"""
+        queryset = MailingStatsHourly.objects.filter(hour__gte=date, hour__lt=date + timezone.timedelta(days=1))
+        return queryset.values(
+            'mailing_id', 'mailing__text', 'mailing__status', 'mailing__start_date', 'mailing__finish_date'
+        ).annotate(**StatisticRollup._get_aggregates()).order_by('-mailing_id')
+
+    @staticmethod
+    def _get_aggregates() -> Dict[str, Any]:
+        # avg_delay первым: дальше имя sent занято агрегатом
+        return {
+            'avg_delay': Coalesce(Sum('delay_sum') / NullIf(Sum('sent'), 0), 0.0),
+            'sent': Sum('sent'),
+            'failed': Sum('failed'),
+        }
+
+
+class MailingBreakdownDB:
+    """Materialized view с разбивкой сообщений рассылок по коду оператора и тэгу"""
+    watermark_name = 'breakdown'
+    groups = ('code', 'tag')
+    # Блокировка от параллельного обновления из нескольких воркеров beat
+    lock_id = 7243001
+
+    @classmethod
+    def create_view(cls) -> None:
+        """Создать view без данных (заполняется при первом refresh).
+        При изменении запроса view нужно удалить вручную (DROP MATERIALIZED VIEW),
+        следующий refresh создаст ее заново"""
+        qn = connection.ops.quote_name
+        view = qn(MailingBreakdown._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE MATERIALIZED VIEW IF NOT EXISTS {view} AS '
+                f'SELECT m.mailing_id || \':\' || COALESCE(oc.code, \'\') || \':\' || COALESCE(t.name, \'\') AS key, '
+                f'm.mailing_id, COALESCE(oc.code, \'\') AS code, COALESCE(t.name, \'\') AS tag, '
+                f'COUNT(*)::integer AS total, '
+                f'(COUNT(*) FILTER (WHERE m.status = 1))::integer AS sent, '
+                f'(COUNT(*) FILTER (WHERE m.status = 0))::integer AS failed, '
+                f'(COUNT(*) FILTER (WHERE m.status IS NULL))::integer AS pending '
+                f'FROM {qn(Message._meta.db_table)} AS m '
+                f'LEFT JOIN {qn(Client._meta.db_table)} AS c ON c.id = m.client_id '
+                f'LEFT JOIN {qn(OperatorCode._meta.db_table)} AS oc ON oc.id = c.code_id '
+                f'LEFT JOIN {qn(Tag._meta.db_table)} AS t ON t.id = c.tag_id '
+                f'GROUP BY m.mailing_id, oc.code, t.name '
+                f'WITH NO DATA'
+            )
+            # Уникальный индекс обязателен для REFRESH ... CONCURRENTLY
+            cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {qn("app_mailing_breakdown_key")} '
+                           f'ON {view} (mailing_id, code, tag)')
+
+    @classmethod
+    def refresh(cls) -> bool:
+        """Обновить view, не блокируя чтение; False, если обновление уже идет"""
+        qn = connection.ops.quote_name
+        view = qn(MailingBreakdown._meta.db_table)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', [cls.lock_id])
+            if not cursor.fetchone()[0]:
+                logger.info('breakdown refresh skipped, already running')
+                return False
+
+            cursor.execute('SELECT ispopulated FROM pg_matviews WHERE matviewname = %s',
+                           [MailingBreakdown._meta.db_table])
+            row = cursor.fetchone()
+            if row is None:
+                # View еще не создана (до post_migrate) или удалена вручную
+                logger.warning('breakdown view not found, create it')
+                cls.create_view()
+            populated = bool(row and row[0])
+            # Первое заполнение CONCURRENTLY не поддерживает
+            cursor.execute(f'REFRESH MATERIALIZED VIEW {"CONCURRENTLY " if populated else ""}{view}')
+            StatsWatermark.objects.update_or_create(name=cls.watermark_name, defaults={'value': timezone.now()})
+        logger.info('breakdown refreshed')
+        return True
 
-def generation_csv(data: QuerySet, date: str) -> str:
-    """Создается файл со статистикой"""
-    filename = f'statistics_{date}.csv'
+    @classmethod
+    def get_refreshed_at(cls) -> datetime.datetime | None:
+        watermark = StatsWatermark.objects.filter(name=cls.watermark_name).first()
+        return watermark.value if watermark else None
+
+    @classmethod
+    def get_queryset(cls, mailing_id: int, group_by: str = None) -> QuerySet:
+        """Разбивка рассылки, худшие по числу неотправленных первыми"""
+        queryset = MailingBreakdown.objects.filter(mailing_id=mailing_id)
+        fields = (group_by,) if group_by else cls.groups
+        return queryset.values(*fields).annotate(
+            total=Sum('total'),
+            sent=Sum('sent'),
+            failed=Sum('failed'),
+            pending=Sum('pending'),
+        ).order_by('-failed', *fields)
+
+
+def iter_csv_gzip(data: QuerySet, fieldnames: Iterable[str], chunk_size: int = None) -> Iterator[bytes]:
+    """CSV в gzip по частям: строки читаются серверным курсором, память не зависит от объема"""
+    chunk_size = chunk_size or settings.STATISTICS_EXPORT_CHUNK_SIZE
+    buffer = io.BytesIO()
+    text = io.TextIOWrapper(gzip.GzipFile(fileobj=buffer, mode='wb'), encoding='utf-8', newline='')
+    writer = csv.DictWriter(text, fieldnames=fieldnames)
+    writer.writeheader()
+
+    for i, row in enumerate(data.iterator(chunk_size=chunk_size), 1):
+        writer.writerow(row)
+        if i % chunk_size == 0:
+            text.flush()
+            chunk = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            if chunk:
+                yield chunk
+
+    text.close()
+    yield buffer.getvalue()
+
+
+def generation_csv(data: QuerySet, date: str, fieldnames: Iterable[str] = Statistic.list_fields) -> Path:
+    """Создается сжатый файл со статистикой"""
+    filename = f'statistics_{date}.csv.gz'
     file = settings.FOLDER_STATISTICS / filename
 
-    with open(file, 'w') as csvfile:
-        fieldnames = data[0].keys()
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(data)
+    with open(file, 'wb') as csvfile:
+        for chunk in iter_csv_gzip(data, fieldnames):
+            csvfile.write(chunk)
     return file
@@ -2,14 +2,26 @@ from django.utils import timezone
 from django.core.mail import EmailMessage
 from django.conf import settings
 from celery import shared_task
+from celery.signals import worker_init, worker_process_shutdown
 from celery.exceptions import SoftTimeLimitExceeded
+from collections import Counter
 import logging
+import time
+from typing import Iterable
+from . import metrics
+from .profiling import TaskProfiler
+from .limiters import rate_limiter, circuit_breaker
+from .models import Mailing
 from .services import (
     MailingDB,
+    MailingDispatcher,
+    MessageStatusBuffer,
     TaskMailingDB,
     TaskMailing,
     MsgAPI,
-    Statistic,
+    PendingMessage,
+    StatisticRollup,
+    MailingBreakdownDB,
     generation_csv
 )
 
@@ -17,75 +29,233 @@ logger = logging.getLogger(__name__)
 
 
 @shared_task(bind=True, max_retries=None, name='send_mailing')
+@metrics.task_duration_seconds.labels('send_mailing').time()
 def send_mailing(self, mailing_id: int) -> None:
     """Выполнение задачи по рассылке"""
     task_id = self.request.id
-    logger.info(f'[mailing_id={mailing_id}]: run task, task_id={task_id}')
+    logger.info(f'[mailing_id={mailing_id}]: run task, task_id={task_id}',
+                extra={'mailing_id': mailing_id, 'task_id': task_id})
 
     mailing_db = MailingDB(mailing_id=mailing_id)
 
     if mailing_db.mailing:
         mailing_db.set_status('STARTED')
         task_mailing_db = TaskMailingDB(mailing_db.mailing)
+        summary, started_at = Counter(), time.monotonic()
+        profiler = TaskProfiler(self.name, task_id, mailing_db.mailing)
+        profiler.start()
         try:
             if self.request.retries == 0:
                 task_mailing_db.create_messages()
 
+            if settings.MAILING_WORKERS > 1:
+                run_mailing_parts(mailing_db.mailing, settings.MAILING_WORKERS)
+                logger.info(f'[mailing_id={mailing_id}]: run {settings.MAILING_WORKERS} '
+                            f'parts of task, task_id={task_id}',
+                            extra={'mailing_id': mailing_id, 'task_id': task_id})
+                return
+
             while True:
-                messages = task_mailing_db.get_queryset_messages()
-                if not messages.exists():
+                next_attempt_at = task_mailing_db.get_next_attempt_date()
+                if next_attempt_at is None:
                     break
-                msg_api = MsgAPI(mailing_db.mailing)
-
-                for message in messages:
-                    send_date = timezone.now()
-                    status, data = msg_api.post(message)
-
-                    if status:
-                        task_mailing_db.set_sent_status_message(message, send_date)
-                    else:
-                        if data == msg_api.except_names[2]:
-                            task_mailing = TaskMailing(mailing_db.mailing)
-                            soft_time_limit = task_mailing.get_time_life()
-                            countdown = 300
-
-                            if soft_time_limit <= countdown:
-                                raise SoftTimeLimitExceeded
-
-                            logger.info(f'[mailing_id={mailing_id}]: retry task, task_id={task_id}')
-                            raise self.retry(countdown=countdown, expires=mailing_db.mailing.finish_date,
-                                             soft_time_limit=soft_time_limit)
+                delay = (next_attempt_at - timezone.now()).total_seconds()
+                if delay > 0:
+                    # Воркер не ждет отложенные повторы: задача перезапускается к ближайшей попытке
+                    retry_task(self, mailing_db.mailing, delay)
+                send_messages(self, mailing_db, task_mailing_db, task_mailing_db.iter_messages(), summary)
 
             mailing_db.set_status('SUCCESS')
-            logger.info(f'[mailing_id={mailing_id}]: success task, task_id={task_id}')
+            logger.info(f'[mailing_id={mailing_id}]: success task, task_id={task_id}',
+                        extra={'mailing_id': mailing_id, 'task_id': task_id})
         except SoftTimeLimitExceeded:
             task_mailing_db.set_not_sent_status_message()
             mailing_db.set_status('REVOKED BY TIME')
-            logger.info(f'[mailing_id={mailing_id}]: stop task by time limit, task_id={task_id}')
+            logger.info(f'[mailing_id={mailing_id}]: stop task by time limit, task_id={task_id}',
+                        extra={'mailing_id': mailing_id, 'task_id': task_id})
+        finally:
+            task_mailing_db.flush_status_messages()
+            log_summary(mailing_id, task_id, summary, started_at)
+            profiler.stop()
     else:
         TaskMailing.revoke_task_by_task_uuid(task_id, mailing_id)
         mailing_db.set_status('REVOKED')
-        logger.info(f'[mailing_id={mailing_id}]: stop task, task_id={task_id}')
+        logger.info(f'[mailing_id={mailing_id}]: stop task, task_id={task_id}',
+                    extra={'mailing_id': mailing_id, 'task_id': task_id})
+
+
+@shared_task(bind=True, max_retries=None, name='send_mailing_part')
+@metrics.task_duration_seconds.labels('send_mailing_part').time()
+def send_mailing_part(self, mailing_id: int) -> None:
+    """Выполнение части рассылки: сообщения захватываются пакетами совместно с другими воркерами"""
+    task_id = self.request.id
+    mailing_db = MailingDB(mailing_id=mailing_id)
+
+    if not (mailing_db.mailing and mailing_db.is_started()):
+        logger.info(f'[mailing_id={mailing_id}]: skip part of task, task_id={task_id}',
+                    extra={'mailing_id': mailing_id, 'task_id': task_id})
+        return
+
+    task_mailing_db = TaskMailingDB(mailing_db.mailing)
+    summary, started_at = Counter(), time.monotonic()
+    profiler = TaskProfiler(self.name, task_id, mailing_db.mailing)
+    profiler.start()
+    try:
+        while mailing_db.is_started():
+            messages = task_mailing_db.claim_messages()
+            if messages:
+                send_messages(self, mailing_db, task_mailing_db, messages, summary)
+            elif task_mailing_db.get_queryset_messages().exists():
+                # Оставшиеся сообщения захвачены другими воркерами: ждем их завершения
+                # или истечения аренды, если воркер упал
+                time.sleep(settings.MESSAGE_LEASE_POLL_INTERVAL)
+            else:
+                if mailing_db.set_status_if_started('SUCCESS'):
+                    logger.info(f'[mailing_id={mailing_id}]: success task, task_id={task_id}',
+                                extra={'mailing_id': mailing_id, 'task_id': task_id})
+                break
+        else:
+            if mailing_db.has_status('REVOKED BY TIME'):
+                # Рассылку остановила по времени другая часть: оставшиеся сообщения
+                # без аренды переводит в не отправленные часть, завершившаяся последней
+                task_mailing_db.set_not_sent_status_message()
+    except SoftTimeLimitExceeded:
+        task_mailing_db.set_not_sent_status_message()
+        mailing_db.set_status_if_started('REVOKED BY TIME')
+        logger.info(f'[mailing_id={mailing_id}]: stop part of task by time limit, task_id={task_id}',
+                    extra={'mailing_id': mailing_id, 'task_id': task_id})
+    finally:
+        task_mailing_db.flush_status_messages()
+        log_summary(mailing_id, task_id, summary, started_at)
+        profiler.stop()
+
+
+def run_mailing_parts(mailing: Mailing, workers: int) -> None:
+    """Запустить совместную отправку рассылки несколькими воркерами"""
+    soft_time_limit = TaskMailing(mailing).get_time_life()
+    for _ in range(workers):
+        send_mailing_part.apply_async(kwargs={'mailing_id': mailing.id},
+                                      expires=mailing.finish_date,
+                                      soft_time_limit=soft_time_limit)
+
+
+def send_messages(task, mailing_db: MailingDB, task_mailing_db: TaskMailingDB,
+                  messages: Iterable[PendingMessage], summary: Counter = None) -> None:
+    """Отправить сообщения, при недоступности API перезапустить задачу.
+    Результаты накапливаются в summary для итоговой записи по рассылке"""
+    msg_api = MsgAPI(mailing_db.mailing)
+    summary = Counter() if summary is None else summary
+    retry = False
+    rate_limit_wait = rate_limiter.wait_time
+    dispatcher = MailingDispatcher(msg_api)
+
+    def save_result(message: PendingMessage, send_date, status: bool, data) -> bool:
+        """Записать результат отправки, True - API недоступно"""
+        if status:
+            task_mailing_db.set_sent_status_message(message, send_date)
+            summary['sent'] += 1
+        elif data != msg_api.except_names[2]:
+            failed = task_mailing_db.set_failed_attempt_message(message, send_date)
+            summary['failed' if failed else 'postponed'] += 1
+        else:
+            summary['postponed'] += 1
+            return True
+        return False
+
+    try:
+        with dispatcher:
+            for result in dispatcher.dispatch(messages):
+                if save_result(*result) and not circuit_breaker.enabled:
+                    # Без circuit breaker задача перезапускается целиком,
+                    # иначе отправка приостанавливается до закрытия цепи
+                    dispatcher.stop()
+                    retry = True
+    finally:
+        # Ответы на запросы в полёте при остановке по времени учитываются до перевода
+        # оставшихся сообщений в не отправленные
+        for result in dispatcher.drain():
+            save_result(*result)
+        task_mailing_db.flush_status_messages()
+        summary['rate_limit_wait'] += rate_limiter.wait_time - rate_limit_wait
 
+    if retry:
+        retry_task(task, mailing_db.mailing, 300)
 
-@shared_task(name='send_statistics')
-def send_statistics() -> None:
+
+def retry_task(task, mailing: Mailing, countdown: float) -> None:
+    """Перезапустить задачу через countdown сек, если рассылка к этому времени не завершится"""
+    soft_time_limit = TaskMailing(mailing).get_time_life()
+    if soft_time_limit <= countdown:
+        raise SoftTimeLimitExceeded
+
+    logger.info(f'[mailing_id={mailing.id}]: retry task, countdown={countdown:.1f}s, task_id={task.request.id}',
+                extra={'mailing_id': mailing.id, 'task_id': task.request.id})
+    metrics.task_retries_total.labels(task.name).inc()
+    raise task.retry(countdown=countdown, expires=mailing.finish_date, soft_time_limit=soft_time_limit)
+
+
+def log_summary(mailing_id: int, task_id: str, summary: Counter, started_at: float) -> None:
+    """Итоги отправки задачей одной записью вместо записей по каждому сообщению"""
+    elapsed = time.monotonic() - started_at
+    processed = summary['sent'] + summary['failed']
+    rate = processed / elapsed if elapsed else 0.0
+    logger.info(f'[mailing_id={mailing_id}]: summary sent={summary["sent"]}, failed={summary["failed"]}, '
+                f'postponed={summary["postponed"]}, elapsed={elapsed:.1f}s, rate={rate:.1f}/s, '
+                f'rate limit wait={summary["rate_limit_wait"]:.3f}s, task_id={task_id}',
+                extra={'mailing_id': mailing_id, 'task_id': task_id, 'sent': summary['sent'],
+                       'failed': summary['failed'], 'postponed': summary['postponed'],
+                       'elapsed': round(elapsed, 3), 'rate': round(rate, 1),
+                       'rate_limit_wait': round(summary['rate_limit_wait'], 3)})
+
+
+@worker_process_shutdown.connect
+def flush_message_statuses(**kwargs) -> None:
+    """Не терять статусы отправленных сообщений при остановке воркера"""
+    MessageStatusBuffer.flush_all()
+    metrics.mark_process_dead()
+
+
+@worker_init.connect
+def start_metrics_server(**kwargs) -> None:
+    """Метрики воркера (всех процессов пула в multiprocess-режиме) по HTTP"""
+    metrics.start_worker_server()
+
+
+@shared_task(name='rollup_statistics')
+def rollup_statistics() -> None:
+    """Обновление почасовой статистики по новым обработанным сообщениям"""
+    StatisticRollup().run()
+
+
+@shared_task(name='refresh_breakdown')
+def refresh_breakdown() -> None:
+    """Обновление разбивки рассылок по кодам оператора и тэгам"""
+    MailingBreakdownDB.refresh()
+
+
+@shared_task(bind=True, name='send_statistics')
+@metrics.task_duration_seconds.labels('send_statistics').time()
+def send_statistics(self) -> None:
     """Отправка ежедневной статистики админу"""
-    current_date = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    yesterday = current_date - timezone.timedelta(days=1)
-    yesterday_str = yesterday.strftime('%d-%m-%Y')
-    data = Statistic.get_queryset_to_date(yesterday)
-
-    if data:
-        file = generation_csv(data, yesterday_str)
-        email = EmailMessage(
-            subject=f'Статистика за {yesterday_str}',
-            body='Статистика по рассылкам',
-            from_email=settings.EMAIL_HOST_USER,
-            to=[settings.EMAIL_HOST_ADMIN]
-        )
-        email.attach_file(file)
-        email.send()
-        logger.info(f'Статистика за {yesterday_str} отправлена')
-    else:
-        logger.info(f'Статистика за {yesterday_str} не обнаружена')
+    with TaskProfiler(self.name, self.request.id):
+        current_date = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        yesterday = current_date - timezone.timedelta(days=1)
+        yesterday_str = yesterday.strftime('%d-%m-%Y')
+        StatisticRollup().run()
+        data = StatisticRollup.get_queryset_daily(yesterday)
+
+        if data.exists():
+            file = generation_csv(data, yesterday_str, StatisticRollup.daily_fields)
+            email = EmailMessage(
+                subject=f'Статистика за {yesterday_str}',
+                body='Статистика по рассылкам',
+                from_email=settings.EMAIL_HOST_USER,
+                to=[settings.EMAIL_HOST_ADMIN]
+            )
+            email.attach_file(file, mimetype='application/gzip')
+            email.send()
+            metrics.statistics_reports_total.labels('sent').inc()
+            logger.info(f'Статистика за {yesterday_str} отправлена')
+        else:
+            metrics.statistics_reports_total.labels('empty').inc()
+            logger.info(f'Статистика за {yesterday_str} не обнаружена')
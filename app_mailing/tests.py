@@ -1,12 +1,45 @@
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.db.models import Sum
+from django.test import SimpleTestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
 from rest_framework import status
+from celery.exceptions import Retry, SoftTimeLimitExceeded
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import csv
+import datetime
+import gzip
+import io
+import json
+import logging
+import random
+import threading
+import tempfile
+import time
 import uuid
+from pathlib import Path
 from unittest import mock
+from prometheus_client import REGISTRY
+import redis
+import requests
 from requests.exceptions import HTTPError, ConnectionError, Timeout
+from config.log import JsonFormatter, MessageSamplingFilter, QueueFileHandler
 from app_user.tests import AuthAPITestCase
-from .models import Mailing, Message
-from .services import MsgAPI
+from app_user.models import Client, OperatorCode, Tag
+from .apps import create_breakdown_view
+from .models import Mailing, MailingBreakdown, MailingStats, MailingStatsHourly, Message
+from .services import MsgAPI, MailingDispatcher, MessageStatusBuffer, TaskMailingDB, PendingMessage, \
+    Statistic, StatisticRollup, MailingBreakdownDB, iter_csv_gzip
+from .fake_probe import FakeProbeServer, parse_latency
+from .limiters import RateLimiter, CircuitBreaker
+from .transport import ProbeTransport
+from .profiling import TaskProfiler
+from .management.commands.benchmark import Command as BenchmarkCommand
+from . import metrics
+from .tasks import send_mailing, send_mailing_part, send_statistics
 
 
 class MockTask:
@@ -146,6 +179,17 @@ class MailingTest(AuthAPITestCase):
             else:
                 self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_get_endpoints_cursor_pagination(self):
+        for url in (self.__url_mailing, reverse('statistics-list')):
+            ids = []
+            url = f'{url}?pagination=cursor&page_size=3'
+            while url:
+                response = self.client_admin.get(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                ids.extend(row['id'] for row in response.data['results'])
+                url = response.data['next']
+            self.assertEqual(ids, list(Mailing.objects.order_by('-id').values_list('id', flat=True)))
+
 
 class MsgAPITest(AuthAPITestCase):
     @classmethod
@@ -158,33 +202,1131 @@ class MsgAPITest(AuthAPITestCase):
         self._create_messages(mailings)
         self.client_admin = self._authorization_admin()
 
-    @mock.patch('requests.post')
+    @staticmethod
+    def _get_pending_message(message: Message) -> PendingMessage:
+        return PendingMessage(message.id, message.client_id, message.client.phone, message.attempts)
+
+    @mock.patch('requests.Session.post')
     def test_post_response_http_200(self, requests_post):
         requests_post.return_value = MockResponseMsgApi(method='post', status_code=200)
         message = Message.objects.first()
 
         msg_api = MsgAPI(message.mailing)
-        result = msg_api.post(message)
+        result = msg_api.post(self._get_pending_message(message))
         self.assertTrue(result[0])
         self.assertEqual(result[1].get('code'), 0)
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_post_response_http_400(self, requests_post):
         requests_post.return_value = MockResponseMsgApi(method='post', status_code=400)
         message = Message.objects.first()
 
         msg_api = MsgAPI(message.mailing)
-        result = msg_api.post(message)
+        result = msg_api.post(self._get_pending_message(message))
         self.assertFalse(result[0])
         self.assertEqual(result[1], MsgAPI.except_names[1])
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_post_response_error(self, requests_post):
         for except_name in MsgAPI.except_names:
             requests_post.return_value = MockResponseMsgApi(method='post', name_error=except_name)
             message = Message.objects.first()
 
             msg_api = MsgAPI(message.mailing)
-            result = msg_api.post(message)
+            result = msg_api.post(self._get_pending_message(message))
             self.assertFalse(result[0])
             self.assertEqual(result[1], except_name)
+
+
+class MailingDispatcherTest(AuthAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data_clients()
+
+    def setUp(self) -> None:
+        start_date = timezone.now()
+        self.mailing = Mailing.objects.create(start_date=start_date, text='Test',
+                                              finish_date=start_date + timezone.timedelta(hours=1))
+        Message.objects.bulk_create(Message(mailing=self.mailing, client=client)
+                                    for client in Client.objects.all())
+
+    @mock.patch('requests.Session.post')
+    def test_dispatch_limits_requests_in_flight(self, requests_post):
+        lock = threading.Lock()
+        counter = {'in_flight': 0, 'max': 0}
+
+        def post(*args, **kwargs):
+            with lock:
+                counter['in_flight'] += 1
+                counter['max'] = max(counter['max'], counter['in_flight'])
+            time.sleep(0.01)
+            with lock:
+                counter['in_flight'] -= 1
+            return MockResponseMsgApi(method='post', status_code=200)
+
+        requests_post.side_effect = post
+        messages = TaskMailingDB(self.mailing).iter_messages()
+
+        with MailingDispatcher(MsgAPI(self.mailing), concurrency=4) as dispatcher:
+            results = list(dispatcher.dispatch(messages))
+
+        self.assertEqual(len(results), self.mailing.message.count())
+        self.assertTrue(all(status for _, _, status, _ in results))
+        self.assertLessEqual(counter['max'], 4)
+        self.assertGreater(counter['max'], 1)
+
+    @mock.patch('requests.Session.post')
+    def test_dispatch_stop(self, requests_post):
+        requests_post.return_value = MockResponseMsgApi(method='post', name_error=MsgAPI.except_names[2])
+        messages = TaskMailingDB(self.mailing).iter_messages()
+
+        with MailingDispatcher(MsgAPI(self.mailing), concurrency=2) as dispatcher:
+            results = []
+            for result in dispatcher.dispatch(messages):
+                results.append(result)
+                dispatcher.stop()
+
+        self.assertLessEqual(len(results), 2)
+
+    @mock.patch('requests.Session.post')
+    def test_exit_drains_in_flight(self, requests_post):
+        def post(*args, **kwargs):
+            time.sleep(0.05)
+            return MockResponseMsgApi(method='post', status_code=200)
+
+        requests_post.side_effect = post
+        messages = TaskMailingDB(self.mailing).iter_messages()
+        dispatcher = MailingDispatcher(MsgAPI(self.mailing), concurrency=4)
+
+        with self.assertRaises(SoftTimeLimitExceeded), dispatcher:
+            for _ in dispatcher.dispatch(messages):
+                raise SoftTimeLimitExceeded
+
+        # Запросы в полёте завершены и отданы, новые не отправлялись
+        drained = dispatcher.drain()
+        self.assertEqual(len(drained), 3)
+        self.assertTrue(all(status for _, _, status, _ in drained))
+        self.assertEqual(requests_post.call_count, 4)
+        self.assertEqual(dispatcher.drain(), [])
+
+
+class MessageStatusBufferTest(AuthAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data_clients()
+
+    def setUp(self) -> None:
+        start_date = timezone.now()
+        self.mailing = Mailing.objects.create(start_date=start_date, text='Test',
+                                              finish_date=start_date + timezone.timedelta(hours=1))
+        Message.objects.bulk_create(Message(mailing=self.mailing, client=client)
+                                    for client in Client.objects.all())
+
+    def test_flush_by_size(self):
+        buffer = MessageStatusBuffer(self.mailing, size=5, interval=60000)
+        message_ids = list(self.mailing.message.values_list('id', flat=True))
+
+        with self.assertNumQueries(0):
+            for message_id in message_ids[:4]:
+                buffer.add(message_id, 1, timezone.now())
+        self.assertEqual(len(buffer), 4)
+
+        buffer.add(message_ids[4], 1, timezone.now())
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(self.mailing.message.filter(status=1).count(), 5)
+
+    def test_not_sent_status_keeps_buffered(self):
+        task_mailing_db = TaskMailingDB(self.mailing)
+        message = next(task_mailing_db.iter_messages())
+        task_mailing_db.set_sent_status_message(message, timezone.now())
+        task_mailing_db.set_not_sent_status_message()
+
+        self.assertEqual(Message.objects.get(pk=message.id).status, 1)
+        self.assertEqual(self.mailing.message.filter(status=0).count(),
+                         self.mailing.message.count() - 1)
+
+
+class CreateMessagesTest(AuthAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data_clients()
+
+    def setUp(self) -> None:
+        start_date = timezone.now()
+        self.mailing = Mailing.objects.create(start_date=start_date, text='Test',
+                                              finish_date=start_date + timezone.timedelta(hours=1))
+        self.mailing.code.set(OperatorCode.objects.all())
+
+    @override_settings(MESSAGE_CREATE_CHUNK_SIZE=5)
+    def test_create_messages_by_chunks(self):
+        tag = Tag.objects.filter(client__isnull=False).first()
+        self.mailing.tag.set([tag])
+        clients = Client.objects.filter(tag=tag)
+
+        created = TaskMailingDB(self.mailing).create_messages()
+
+        self.assertEqual(created, clients.count())
+        self.assertEqual(set(self.mailing.message.values_list('client_id', flat=True)),
+                         set(clients.values_list('id', flat=True)))
+        self.assertFalse(self.mailing.message.filter(status__isnull=False).exists())
+
+    @override_settings(MESSAGE_CREATE_CHUNK_SIZE=2)
+    def test_create_messages_resumes_after_last_client(self):
+        self.mailing.tag.set(Tag.objects.all())
+        client_ids = list(Client.objects.filter(tag__isnull=False).order_by('id').values_list('id', flat=True))
+        # Части до сбоя уже закоммичены вместе со счетчиком pending
+        Message.objects.bulk_create(Message(mailing=self.mailing, client_id=client_id)
+                                    for client_id in client_ids[:3])
+
+        created = TaskMailingDB(self.mailing).create_messages()
+
+        self.assertEqual(created, len(client_ids) - 3)
+        self.assertEqual(sorted(self.mailing.message.values_list('client_id', flat=True)), client_ids)
+        self.assertEqual(MailingStats.objects.get(mailing=self.mailing).pending, created)
+
+    def test_create_messages_without_clients(self):
+        self.assertEqual(TaskMailingDB(self.mailing).create_messages(), 0)
+        self.assertFalse(self.mailing.message.exists())
+
+
+class IterMessagesTest(AuthAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data_clients()
+
+    def setUp(self) -> None:
+        start_date = timezone.now()
+        self.mailing = Mailing.objects.create(start_date=start_date, text='Test',
+                                              finish_date=start_date + timezone.timedelta(hours=1))
+        Message.objects.bulk_create(Message(mailing=self.mailing, client=client)
+                                    for client in Client.objects.all())
+
+    def test_iter_messages_by_window(self):
+        self.mailing.message.filter(id=self.mailing.message.last().id).update(status=1)
+        pending = self.mailing.message.filter(status__isnull=True).select_related('client')
+        expected = [PendingMessage(message.id, message.client_id, message.client.phone, 0)
+                    for message in pending.order_by('id')]
+
+        windows = -(-len(expected) // 4)
+        with self.assertNumQueries(windows + (len(expected) % 4 == 0)):
+            messages = list(TaskMailingDB(self.mailing).iter_messages(window=4))
+
+        self.assertEqual(messages, expected)
+
+
+class MessageAttemptsTest(AuthAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data_clients()
+
+    def setUp(self) -> None:
+        start_date = timezone.now()
+        self.mailing = Mailing.objects.create(start_date=start_date, text='Test',
+                                              finish_date=start_date + timezone.timedelta(hours=1))
+        Message.objects.bulk_create(Message(mailing=self.mailing, client=client)
+                                    for client in Client.objects.all())
+
+    @override_settings(MESSAGE_MAX_ATTEMPTS=2, MESSAGE_RETRY_BACKOFF=60)
+    def test_failed_attempt_backoff_and_terminal_status(self):
+        task_mailing_db = TaskMailingDB(self.mailing)
+        message = next(task_mailing_db.iter_messages())
+        task_mailing_db.set_failed_attempt_message(message, timezone.now())
+        task_mailing_db.flush_status_messages()
+
+        message_obj = Message.objects.get(pk=message.id)
+        self.assertIsNone(message_obj.status)
+        self.assertEqual(message_obj.attempts, 1)
+        self.assertGreaterEqual(message_obj.next_attempt_at, timezone.now() + timezone.timedelta(seconds=29))
+        self.assertNotIn(message.id, [message.id for message in task_mailing_db.iter_messages()])
+
+        task_mailing_db.set_failed_attempt_message(message._replace(attempts=1), timezone.now())
+        task_mailing_db.flush_status_messages()
+        message_obj.refresh_from_db()
+        self.assertEqual(message_obj.status, 0)
+        self.assertEqual(message_obj.attempts, 2)
+
+    @override_settings(MESSAGE_RETRY_BACKOFF=10, MESSAGE_RETRY_BACKOFF_MAX=30)
+    def test_retry_delay(self):
+        for attempts, delay in ((1, 10), (2, 20), (3, 30), (10, 30)):
+            retry_delay = TaskMailingDB.get_retry_delay(attempts)
+            self.assertGreaterEqual(retry_delay, delay / 2)
+            self.assertLessEqual(retry_delay, delay)
+
+
+class ClaimMessagesTest(AuthAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data_clients()
+
+    def setUp(self) -> None:
+        start_date = timezone.now()
+        self.mailing = Mailing.objects.create(start_date=start_date, text='Test',
+                                              finish_date=start_date + timezone.timedelta(hours=1))
+        Message.objects.bulk_create(Message(mailing=self.mailing, client=client)
+                                    for client in Client.objects.all())
+
+    def test_claim_messages_not_overlap(self):
+        first = TaskMailingDB(self.mailing).claim_messages(size=5)
+        second = TaskMailingDB(self.mailing).claim_messages(size=5)
+
+        self.assertEqual(len(first), 5)
+        self.assertEqual(len(second), 5)
+        self.assertFalse({message.id for message in first} & {message.id for message in second})
+
+    def test_claim_messages_reclaim_expired_lease(self):
+        task_mailing_db = TaskMailingDB(self.mailing)
+        claimed = task_mailing_db.claim_messages(size=100)
+        self.assertEqual(task_mailing_db.claim_messages(), [])
+
+        Message.objects.filter(id=claimed[0].id). \
+            update(lease_until=timezone.now() - timezone.timedelta(seconds=1))
+        self.assertEqual(task_mailing_db.claim_messages(), claimed[:1])
+
+    def test_set_not_sent_skips_messages_leased_by_other_parts(self):
+        first, second = TaskMailingDB(self.mailing), TaskMailingDB(self.mailing)
+        own = first.claim_messages(size=3)
+        other = second.claim_messages(size=3)
+
+        first.set_not_sent_status_message()
+        pending = set(self.mailing.message.filter(status__isnull=True).values_list('id', flat=True))
+        self.assertEqual(pending, {message.id for message in other})
+        self.assertFalse(self.mailing.message.filter(id__in=[message.id for message in own],
+                                                     status__isnull=True).exists())
+
+        # Последняя часть переводит свои сообщения
+        second.set_not_sent_status_message()
+        self.assertFalse(self.mailing.message.filter(status__isnull=True).exists())
+
+
+class SendMailingTest(AuthAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data_clients()
+
+    def setUp(self) -> None:
+        start_date = timezone.now()
+        self.mailing = Mailing.objects.create(start_date=start_date, text='Test',
+                                              finish_date=start_date + timezone.timedelta(hours=1))
+        self.mailing.tag.set(Tag.objects.all())
+        self.mailing.code.set(OperatorCode.objects.all())
+
+    @mock.patch('requests.Session.post')
+    def test_send_mailing(self, requests_post):
+        requests_post.return_value = MockResponseMsgApi(method='post', status_code=200)
+        send_mailing.apply(kwargs={'mailing_id': self.mailing.id})
+        self.mailing.refresh_from_db()
+
+        self.assertEqual(self.mailing.status, 2)
+        self.assertEqual(self.mailing.message.count(), Client.objects.count())
+        self.assertFalse(self.mailing.message.exclude(status=1).exists())
+
+    @override_settings(MESSAGE_MAX_ATTEMPTS=3, MESSAGE_RETRY_BACKOFF=0)
+    @mock.patch('requests.Session.post')
+    def test_send_mailing_stops_after_max_attempts(self, requests_post):
+        requests_post.return_value = MockResponseMsgApi(method='post', status_code=400)
+        send_mailing.apply(kwargs={'mailing_id': self.mailing.id})
+        self.mailing.refresh_from_db()
+
+        self.assertEqual(self.mailing.status, 2)
+        self.assertEqual(requests_post.call_count, 3 * self.mailing.message.count())
+        self.assertFalse(self.mailing.message.exclude(status=0, attempts=3).exists())
+
+    @override_settings(MESSAGE_MAX_ATTEMPTS=2, MESSAGE_RETRY_BACKOFF=60)
+    @mock.patch('app_mailing.tasks.send_mailing.retry', side_effect=Retry)
+    @mock.patch('requests.Session.post')
+    def test_send_mailing_retries_postponed_with_countdown(self, requests_post, retry):
+        requests_post.return_value = MockResponseMsgApi(method='post', status_code=400)
+        send_mailing.apply(kwargs={'mailing_id': self.mailing.id})
+        self.mailing.refresh_from_db()
+
+        # Воркер не спит до повтора, а перезапускает задачу к ближайшей попытке
+        retry.assert_called_once()
+        self.assertTrue(0 < retry.call_args.kwargs['countdown'] <= 60)
+        self.assertEqual(self.mailing.status, 1)
+        self.assertFalse(self.mailing.message.exclude(status__isnull=True, attempts=1).exists())
+
+    @override_settings(MAILING_WORKERS=2, MESSAGE_CLAIM_SIZE=3)
+    @mock.patch('app_mailing.tasks.send_mailing_part.apply_async')
+    @mock.patch('requests.Session.post')
+    def test_send_mailing_by_parts(self, requests_post, apply_async):
+        requests_post.return_value = MockResponseMsgApi(method='post', status_code=200)
+        apply_async.side_effect = lambda kwargs, **options: send_mailing_part.apply(kwargs=kwargs)
+        send_mailing.apply(kwargs={'mailing_id': self.mailing.id})
+        self.mailing.refresh_from_db()
+
+        self.assertEqual(apply_async.call_count, 2)
+        self.assertEqual(self.mailing.status, 2)
+        self.assertFalse(self.mailing.message.exclude(status=1).exists())
+
+    @override_settings(MAILING_WORKERS=2, MESSAGE_CLAIM_SIZE=3, MESSAGE_MAX_ATTEMPTS=2,
+                       MESSAGE_RETRY_BACKOFF=0, MESSAGE_LEASE_TIMEOUT=300)
+    @mock.patch('app_mailing.tasks.time.sleep')
+    @mock.patch('app_mailing.tasks.send_mailing_part.apply_async')
+    @mock.patch('requests.Session.post')
+    def test_send_mailing_by_parts_reclaims_postponed(self, requests_post, apply_async, sleep):
+        requests_post.return_value = MockResponseMsgApi(method='post', status_code=400)
+        apply_async.side_effect = lambda kwargs, **options: send_mailing_part.apply(kwargs=kwargs)
+        # При неснятой аренде часть ждала бы MESSAGE_LEASE_TIMEOUT
+        sleep.side_effect = lambda seconds: Message.objects.update(lease_until=None)
+        send_mailing.apply(kwargs={'mailing_id': self.mailing.id})
+        self.mailing.refresh_from_db()
+
+        sleep.assert_not_called()
+        self.assertEqual(self.mailing.status, 2)
+        self.assertEqual(requests_post.call_count, 2 * self.mailing.message.count())
+        self.assertFalse(self.mailing.message.exclude(status=0, attempts=2).exists())
+
+    @mock.patch('app_mailing.tasks.TaskMailing.get_time_life')
+    @mock.patch('requests.Session.post')
+    def test_send_mailing_connection_error_near_time_limit(self, requests_post, get_time_life):
+        requests_post.return_value = MockResponseMsgApi(method='post', name_error=MsgAPI.except_names[2])
+        get_time_life.return_value = 10
+        send_mailing.apply(kwargs={'mailing_id': self.mailing.id})
+        self.mailing.refresh_from_db()
+
+        self.assertEqual(self.mailing.status, 3)
+        self.assertFalse(self.mailing.message.exclude(status=0).exists())
+
+
+class ProbeHandler(BaseHTTPRequestHandler):
+    """Заглушка стороннего API с keep-alive"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{"code": 0, "message": "OK"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MailingStatsTest(AuthAPITestCase):
+    __url_statistics = reverse('statistics-list')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_users()
+        cls._create_data_clients()
+
+    def setUp(self) -> None:
+        start_date = timezone.now()
+        self.mailing = Mailing.objects.create(start_date=start_date, text='Test',
+                                              finish_date=start_date + timezone.timedelta(hours=1))
+        self.mailing.tag.set(Tag.objects.all())
+        self.mailing.code.set(OperatorCode.objects.all())
+
+    def _get_stats(self) -> MailingStats:
+        return MailingStats.objects.get(mailing=self.mailing)
+
+    def test_counters_follow_message_statuses(self):
+        task_mailing_db = TaskMailingDB(self.mailing)
+        count = task_mailing_db.create_messages()
+        self.assertEqual(self._get_stats().pending, count)
+
+        messages = list(task_mailing_db.iter_messages())[:2]
+        task_mailing_db.set_sent_status_message(messages[0], timezone.now())
+        task_mailing_db.set_sent_status_message(messages[1], timezone.now())
+        task_mailing_db.flush_status_messages()
+        task_mailing_db.set_not_sent_status_message()
+
+        stats = self._get_stats()
+        self.assertEqual((stats.pending, stats.sent, stats.failed), (0, 2, count - 2))
+
+    def test_flush_is_idempotent(self):
+        task_mailing_db = TaskMailingDB(self.mailing)
+        count = task_mailing_db.create_messages()
+        message = next(task_mailing_db.iter_messages())
+
+        task_mailing_db.set_sent_status_message(message, timezone.now())
+        task_mailing_db.set_sent_status_message(message, timezone.now())
+        task_mailing_db.flush_status_messages()
+
+        stats = self._get_stats()
+        self.assertEqual((stats.pending, stats.sent), (count - 1, 1))
+
+    def test_statistics_endpoint_and_rebuild(self):
+        TaskMailingDB(self.mailing).create_messages()
+        self.mailing.message.update(status=1)
+        client = self._authorization_admin()
+
+        response = client.get(self.__url_statistics)
+        self.assertEqual(response.data['results'][0]['send_pending'], Client.objects.count())
+        self.assertEqual(response.data['results'][0]['send_success'], 0)
+
+        call_command('rebuild_mailing_stats', stdout=io.StringIO())
+        response = client.get(self.__url_statistics)
+        self.assertEqual(response.data['results'][0]['send_pending'], 0)
+        self.assertEqual(response.data['results'][0]['send_success'], Client.objects.count())
+
+
+class StatisticsMessagesTest(AuthAPITestCase):
+    __name_url_messages = 'statistics-messages'
+    __name_url_detail = 'statistics-detail'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_users()
+        cls._create_data_clients()
+        start_date = timezone.now()
+        cls.mailing = Mailing.objects.create(start_date=start_date, text='Test',
+                                             finish_date=start_date + timezone.timedelta(hours=1))
+        Message.objects.bulk_create(
+            Message(mailing=cls.mailing, client=client, status=i % 2,
+                    send_date=start_date - timezone.timedelta(minutes=i))
+            for i, client in enumerate(Client.objects.order_by('id'))
+        )
+
+    def setUp(self) -> None:
+        self.client_admin = self._authorization_admin()
+        self.url = reverse(self.__name_url_messages, args=[self.mailing.id])
+
+    def test_detail_without_messages(self):
+        response = self.client_admin.get(reverse(self.__name_url_detail, args=[self.mailing.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('message', response.data)
+
+    def test_cursor_pages(self):
+        ids = []
+        url = f'{self.url}?page_size=5'
+        while url:
+            response = self.client_admin.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.extend(row['id'] for row in response.data['results'])
+            url = response.data['next']
+
+        self.assertEqual(ids, list(self.mailing.message.order_by('-id').values_list('id', flat=True)))
+
+    def test_filters(self):
+        date = timezone.now() - timezone.timedelta(minutes=5, seconds=30)
+        response = self.client_admin.get(self.url, {'status': '1', 'send_date_after': date.isoformat()})
+        expected = self.mailing.message.filter(status=1, send_date__gte=date)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({row['id'] for row in response.data['results']},
+                         set(expected.values_list('id', flat=True)))
+
+        response = self.client_admin.get(self.url, {'status': 'sent'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(MESSAGE_STREAM_WINDOW=3)
+    def test_stream(self):
+        response = self.client_admin.get(self.url, {'stream': '1', 'status': '0'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([row['id'] for row in rows],
+                         list(self.mailing.message.filter(status=0).order_by('-id').values_list('id', flat=True)))
+
+    def test_messages_if_login_user(self):
+        client = self._authorization(self._username.format(1))
+        response = client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class StatisticsExportTest(AuthAPITestCase):
+    __url_export = reverse('statistics-export')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_users()
+        now = timezone.now()
+        cls.mailings = Mailing.objects.bulk_create(
+            Mailing(start_date=now - timezone.timedelta(days=i + 1), text=f'Test {i}',
+                    finish_date=now - timezone.timedelta(days=i) + timezone.timedelta(hours=1))
+            for i in range(5)
+        )
+
+    def _read_csv(self, content: bytes) -> list:
+        return list(csv.DictReader(io.StringIO(gzip.decompress(content).decode())))
+
+    @override_settings(STATISTICS_EXPORT_CHUNK_SIZE=2)
+    def test_iter_csv_gzip_by_chunks(self):
+        chunks = list(iter_csv_gzip(Statistic.get_queryset_list(), Statistic.list_fields))
+        rows = self._read_csv(b''.join(chunks))
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual([int(row['id']) for row in rows], [mailing.id for mailing in
+                                                            Mailing.objects.order_by('-id')])
+        self.assertEqual(list(rows[0].keys()), list(Statistic.list_fields))
+
+    def test_export_endpoint(self):
+        client = self._authorization_admin()
+        date_from = timezone.now() - timezone.timedelta(days=2)
+        response = client.get(self.__url_export, {'date_from': date_from.isoformat()})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        rows = self._read_csv(b''.join(response.streaming_content))
+        self.assertEqual({int(row['id']) for row in rows},
+                         set(Mailing.objects.filter(finish_date__gte=date_from).values_list('id', flat=True)))
+
+        response = client.get(self.__url_export, {'date_from': date_from.isoformat(),
+                                                  'date_to': (date_from - timezone.timedelta(days=1)).isoformat()})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class StatisticRollupTest(AuthAPITestCase):
+    __url_timeseries = reverse('statistics-timeseries')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_users()
+        cls._create_data_clients()
+
+    def setUp(self) -> None:
+        self.yesterday = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0) - \
+            timezone.timedelta(days=1)
+        self.mailing = Mailing.objects.create(start_date=self.yesterday, text='Test',
+                                              finish_date=self.yesterday + timezone.timedelta(days=2))
+        self.clients = list(Client.objects.select_related('code', 'tag'))
+        self._create_messages(self.yesterday + timezone.timedelta(hours=1, minutes=10))
+
+    def _create_messages(self, send_date: datetime.datetime, status: int = 1) -> None:
+        Message.objects.bulk_create(Message(mailing=self.mailing, client=client, status=status, send_date=send_date,
+                                            processed_at=send_date)
+                                    for client in self.clients)
+
+    def test_rollup_is_incremental(self):
+        self.assertGreater(StatisticRollup(lag=0).run(), 0)
+        self.assertEqual(StatisticRollup(lag=0).run(), 0)
+
+        self._create_messages(timezone.now(), status=0)
+        StatisticRollup(lag=0).run()
+
+        totals = MailingStatsHourly.objects.aggregate(sent=Sum('sent'), failed=Sum('failed'))
+        self.assertEqual(totals, {'sent': len(self.clients), 'failed': len(self.clients)})
+        row = MailingStatsHourly.objects.filter(sent__gt=0).first()
+        self.assertEqual(row.hour, self.yesterday + timezone.timedelta(hours=1))
+        self.assertAlmostEqual(row.delay_sum / row.sent, 70 * 60)
+        self.assertEqual(MailingStatsHourly.objects.filter(sent__gt=0).count(),
+                         len({(client.code.code, client.tag.name) for client in self.clients}))
+
+    def test_rollup_counts_late_status_writes(self):
+        StatisticRollup(lag=0).run()
+        # Отправлено в прошлом часе, статус записан в БД после отметки
+        messages = Message.objects.bulk_create(Message(mailing=self.mailing, client=client) for client in self.clients)
+        buffer = MessageStatusBuffer(self.mailing, size=len(messages) + 1)
+        for message in messages:
+            buffer.add(message.id, 0, self.yesterday + timezone.timedelta(hours=1, minutes=20))
+        buffer.flush()
+        StatisticRollup(lag=0).run()
+
+        totals = MailingStatsHourly.objects.filter(hour=self.yesterday + timezone.timedelta(hours=1)). \
+            aggregate(sent=Sum('sent'), failed=Sum('failed'))
+        self.assertEqual(totals, {'sent': len(self.clients), 'failed': len(self.clients)})
+
+    def test_timeseries_endpoint(self):
+        StatisticRollup(lag=0).run()
+        client = self._authorization_admin()
+
+        response = client.get(self.__url_timeseries, {'group_by': 'code'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sum(row['sent'] for row in response.data), len(self.clients))
+        self.assertEqual({row['code'] for row in response.data}, {client.code.code for client in self.clients})
+        self.assertEqual(response.data[0]['avg_delay'], 70 * 60)
+
+        response = client.get(reverse('statistics-mailing-timeseries', args=[self.mailing.id]),
+                              {'date_from': (self.yesterday + timezone.timedelta(hours=2)).isoformat()})
+        self.assertEqual(response.data, [])
+
+    def test_send_statistics(self):
+        with tempfile.TemporaryDirectory() as folder, \
+                override_settings(FOLDER_STATISTICS=Path(folder), EMAIL_HOST_ADMIN='admin@test.com'):
+            send_statistics()
+            self.assertEqual(len(mail.outbox), 1)
+            filename, content, mimetype = mail.outbox[0].attachments[0]
+
+        self.assertTrue(filename.endswith('.csv.gz'))
+        self.assertEqual(mimetype, 'application/gzip')
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(content).decode())))
+        self.assertEqual([(int(row['mailing_id']), int(row['sent'])) for row in rows],
+                         [(self.mailing.id, len(self.clients))])
+
+
+class MailingBreakdownTest(AuthAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_users()
+        cls._create_data_clients()
+        start_date = timezone.now()
+        cls.mailing = Mailing.objects.create(start_date=start_date, text='Test',
+                                             finish_date=start_date + timezone.timedelta(hours=1))
+        cls.clients = list(Client.objects.select_related('code', 'tag'))
+        Message.objects.bulk_create(Message(mailing=cls.mailing, client=client, status=i % 2)
+                                    for i, client in enumerate(cls.clients))
+
+    def test_refresh_and_breakdown(self):
+        self.assertTrue(MailingBreakdownDB.refresh())
+        Message.objects.filter(mailing=self.mailing, status=1).update(status=0)
+        self.assertTrue(MailingBreakdownDB.refresh())
+
+        client = self._authorization_admin()
+        response = client.get(reverse('statistics-breakdown', args=[self.mailing.id]), {'group_by': 'code'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(response.data['refreshed_at'])
+
+        results = response.data['results']
+        expected = {}
+        for client_obj in self.clients:
+            expected[client_obj.code.code] = expected.get(client_obj.code.code, 0) + 1
+        self.assertEqual({row['code']: row['failed'] for row in results}, expected)
+        self.assertEqual([row['failed'] for row in results], sorted(expected.values(), reverse=True))
+        self.assertNotIn('tag', results[0])
+
+    def test_refresh_creates_missing_view(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP MATERIALIZED VIEW {connection.ops.quote_name(MailingBreakdown._meta.db_table)}')
+        self.assertTrue(MailingBreakdownDB.refresh())
+        self.assertEqual(MailingBreakdown.objects.filter(mailing_id=self.mailing.id).count(),
+                         len({(c.code.code, c.tag.name) for c in self.clients}))
+
+    @mock.patch('app_mailing.services.MailingBreakdownDB.create_view')
+    def test_create_view_skipped_without_tables(self, create_view):
+        with mock.patch.object(connection.introspection, 'table_names', return_value=[]):
+            create_breakdown_view(sender=None)
+        create_view.assert_not_called()
+        create_breakdown_view(sender=None)
+        create_view.assert_called_once()
+
+    def test_breakdown_by_code_and_tag(self):
+        MailingBreakdownDB.refresh()
+        client = self._authorization_admin()
+        response = client.get(reverse('statistics-breakdown', args=[self.mailing.id]))
+
+        results = response.data['results']
+        self.assertEqual(sum(row['total'] for row in results), len(self.clients))
+        self.assertEqual(len(results), len({(c.code.code, c.tag.name) for c in self.clients}))
+
+
+class ProbeTransportTest(SimpleTestCase):
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ProbeHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/v1/send/'
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_post_reuses_connection(self):
+        transport = ProbeTransport(pool_connections=1, pool_maxsize=2)
+        for i in range(3):
+            response = transport.post(f'{self.url}{i}', json={'id': i}, timeout=5)
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(transport.stats(), {'opened': 1, 'reused': 2, 'requests': 3})
+        transport.close()
+
+    def test_pop_stats_metrics(self):
+        def get_value(kind: str) -> float:
+            return REGISTRY.get_sample_value('probe_connections_total', {'kind': kind}) or 0
+
+        transport = ProbeTransport(pool_connections=1, pool_maxsize=2)
+        before = {kind: get_value(kind) for kind in ('opened', 'reused')}
+        for i in range(3):
+            transport.post(self.url, json={'id': i}, timeout=5)
+        metrics.observe_connections(transport.pop_stats())
+
+        self.assertEqual(get_value('opened') - before['opened'], 1)
+        self.assertEqual(get_value('reused') - before['reused'], 2)
+        transport.post(self.url, json={'id': 3}, timeout=5)
+        self.assertEqual(transport.pop_stats(), {'opened': 0, 'reused': 1, 'requests': 1})
+        transport.close()
+
+    def test_reset_opens_new_pool(self):
+        transport = ProbeTransport(pool_connections=1, pool_maxsize=2)
+        session = transport.session
+        transport.reset()
+
+        self.assertIsNot(session, transport.session)
+        self.assertEqual(transport.stats()['opened'], 0)
+        session.close()
+        transport.close()
+
+
+class MockRedis:
+    """Mock для Redis: скрипт возвращает заданные времена ожидания"""
+
+    def __init__(self, waits):
+        self.waits = list(waits)
+        self.calls = []
+
+    def register_script(self, script):
+        def call(keys, args):
+            self.calls.append((keys, args))
+            wait_ms = self.waits.pop(0) if self.waits else 0
+            if isinstance(wait_ms, Exception):
+                raise wait_ms
+            return wait_ms
+        return call
+
+
+class RateLimiterTest(SimpleTestCase):
+    def test_disabled_without_limits(self):
+        client = MockRedis([])
+        limiter = RateLimiter(rate=0, rates_by_code={}, client=client)
+
+        self.assertFalse(limiter.enabled)
+        self.assertEqual(limiter.acquire('901'), 0)
+        self.assertEqual(client.calls, [])
+
+    @mock.patch('app_mailing.limiters.time.sleep')
+    def test_acquire_waits_for_token(self, sleep):
+        client = MockRedis([200, 50])
+        limiter = RateLimiter(rate=10, burst=10, rates_by_code={'901': 2}, client=client)
+
+        self.assertAlmostEqual(limiter.acquire('901'), 0.25)
+        self.assertAlmostEqual(limiter.wait_time, 0.25)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(client.calls[0][0], ['probe_rate_limit:global', 'probe_rate_limit:code:901'])
+
+    def test_global_bucket_only_for_other_codes(self):
+        client = MockRedis([])
+        limiter = RateLimiter(rate=10, burst=10, rates_by_code={'901': 2}, client=client)
+        limiter.acquire('902')
+
+        self.assertEqual(client.calls, [(['probe_rate_limit:global'], [10, 10])])
+
+    def test_acquire_fails_open_on_redis_error(self):
+        client = MockRedis([redis.ConnectionError('Connection refused')])
+        limiter = RateLimiter(rate=10, burst=10, rates_by_code={}, client=client)
+
+        with mock.patch('app_mailing.limiters._error_logged_at', {}), \
+                self.assertLogs('app_mailing.limiters', level='WARNING'):
+            self.assertEqual(limiter.acquire('901'), 0)
+
+
+class CircuitBreakerTest(AuthAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data_clients()
+
+    def setUp(self) -> None:
+        start_date = timezone.now()
+        self.mailing = Mailing.objects.create(start_date=start_date, text='Test',
+                                              finish_date=start_date + timezone.timedelta(hours=1))
+        Message.objects.bulk_create(Message(mailing=self.mailing, client=client)
+                                    for client in Client.objects.all()[:3])
+
+    def test_disabled_without_threshold(self):
+        client = MockRedis([])
+        breaker = CircuitBreaker(failure_threshold=0, client=client)
+        breaker.record(success=False)
+
+        self.assertEqual(breaker.acquire(), 0)
+        self.assertEqual(client.calls, [])
+
+    def test_fails_open_on_redis_error(self):
+        client = MockRedis([redis.TimeoutError('Timeout reading from socket')] * 2)
+        breaker = CircuitBreaker(failure_threshold=1, client=client)
+        errors = REGISTRY.get_sample_value('probe_limiter_errors_total', {'limiter': 'circuit_breaker'}) or 0
+
+        breaker.record(success=False)
+        self.assertEqual(breaker.acquire(), 0)
+        self.assertEqual(len(client.calls), 2)
+        self.assertEqual(REGISTRY.get_sample_value('probe_limiter_errors_total', {'limiter': 'circuit_breaker'}),
+                         errors + 2)
+
+    @mock.patch('app_mailing.services.circuit_breaker.record')
+    @mock.patch('requests.Session.post')
+    def test_post_records_result(self, requests_post, record):
+        message = next(TaskMailingDB(self.mailing).iter_messages())
+        msg_api = MsgAPI(self.mailing)
+
+        requests_post.return_value = MockResponseMsgApi(method='post', name_error=MsgAPI.except_names[2])
+        msg_api.post(message)
+        requests_post.return_value = MockResponseMsgApi(method='post', status_code=200)
+        msg_api.post(message)
+
+        self.assertEqual(record.call_args_list, [mock.call(success=False), mock.call(success=True)])
+
+    @mock.patch('app_mailing.services.circuit_breaker.acquire')
+    @mock.patch('requests.Session.post')
+    def test_dispatch_waits_while_circuit_open(self, requests_post, acquire):
+        requests_post.return_value = MockResponseMsgApi(method='post', status_code=200)
+        acquire.side_effect = [0.01, 0.01] + [0] * 10
+        messages = TaskMailingDB(self.mailing).iter_messages()
+
+        with MailingDispatcher(MsgAPI(self.mailing), concurrency=1) as dispatcher:
+            results = list(dispatcher.dispatch(messages))
+
+        self.assertTrue(all(status for _, _, status, _ in results))
+        self.assertEqual(requests_post.call_count, 3)
+        self.assertEqual(acquire.call_count, 5)
+
+
+class FakeProbeServerTest(SimpleTestCase):
+    def test_outcomes(self):
+        with FakeProbeServer(latency='fixed:0', error_rate=1, seed=1) as server:
+            response = requests.post(f'{server.url}1', json={'id': 1}, timeout=5)
+            self.assertEqual(response.status_code, 400)
+
+        with FakeProbeServer(drop_rate=1) as server:
+            with self.assertRaises(ConnectionError):
+                requests.post(f'{server.url}1', json={'id': 1}, timeout=5)
+
+        with FakeProbeServer(burst_every=60, burst_duration=60) as server:
+            response = requests.post(f'{server.url}1', json={'id': 1}, timeout=5)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(server.stats()[0]['burst'], 1)
+
+    def test_parse_latency(self):
+        self.assertEqual(parse_latency('fixed:5')(random.Random()), 5)
+        self.assertTrue(10 <= parse_latency('uniform:10:20')(random.Random()) <= 20)
+        with self.assertRaises(ValueError):
+            parse_latency('normal:5')
+
+
+class LoadTestCommandTest(AuthAPITestCase):
+    def test_loadtest_eager(self):
+        stdout = io.StringIO()
+        call_command('loadtest', clients=30, codes=2, latency='fixed:1', json=True, stdout=stdout)
+        report = json.loads(stdout.getvalue()[stdout.getvalue().index('{'):])
+
+        self.assertEqual(report['mode'], 'eager')
+        self.assertEqual(report['status'], 'SUCCESS')
+        self.assertEqual(report['sent'], 30)
+        self.assertEqual(report['latency_ms']['responses'], 30)
+        self.assertEqual(report['server']['ok'], 30)
+        self.assertIsNotNone(report['queries_per_message'])
+        self.assertFalse(Mailing.objects.filter(pk=report['mailing_id']).exists())
+        self.assertFalse(Tag.objects.filter(name='loadtest').exists())
+
+
+class BenchmarkCommandTest(AuthAPITestCase):
+    def test_benchmark_output_and_compare(self):
+        ops = ['get_queryset_list', 'get_queryset_messages', 'client_serializer']
+        with tempfile.TemporaryDirectory() as folder:
+            output = Path(folder) / 'base.json'
+            call_command('benchmark', ops=ops, repeat=1, min_time=0, label='base', output=output, stdout=io.StringIO())
+            results = json.loads(output.read_text())
+
+            self.assertEqual(results['dataset']['clients'], 10000)
+            self.assertEqual(list(results['results']), ops)
+            self.assertEqual(results['results']['get_queryset_list']['queries'], 1)
+            self.assertEqual(results['results']['client_serializer']['queries'], 0)
+
+            call_command('benchmark', ops=ops, repeat=1, min_time=0, compare=output, threshold=100, stdout=io.StringIO())
+
+            results['results']['get_queryset_list']['queries'] = 0
+            output.write_text(json.dumps(results))
+            with self.assertRaisesMessage(CommandError, 'get_queryset_list (queries)'):
+                call_command('benchmark', ops=ops, repeat=1, min_time=0, compare=output, threshold=100,
+                             stdout=io.StringIO())
+
+    def test_compare_noise_floor(self):
+        def results(**timings):
+            return {'scale': '10k', 'dataset': {}, 'results': {
+                name: {'min_ms': min_ms, 'stdev_ms': stdev_ms, 'queries': 1, 'peak_kb': 10.0}
+                for name, (min_ms, stdev_ms) in timings.items()}}
+
+        command = BenchmarkCommand(stdout=io.StringIO())
+        baseline = results(fast=(1.5, 0.1), noisy=(40.0, 5.0), slow=(100.0, 2.0))
+        # +60% у быстрой операции меньше 1 мс, +30% у шумной меньше 3 stdev
+        command._compare(baseline, results(fast=(2.4, 0.1), noisy=(52.0, 5.0), slow=(110.0, 2.0)), 0.2)
+        with self.assertRaisesMessage(CommandError, 'Regressions: slow (time)'):
+            command._compare(baseline, results(fast=(2.4, 0.1), noisy=(52.0, 5.0), slow=(130.0, 2.0)), 0.2)
+
+
+class MetricsTest(AuthAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data_clients()
+
+    def setUp(self) -> None:
+        start_date = timezone.now()
+        self.mailing = Mailing.objects.create(start_date=start_date, text='Test',
+                                              finish_date=start_date + timezone.timedelta(hours=1))
+        self.mailing.tag.set(Tag.objects.all())
+        self.mailing.code.set(OperatorCode.objects.all())
+
+    @mock.patch('requests.Session.post')
+    def test_send_mailing_metrics(self, requests_post):
+        requests_post.return_value = MockResponseMsgApi(method='post', status_code=200)
+        requests_before = REGISTRY.get_sample_value('probe_request_duration_seconds_count', {'outcome': 'ok'}) or 0
+        send_mailing.apply(kwargs={'mailing_id': self.mailing.id})
+
+        for code in OperatorCode.objects.all():
+            sent = REGISTRY.get_sample_value('mailing_messages_total', {'mailing_id': str(self.mailing.id),
+                                                                        'code': code.code, 'status': 'sent'})
+            self.assertEqual(sent or 0, Client.objects.filter(code=code).count())
+        self.assertEqual(REGISTRY.get_sample_value('probe_request_duration_seconds_count', {'outcome': 'ok'}),
+                         requests_before + Client.objects.count())
+        self.assertEqual(REGISTRY.get_sample_value('probe_requests_in_flight'), 0)
+
+    @override_settings(PROMETHEUS_METRICS_TOKEN='secret')
+    def test_metrics_endpoint(self):
+        Mailing.objects.filter(pk=self.mailing.pk).update(status=1)
+        MailingStats.objects.create(mailing=self.mailing, pending=7)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(f'mailing_pending_messages{{mailing_id="{self.mailing.id}"}} 7.0', response.content.decode())
+        self.assertIn('message_status_flush_duration_seconds_bucket', response.content.decode())
+
+    @override_settings(PROMETHEUS_METRICS_TOKEN='secret')
+    def test_metrics_endpoint_rejects_unauthorized(self):
+        with mock.patch.object(metrics.BacklogCollector, 'collect') as collect:
+            for headers in ({}, {'HTTP_AUTHORIZATION': 'Bearer wrong'}, {'HTTP_AUTHORIZATION': 'secret'}):
+                response = self.client.get(reverse('metrics'), **headers)
+                self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        collect.assert_not_called()
+
+        with override_settings(PROMETHEUS_METRICS_TOKEN=''):
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer ')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            self._create_users()
+            self.client.force_login(User.objects.get(username=self._username_admin))
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_200_OK)
+
+
+class LoggingTest(SimpleTestCase):
+    def test_queue_handler_writes_json(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = Path(folder) / 'test.log'
+            handler = QueueFileHandler(str(filename), encoding='UTF-8')
+            handler.setFormatter(JsonFormatter())
+            test_logger = logging.getLogger('app_mailing.tests.queue')
+            test_logger.addHandler(handler)
+            try:
+                test_logger.warning('[mailing_id=%s]: text %s', 1, 'value',
+                                    extra={'mailing_id': 1, 'message_id': 2, 'client_id': 3})
+                handler.flush()
+                # После fork очередь и поток создаются заново
+                handler.reset()
+                test_logger.warning('after reset')
+                handler.flush()
+            finally:
+                test_logger.removeHandler(handler)
+                handler.close()
+            records = [json.loads(line) for line in filename.read_text(encoding='UTF-8').splitlines()]
+
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['message'], '[mailing_id=1]: text value')
+        self.assertEqual((records[0]['mailing_id'], records[0]['message_id'], records[0]['client_id']), (1, 2, 3))
+        self.assertEqual(records[0]['level'], 'WARNING')
+        self.assertEqual(records[1]['message'], 'after reset')
+
+    def test_queue_handler_reports_dropped(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = Path(folder) / 'test.log'
+            handler = QueueFileHandler(str(filename), encoding='UTF-8', queue_size=1)
+            handler.setFormatter(JsonFormatter())
+            file_handler = handler._QueueFileHandler__file_handler
+            handle, release = file_handler.handle, threading.Event()
+
+            def blocked_handle(record):
+                release.wait(5)
+                return handle(record)
+
+            test_logger = logging.getLogger('app_mailing.tests.dropped')
+            test_logger.addHandler(handler)
+            try:
+                with mock.patch.object(file_handler, 'handle', side_effect=blocked_handle):
+                    test_logger.warning('first')
+                    # Фоновый поток забрал первую запись и ждет, очередь из одной записи заполняется
+                    deadline = time.monotonic() + 5
+                    while not handler.queue.empty() and time.monotonic() < deadline:
+                        time.sleep(0.01)
+                    for text in ('second', 'third', 'fourth'):
+                        test_logger.warning(text)
+                    self.assertEqual(handler.dropped, 2)
+                    release.set()
+                    handler.flush()
+                    test_logger.warning('fifth')
+                    handler.flush()
+            finally:
+                test_logger.removeHandler(handler)
+                handler.close()
+            records = [json.loads(line) for line in filename.read_text(encoding='UTF-8').splitlines()]
+
+        messages = [record['message'] for record in records]
+        self.assertEqual(messages[:3], ['first', 'second', 'log queue is full, dropped 2 records'])
+        self.assertEqual(messages.count('log queue is full, dropped 2 records'), 1)
+        self.assertEqual(records[2]['level'], 'WARNING')
+
+    def test_message_sampling(self):
+        def make_record(level: int, **extra) -> logging.LogRecord:
+            record = logging.LogRecord('app_mailing', level, __file__, 0, 'text', (), None)
+            record.__dict__.update(extra)
+            return record
+
+        drop_all = MessageSamplingFilter(rate=0)
+        self.assertFalse(drop_all.filter(make_record(logging.WARNING, message_id=1)))
+        self.assertTrue(drop_all.filter(make_record(logging.ERROR, message_id=1)))
+        self.assertTrue(drop_all.filter(make_record(logging.INFO, mailing_id=1)))
+
+        half = MessageSamplingFilter(rate=0.5)
+        kept = [message_id for message_id in range(1000)
+                if half.filter(make_record(logging.INFO, message_id=message_id))]
+        self.assertTrue(400 < len(kept) < 600)
+        self.assertEqual(kept, [message_id for message_id in range(1000)
+                                if half.filter(make_record(logging.WARNING, message_id=message_id))])
+
+
+class ProfilingTest(AuthAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data_clients()
+
+    def setUp(self) -> None:
+        start_date = timezone.now()
+        self.mailing = Mailing.objects.create(start_date=start_date, text='Test', profile=True,
+                                              finish_date=start_date + timezone.timedelta(hours=1))
+        self.mailing.tag.set(Tag.objects.all())
+        self.mailing.code.set(OperatorCode.objects.all())
+        self.folder = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(FOLDER_PROFILES=Path(self.folder.name), PROFILE_INTERVAL=0.001)
+        self.settings_override.enable()
+
+    def tearDown(self) -> None:
+        self.settings_override.disable()
+        self.folder.cleanup()
+
+    @mock.patch('requests.Session.post')
+    def test_send_mailing_profile(self, requests_post):
+        def post(*args, **kwargs):
+            time.sleep(0.01)
+            return MockResponseMsgApi(method='post', status_code=200)
+        requests_post.side_effect = post
+        send_mailing.apply(kwargs={'mailing_id': self.mailing.id})
+
+        files = sorted(Path(self.folder.name).iterdir())
+        self.assertEqual([file.suffix for file in files], ['.folded', '.json'])
+        report = json.loads(files[1].read_text())
+        self.assertEqual((report['task'], report['mailing_id']), ('send_mailing', self.mailing.id))
+        self.assertGreater(report['samples'], 0)
+        self.assertAlmostEqual(sum(value['share'] for value in report['wall'].values()), 1, delta=0.01)
+        self.assertIn('dispatch', files[0].read_text())
+
+    def test_disabled(self):
+        Mailing.objects.filter(pk=self.mailing.pk).update(profile=False)
+        self.mailing.refresh_from_db()
+        with override_settings(PROFILE_SAMPLE_RATE=0):
+            profiler = TaskProfiler('send_mailing', 'id', self.mailing)
+            profiler.start()
+            self.assertIsNone(profiler.stop())
+        self.assertFalse(profiler.enabled)
+        with override_settings(PROFILE_SAMPLE_RATE=1):
+            self.assertTrue(TaskProfiler('send_statistics').enabled)
+        self.assertEqual(list(Path(self.folder.name).iterdir()), [])
+
+    def test_classify(self):
+        cases = [
+            ([('/lib/python3/socket.py', 'readinto'), ('/site-packages/requests/sessions.py', 'post')], 'http'),
+            ([('/site-packages/django/db/backends/utils.py', '_execute'), ('/app_mailing/services.py', 'f')], 'db'),
+            ([('/lib/python3/json/encoder.py', 'encode'), ('/config/log.py', 'format'),
+              ('/lib/python3/logging/__init__.py', 'handle')], 'logging'),
+            ([('/lib/python3/threading.py', 'wait'), ('/lib/python3/queue.py', 'get'),
+              ('/lib/python3/concurrent/futures/thread.py', '_worker')], 'idle'),
+            ([('/app_mailing/services.py', 'post'), ('/lib/python3/threading.py', 'run')], 'other'),
+            ([('/lib/python3/threading.py', 'wait'), ('/app_mailing/tasks.py', 'send_messages')], 'wait'),
+        ]
+        for stack, bucket in cases:
+            self.assertEqual(TaskProfiler.classify(stack), bucket)
@@ -0,0 +1,90 @@
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+import logging
+import os
+import requests
+import threading
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+class ProbeTransport:
+    """Пул keep-alive соединений к стороннему API, один на процесс воркера"""
+
+    def __init__(self, pool_connections: int = None, pool_maxsize: int = None):
+        self.__pool_connections = pool_connections or settings.PROBE_SERVER_POOL_CONNECTIONS
+        self.__pool_maxsize = pool_maxsize or settings.PROBE_SERVER_POOL_MAXSIZE
+        self.__lock = threading.Lock()
+        self.__pid = None
+        self.__session = None
+        self.__adapter = None
+        self.__reported = {}
+
+    @property
+    def session(self) -> requests.Session:
+        """Сессия текущего процесса, пересоздается после fork"""
+        if self.__pid != os.getpid():
+            with self.__lock:
+                if self.__pid != os.getpid():
+                    self._open()
+        return self.__session
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.session.post(url, **kwargs)
+
+    def close(self) -> None:
+        """Закрыть соединения пула"""
+        if self.__session is not None:
+            self.__session.close()
+        self.__session = None
+        self.__adapter = None
+        self.__reported = {}
+        self.__pid = None
+
+    def reset(self) -> None:
+        """Сбросить пул, унаследованный от родительского процесса"""
+        # Сокеты родителя не закрываем: они используются родительским процессом
+        self.__session = None
+        self.__adapter = None
+        self.__reported = {}
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+    def stats(self) -> Dict[str, int]:
+        """Количество открытых и повторно использованных соединений"""
+        opened = requests_cnt = 0
+        if self.__adapter is not None:
+            pools = self.__adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    opened += pool.num_connections
+                    requests_cnt += pool.num_requests
+        return {'opened': opened, 'reused': max(requests_cnt - opened, 0), 'requests': requests_cnt}
+
+    def pop_stats(self) -> Dict[str, int]:
+        """Прирост счетчиков stats с предыдущего вызова (для метрик)"""
+        with self.__lock:
+            stats = self.stats()
+            delta = {key: max(value - self.__reported.get(key, 0), 0) for key, value in stats.items()}
+            self.__reported = stats
+        return delta
+
+    def _open(self) -> None:
+        self.__adapter = HTTPAdapter(pool_connections=self.__pool_connections,
+                                     pool_maxsize=self.__pool_maxsize, pool_block=True)
+        session = requests.Session()
+        session.mount('http://', self.__adapter)
+        session.mount('https://', self.__adapter)
+        self.__session = session
+        self.__reported = {}
+        self.__pid = os.getpid()
+        logger.info(f'[pid={self.__pid}]: open probe server connection pool, '
+                    f'maxsize={self.__pool_maxsize}')
+
+
+transport = ProbeTransport()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=transport.reset)
@@ -1,22 +1,33 @@
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, HttpResponseForbidden, StreamingHttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.permissions import IsAdminUser
+from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import status, serializers
+import hmac
+import json
 import logging
+from . import metrics
 from .models import Mailing
-from .serializers import MailingSerializer, StatisticsSerializer, StatisticsDetailSerializer
-from .services import TaskMailing, Statistic
-from app_user.paginations import CustomPagination
+from .serializers import MailingSerializer, StatisticsSerializer, StatisticsDetailSerializer, \
+    MessageSerializer, MessageFilterSerializer, StatisticsExportSerializer, TimeseriesFilterSerializer, \
+    TimeseriesSerializer, BreakdownFilterSerializer, BreakdownSerializer
+from .services import TaskMailing, Statistic, StatisticRollup, MailingBreakdownDB, iter_csv_gzip
+from app_user.paginations import CustomPagination, CursorPaginationMixin, MessageCursorPagination
 
 logger = logging.getLogger(__name__)
 
 
-class MailingViewSet(ModelViewSet):
+class MailingViewSet(CursorPaginationMixin, ModelViewSet):
     """Управление рассылками"""
     queryset = Mailing.objects.all()
     serializer_class = MailingSerializer
     permission_classes = (IsAdminUser,)
     pagination_class = CustomPagination
+    cursor_ordering = '-id'
 
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -43,11 +54,12 @@ class MailingViewSet(ModelViewSet):
             )
 
 
-class StatisticsViewSet(ReadOnlyModelViewSet):
+class StatisticsViewSet(CursorPaginationMixin, ReadOnlyModelViewSet):
     """Статистика по рассылкам"""
     serializer_class = StatisticsSerializer
     permission_classes = (IsAdminUser,)
     pagination_class = CustomPagination
+    cursor_ordering = '-id'
 
     def get_queryset(self):
         if self.kwargs.get('pk'):
@@ -57,4 +69,90 @@ class StatisticsViewSet(ReadOnlyModelViewSet):
     def get_serializer_class(self):
         if self.action == 'retrieve':
             return StatisticsDetailSerializer
+        if self.action == 'messages':
+            return MessageSerializer
         return super().get_serializer_class()
+
+    @action(methods=['get'], detail=True)
+    def messages(self, request, pk=None):
+        """Сообщения рассылки: keyset-пагинация или NDJSON-поток (?stream=1)"""
+        mailing = self.get_object()
+        filters = MessageFilterSerializer(data=request.query_params)
+        filters.is_valid(raise_exception=True)
+        queryset = Statistic.get_queryset_messages(mailing.id, **filters.validated_data)
+
+        if request.query_params.get('stream') in ('1', 'true'):
+            logger.info(f'[mailing_id={mailing.id}]: stream messages')
+            rows = Statistic.iter_messages(queryset)
+            response = StreamingHttpResponse(
+                (json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in rows),
+                content_type='application/x-ndjson'
+            )
+            return response
+
+        paginator = MessageCursorPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = self.get_serializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(methods=['get'], detail=False)
+    def timeseries(self, request):
+        """Почасовая статистика всех рассылок"""
+        return self._timeseries(request)
+
+    @action(methods=['get'], detail=True, url_path='timeseries')
+    def mailing_timeseries(self, request, pk=None):
+        """Почасовая статистика рассылки"""
+        return self._timeseries(request, self.get_object().id)
+
+    @action(methods=['get'], detail=True)
+    def breakdown(self, request, pk=None):
+        """Сообщения рассылки по коду оператора и тэгу (обновляется по расписанию)"""
+        mailing = self.get_object()
+        filters = BreakdownFilterSerializer(data=request.query_params)
+        filters.is_valid(raise_exception=True)
+        data = MailingBreakdownDB.get_queryset(mailing.id, **filters.validated_data)
+        return Response({
+            'refreshed_at': MailingBreakdownDB.get_refreshed_at(),
+            'results': BreakdownSerializer(data, many=True).data
+        })
+
+    @staticmethod
+    def _timeseries(request, mailing_id: int = None) -> Response:
+        filters = TimeseriesFilterSerializer(data=request.query_params)
+        filters.is_valid(raise_exception=True)
+        data = StatisticRollup.get_timeseries(mailing_id=mailing_id, **filters.validated_data)
+        return Response(TimeseriesSerializer(data, many=True).data)
+
+    @action(methods=['get'], detail=False)
+    def export(self, request):
+        """Выгрузка статистики за период в CSV (gzip) потоком"""
+        period = StatisticsExportSerializer(data=request.query_params)
+        period.is_valid(raise_exception=True)
+        date_from = period.validated_data['date_from']
+        date_to = period.validated_data.get('date_to')
+        queryset = Statistic.get_queryset_period(date_from, date_to)
+
+        filename = f'statistics_{date_from:%d-%m-%Y}'
+        if date_to is not None:
+            filename += f'_{date_to:%d-%m-%Y}'
+        logger.info(f'export statistics, date_from={date_from}, date_to={date_to}')
+
+        response = StreamingHttpResponse(iter_csv_gzip(queryset, Statistic.list_fields),
+                                         content_type='application/gzip')
+        response['Content-Disposition'] = f'attachment; filename="{filename}.csv.gz"'
+        return response
+
+
+def metrics_view(request):
+    """Метрики отправки в текстовом формате Prometheus: для админа (сессия) или по токену
+    PROMETHEUS_METRICS_TOKEN в заголовке Authorization: Bearer <token>"""
+    if not (request.user.is_staff or is_metrics_token_valid(request.headers.get('Authorization', ''))):
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(metrics.get_registry()), content_type=CONTENT_TYPE_LATEST)
+
+
+def is_metrics_token_valid(authorization: str) -> bool:
+    token = settings.PROMETHEUS_METRICS_TOKEN
+    scheme, _, value = authorization.partition(' ')
+    return bool(token) and scheme == 'Bearer' and hmac.compare_digest(value.encode(), token.encode())
@@ -0,0 +1,62 @@
+from rest_framework import serializers
+from rest_framework.filters import BaseFilterBackend
+from .models import OperatorCode
+
+
+class CommaSeparatedField(serializers.ListField):
+    """Список значений через запятую: ?tag=1,2"""
+
+    def to_internal_value(self, data):
+        if isinstance(data, list) and len(data) == 1:
+            data = data[0]
+        if isinstance(data, str):
+            data = [value for value in data.split(',') if value]
+        return super().to_internal_value(data)
+
+
+class ClientFilterSerializer(serializers.Serializer):
+    phone = serializers.RegexField(r'^7\d{0,10}$', max_length=11, required=False,
+                                   error_messages={'invalid': 'Phone prefix must be digits starting with 7'})
+    tag = CommaSeparatedField(child=serializers.IntegerField(min_value=1), required=False)
+    code = CommaSeparatedField(child=serializers.RegexField(r'^\d{3}$'), required=False)
+    time_zone = serializers.CharField(max_length=100, required=False)
+    id_min = serializers.IntegerField(min_value=1, required=False)
+    id_max = serializers.IntegerField(min_value=1, required=False)
+
+    def validate(self, data):
+        id_min = data.get('id_min')
+        id_max = data.get('id_max')
+
+        if id_min and id_max and id_min > id_max:
+            raise serializers.ValidationError('id_max must be greater than or equal to the id_min')
+        return data
+
+
+class ClientFilterBackend(BaseFilterBackend):
+    """Фильтры клиентов: префикс телефона, тэги, коды оператора, часовой пояс, диапазон id"""
+
+    def filter_queryset(self, request, queryset, view):
+        if view.action != 'list':
+            return queryset
+
+        filters = ClientFilterSerializer(data=request.query_params)
+        filters.is_valid(raise_exception=True)
+        data = filters.validated_data
+
+        # LIKE 'префикс%' по индексу varchar_pattern_ops, который Django создает для unique phone
+        if data.get('phone'):
+            queryset = queryset.filter(phone__startswith=data['phone'])
+        if data.get('tag'):
+            queryset = queryset.filter(tag_id__in=data['tag'])
+        if data.get('code'):
+            # id кодов отдельным запросом: с константами планировщик читает client_code_tag_idx
+            # уже в порядке id, без сортировки всех подходящих строк
+            code_ids = list(OperatorCode.objects.filter(code__in=data['code']).values_list('id', flat=True))
+            queryset = queryset.filter(code_id__in=code_ids)
+        if data.get('time_zone'):
+            queryset = queryset.filter(time_zone=data['time_zone'])
+        if data.get('id_min'):
+            queryset = queryset.filter(id__gte=data['id_min'])
+        if data.get('id_max'):
+            queryset = queryset.filter(id__lte=data['id_max'])
+        return queryset
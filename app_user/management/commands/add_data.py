@@ -1,41 +1,200 @@
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+import bisect
+import csv
+import io
+import itertools
 import random
-from typing import List
-from app_user.models import Client, OperatorCode, Tag
+import time
+from typing import Dict, Iterable, Iterator, List, Tuple
+from app_user.models import Client, Tag
+from app_user.services import OperatorCodeDB
+from app_user.validators import get_time_zones
+from app_mailing.models import Mailing, Message
+from app_mailing.services import MailingStatsDB
 
 
 class Command(BaseCommand):
-    help = 'add 9000 clients,10 codes and 10 tags'
+    help = 'add synthetic clients, codes, tags and historical mailings with messages (COPY, re-runnable)'
+    # Шаг перестановки номеров внутри кода: взаимно прост с 10^7, номера не повторяются
+    number_space = 10 ** 7
+    number_stride = 7_368_787
+    statuses = {'sent': 1, 'failed': 0, 'pending': None}
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=9000, help='clients to generate')
+        parser.add_argument('--tags', type=int, default=10, help='tags tag1..tagN')
+        parser.add_argument('--codes', type=int, default=10, help='operator codes')
+        parser.add_argument('--code-start', type=int, default=501, help='first operator code')
+        parser.add_argument('--code-distribution', default='uniform',
+                            help='clients by code: uniform or zipf:<exponent>')
+        parser.add_argument('--tag-distribution', default='uniform',
+                            help='clients by tag: uniform or zipf:<exponent>')
+        parser.add_argument('--untagged', type=float, default=0, help='share of clients without tag')
+        parser.add_argument('--time-zones', default='Europe/Minsk:1',
+                            help='time zone weights, e.g. Europe/Minsk:7,Europe/Moscow:2,Asia/Tokyo:1')
+        parser.add_argument('--mailings', type=int, default=0, help='historical mailings')
+        parser.add_argument('--messages', type=int, default=1000, help='messages per mailing')
+        parser.add_argument('--days', type=int, default=30, help='spread mailings over last N days')
+        parser.add_argument('--status-mix', default='sent:0.92,failed:0.08',
+                            help='message status weights: sent, failed, pending')
+        parser.add_argument('--seed', type=int, default=0, help='random seed, same seed gives the same data')
+        parser.add_argument('--chunk-size', type=int, default=100000, help='rows per COPY')
 
     def handle(self, *args, **options):
-        tags = self._add_tags()
-        codes = self._add_codes()
-        self._add_client(codes, tags)
-
-    def _add_tags(self) -> List:
-        tags = []
-        for i in range(1, 11):
-            tags.append(Tag(name=f'tag{i}', description=f'Description{i}'))
-        Tag.objects.bulk_create(tags)
-        self.stdout.write(self.style.SUCCESS('Added tags successfully'))
-        return tags
-
-    def _add_codes(self) -> List:
-        codes = []
-        code = 500
-        for i in range(1, 11):
-            codes.append(OperatorCode(code=f'{code + i}'))
-        OperatorCode.objects.bulk_create(codes)
-        self.stdout.write(self.style.SUCCESS('Added operator codes successfully'))
-        return codes
-
-    def _add_client(self, codes: List, tags: List) -> None:
-        clients = []
-        for i in range(1000, 10000):
-            code = random.choice(codes)
-            tag = random.choice(tags)
-            client = Client(phone=f'7{code.code}567{i}', code=code,
-                            tag=tag, time_zone='Europe/Minsk')
-            clients.append(client)
-        Client.objects.bulk_create(clients)
-        self.stdout.write(self.style.SUCCESS('Added clients successfully'))
+        if connection.vendor != 'postgresql':
+            raise CommandError('PostgreSQL is required')
+
+        self.__random = random.Random(options['seed'])
+        self.__chunk_size = options['chunk_size']
+        time_zones = self._parse_weights(options['time_zones'])
+        unknown = set(time_zones) - get_time_zones()
+        if unknown:
+            raise CommandError(f'Unknown time zones: {", ".join(sorted(unknown))}')
+        status_mix = self._parse_weights(options['status_mix'])
+        if set(status_mix) - self.statuses.keys():
+            raise CommandError('Status mix keys must be sent, failed, pending')
+
+        tags = self._add_tags(options['tags'])
+        codes = self._add_codes(options['codes'], options['code_start'])
+        self._add_clients(options['clients'], options['seed'],
+                          codes, self._get_weights(options['code_distribution'], len(codes)),
+                          tags, self._get_weights(options['tag_distribution'], len(tags)),
+                          options['untagged'], time_zones)
+        if options['mailings']:
+            self._add_mailings(options['mailings'], options['messages'], options['days'], status_mix)
+
+    @staticmethod
+    def _parse_weights(value: str) -> Dict[str, float]:
+        try:
+            return {key: float(weight) for key, weight in (item.rsplit(':', 1) for item in value.split(','))}
+        except ValueError:
+            raise CommandError(f'Invalid weights "{value}", expected name:weight,...')
+
+    @staticmethod
+    def _get_weights(distribution: str, count: int) -> List[float]:
+        if distribution == 'uniform':
+            return [1.0] * count
+        name, _, exponent = distribution.partition(':')
+        if name != 'zipf' or not exponent:
+            raise CommandError(f'Unknown distribution "{distribution}"')
+        return [1 / (rank ** float(exponent)) for rank in range(1, count + 1)]
+
+    def _add_tags(self, count: int) -> List[int]:
+        Tag.objects.bulk_create((Tag(name=f'tag{i}', description=f'Description{i}') for i in range(1, count + 1)),
+                                ignore_conflicts=True)
+        tags = dict(Tag.objects.filter(name__in=[f'tag{i}' for i in range(1, count + 1)]).values_list('name', 'id'))
+        self.stdout.write(self.style.SUCCESS(f'Tags: {len(tags)}'))
+        return [tags[f'tag{i}'] for i in range(1, count + 1)]
+
+    def _add_codes(self, count: int, start: int) -> List[Tuple[str, int]]:
+        if count < 1 or start < 100 or start + count > 1000:
+            raise CommandError('Operator codes must be three digits')
+        codes = OperatorCodeDB.get_or_create_codes(str(code) for code in range(start, start + count))
+        self.stdout.write(self.style.SUCCESS(f'Operator codes: {len(codes)}'))
+        return sorted((code, obj.id) for code, obj in codes.items())
+
+    def _add_clients(self, count: int, seed: int, codes: List[Tuple[str, int]], code_weights: List[float],
+                     tags: List[int], tag_weights: List[float], untagged: float,
+                     time_zones: Dict[str, float]) -> None:
+        if max(code_weights) / sum(code_weights) * count > self.number_space:
+            raise CommandError('Too many clients for operator codes, add --codes')
+
+        rnd = self.__random
+        offset = random.Random(f'phones-{seed}').randrange(self.number_space)
+        counters = [0] * len(codes)
+        code_weights = list(itertools.accumulate(code_weights))
+        tag_weights = list(itertools.accumulate(tag_weights))
+        zone_names = list(time_zones)
+        zone_weights = list(itertools.accumulate(time_zones.values()))
+
+        def pick(items: List, cum_weights: List[float]):
+            return items[bisect.bisect(cum_weights, rnd.random() * cum_weights[-1])]
+
+        def rows() -> Iterator[Tuple]:
+            for _ in range(count):
+                code_index = pick(range(len(codes)), code_weights)
+                code, code_id = codes[code_index]
+                number = (offset + counters[code_index] * self.number_stride) % self.number_space
+                counters[code_index] += 1
+                tag_id = None if not tags or rnd.random() < untagged else pick(tags, tag_weights)
+                yield f'7{code}{number:07d}', code_id, tag_id, pick(zone_names, zone_weights)
+
+        start = time.monotonic()
+        added = self._copy(rows(), Client._meta.db_table, ('phone', 'code_id', 'tag_id', 'time_zone'),
+                           'ON CONFLICT (phone) DO NOTHING')
+        self.stdout.write(self.style.SUCCESS(f'Clients: {added} added of {count} '
+                                             f'in {time.monotonic() - start:.1f} s'))
+
+    def _add_mailings(self, count: int, messages: int, days: int, status_mix: Dict[str, float]) -> None:
+        rnd = self.__random
+        bounds = Client.objects.order_by().values_list('id', flat=True)
+        min_id, max_id = bounds.order_by('id').first(), bounds.order_by('-id').first()
+        if min_id is None:
+            raise CommandError('No clients to send messages to')
+
+        now = timezone.now()
+        mailings = []
+        for i in range(count):
+            start_date = now - timezone.timedelta(seconds=rnd.uniform(86400, days * 86400))
+            mailings.append(Mailing(start_date=start_date, finish_date=start_date + timezone.timedelta(days=1),
+                                    text=f'Synthetic mailing {i + 1}', status=2))
+        mailings = Mailing.objects.bulk_create(mailings)
+
+        status_names = list(status_mix)
+        status_weights = list(itertools.accumulate(status_mix.values()))
+        max_attempts = settings.MESSAGE_MAX_ATTEMPTS
+
+        def rows() -> Iterator[Tuple]:
+            for mailing in mailings:
+                size = min(messages, max_id - min_id + 1)
+                for client_id in rnd.sample(range(min_id, max_id + 1), size):
+                    name = status_names[bisect.bisect(status_weights, rnd.random() * status_weights[-1])]
+                    status = self.statuses[name]
+                    if status is None:
+                        yield mailing.start_date, None, mailing.id, client_id, 0, None
+                        continue
+                    send_date = mailing.start_date + timezone.timedelta(seconds=rnd.expovariate(1 / 60))
+                    attempts = 1 + int(rnd.expovariate(3)) if status == 1 else max_attempts
+                    yield send_date, status, mailing.id, client_id, min(attempts, max_attempts), send_date
+
+        start = time.monotonic()
+        # Пропуски id клиентов отсекаются соединением с таблицей клиентов
+        added = self._copy(rows(), Message._meta.db_table,
+                           ('send_date', 'status', 'mailing_id', 'client_id', 'attempts', 'processed_at'),
+                           join=(Client._meta.db_table, 'client_id'))
+        MailingStatsDB.rebuild([mailing.id for mailing in mailings])
+        self.stdout.write(self.style.SUCCESS(f'Mailings: {count}, messages: {added} '
+                                             f'in {time.monotonic() - start:.1f} s'))
+
+    def _copy(self, rows: Iterable[Tuple], table: str, columns: Tuple[str, ...], on_conflict: str = '',
+              join: Tuple[str, str] = None) -> int:
+        """COPY частями во временную таблицу и INSERT ... SELECT в целевую, вернуть число вставленных строк"""
+        qn = connection.ops.quote_name
+        staging = qn(f'{table}_staging')
+        column_list = ', '.join(qn(column) for column in columns)
+        select = ', '.join(f's.{qn(column)}' for column in columns)
+        join_sql = f'JOIN {qn(join[0])} AS j ON j.id = s.{qn(join[1])} ' if join else ''
+        added = 0
+
+        iterator = iter(rows)
+        while True:
+            chunk = list(itertools.islice(iterator, self.__chunk_size))
+            if not chunk:
+                break
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(chunk)
+            buffer.seek(0)
+
+            with transaction.atomic(), connection.cursor() as cursor:
+                # Только типы столбцов, без ограничений и значений по умолчанию (последовательности id)
+                cursor.execute(f'CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DELETE ROWS '
+                               f'AS SELECT {column_list} FROM {qn(table)} WITH NO DATA')
+                cursor.execute(f'TRUNCATE {staging}')
+                cursor.copy_expert(f'COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT csv)', buffer)
+                cursor.execute(f'INSERT INTO {qn(table)} ({column_list}) SELECT {select} FROM {staging} AS s '
+                               f'{join_sql}{on_conflict}')
+                added += cursor.rowcount
+        return added
@@ -11,8 +11,9 @@ class Client(models.Model):
                     RegexValidator(r'7\d{10}',
                                    message='The phone number must be in the format 7ХХХХХХХХ')]
     )
-    code = models.ForeignKey('OperatorCode', on_delete=models.PROTECT, related_name='client')
-    tag = models.ForeignKey('Tag', on_delete=models.SET_NULL, null=True, related_name='client')
+    # Индексы по code и tag заменяют составные индексы из Meta.indexes
+    code = models.ForeignKey('OperatorCode', on_delete=models.PROTECT, related_name='client', db_index=False)
+    tag = models.ForeignKey('Tag', on_delete=models.SET_NULL, null=True, related_name='client', db_index=False)
     time_zone = models.CharField(max_length=100, validators=[validate_time_zone])
 
     def __str__(self):
@@ -20,6 +21,13 @@ class Client(models.Model):
 
     class Meta:
         ordering = ['id']
+        indexes = [
+            # Выбор клиентов рассылки: code IN (...) AND tag IN (...) по диапазонам id
+            models.Index(fields=['code', 'tag', 'id'], name='client_code_tag_idx'),
+            # Фильтры списка клиентов с сортировкой по id
+            models.Index(fields=['tag', 'id'], name='client_tag_idx'),
+            models.Index(fields=['time_zone', 'id'], name='client_time_zone_idx'),
+        ]
 
 
 class OperatorCode(models.Model):
@@ -43,3 +51,30 @@ class Tag(models.Model):
 
     class Meta:
         ordering = ['id']
+
+
+class ClientImport(models.Model):
+    """Загрузка клиентов из файла"""
+    STATUS_CHOICES = ((0, 'PENDING'), (1, 'STARTED'), (2, 'SUCCESS'), (3, 'FAILURE'))
+    FORMAT_CHOICES = (('csv', 'CSV'), ('ndjson', 'NDJSON'))
+
+    file = models.CharField(max_length=255, editable=False)
+    file_format = models.CharField(max_length=10, choices=FORMAT_CHOICES)
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, default=0)
+    bytes_total = models.BigIntegerField(default=0)
+    bytes_read = models.BigIntegerField(default=0)
+    rows_total = models.IntegerField(default=0)
+    rows_created = models.IntegerField(default=0)
+    rows_updated = models.IntegerField(default=0)
+    rows_rejected = models.IntegerField(default=0)
+    rejected_file = models.CharField(max_length=255, blank=True, editable=False)
+    error = models.TextField(blank=True)
+    task_uuid = models.UUIDField(null=True, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.id}: {self.file}'
+
+    class Meta:
+        ordering = ['-id']
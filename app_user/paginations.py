@@ -1,7 +1,74 @@
-from rest_framework.pagination import PageNumberPagination
+from django.db import connections
+from django.db.models.query import QuerySet
+from rest_framework.pagination import PageNumberPagination, CursorPagination
+from collections import OrderedDict
+import json
 
 
 class CustomPagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
     max_page_size = 100
+
+
+def get_estimated_count(queryset: QuerySet) -> int:
+    """Оценка количества строк по статистике планировщика (EXPLAIN) вместо COUNT(*)"""
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class CursorIdPagination(CursorPagination):
+    """Keyset-пагинация по id без COUNT(*) и OFFSET; count=estimate - оценка общего количества.
+    Порядок задается атрибутом cursor_ordering представления"""
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = 'id'
+    count_query_param = 'count'
+
+    def get_ordering(self, request, queryset, view):
+        return (getattr(view, 'cursor_ordering', self.ordering),)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.estimated_count = None
+        if request.query_params.get(self.count_query_param) == 'estimate':
+            self.estimated_count = get_estimated_count(queryset)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.estimated_count is not None:
+            response.data = OrderedDict([('count', self.estimated_count), *response.data.items()])
+        return response
+
+
+class MessageCursorPagination(CursorIdPagination):
+    """Keyset-пагинация по id: стоимость страницы не зависит от ее номера"""
+    page_size = 100
+    max_page_size = 1000
+    ordering = '-id'
+
+    def get_ordering(self, request, queryset, view):
+        return (self.ordering,)
+
+
+class CursorPaginationMixin:
+    """Списки с ?pagination=cursor используют CursorIdPagination вместо pagination_class"""
+    cursor_pagination_class = CursorIdPagination
+    cursor_ordering = 'id'
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator') and self.request is not None and \
+                self.request.query_params.get('pagination') == 'cursor':
+            self._paginator = self.cursor_pagination_class()
+        return super().paginator
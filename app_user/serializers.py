@@ -1,9 +1,14 @@
+from django.conf import settings
 from django.db import transaction
 from django.forms import model_to_dict
 from rest_framework import serializers
 import logging
-from .models import Client, OperatorCode, Tag
+from pathlib import Path
+import uuid
+from .models import Client, ClientImport, OperatorCode, Tag
 from .services import OperatorCodeDB
+from .tasks import import_clients
+from .validators import validate_time_zone
 
 logger = logging.getLogger(__name__)
 
@@ -41,3 +46,48 @@ class TagSerializer(serializers.ModelSerializer):
     class Meta:
         model = Tag
         fields = '__all__'
+
+
+class ClientBulkItemSerializer(serializers.Serializer):
+    """Клиент в массовой загрузке: проверки без запросов к БД"""
+    phone = serializers.CharField(max_length=11, validators=Client._meta.get_field('phone').validators)
+    tag = serializers.IntegerField(min_value=1, allow_null=True, required=False)
+    time_zone = serializers.CharField(max_length=100, validators=[validate_time_zone])
+
+
+class ClientImportSerializer(serializers.ModelSerializer):
+    upload = serializers.FileField(write_only=True)
+    file_format = serializers.ChoiceField(choices=ClientImport.FORMAT_CHOICES, required=False)
+    extensions = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+
+    class Meta:
+        model = ClientImport
+        fields = ('id', 'upload', 'file_format', 'status', 'bytes_total', 'bytes_read', 'rows_total',
+                  'rows_created', 'rows_updated', 'rows_rejected', 'error', 'created_at', 'finished_at')
+        read_only_fields = ('status', 'bytes_total', 'bytes_read', 'rows_total', 'rows_created',
+                            'rows_updated', 'rows_rejected', 'error', 'created_at', 'finished_at')
+
+    def validate(self, data):
+        name = Path(data['upload'].name)
+        suffixes = name.with_suffix('').suffixes if name.suffix == '.gz' else name.suffixes
+        file_format = data.get('file_format') or self.extensions.get(suffixes[-1] if suffixes else '')
+        if file_format is None:
+            raise serializers.ValidationError('Unknown file format, set file_format: csv or ndjson')
+        data['file_format'] = file_format
+        return data
+
+    def create(self, validated_data):
+        upload = validated_data.pop('upload')
+        suffix = '.gz' if upload.name.endswith('.gz') else ''
+        file = settings.FOLDER_IMPORTS / f'{uuid.uuid4()}.{validated_data["file_format"]}{suffix}'
+        with open(file, 'wb') as destination:
+            for chunk in upload.chunks():
+                destination.write(chunk)
+
+        client_import = ClientImport.objects.create(file=str(file), bytes_total=upload.size, **validated_data)
+        logger.info(f'[import_id={client_import.id}]: upload file {upload.name}, size={upload.size}')
+
+        task = import_clients.apply_async(kwargs={'import_id': client_import.id})
+        client_import.task_uuid = task.id
+        client_import.save(update_fields=['task_uuid'])
+        return client_import
@@ -1,6 +1,17 @@
+from django.conf import settings
+from django.db import connection, transaction
+from rest_framework import serializers
 from django.forms import model_to_dict
+from pathlib import Path
+import csv
+import gzip
+import io
+import json
 import logging
-from .models import OperatorCode, Client
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+from .models import OperatorCode, Client, ClientImport, Tag
+from .validators import get_time_zones
 
 logger = logging.getLogger(__name__)
 
@@ -9,9 +20,27 @@ class OperatorCodeDB:
     """Работа с таблицей operatorcode"""
 
     def __init__(self, phone: str, client: Client = None):
-        self.__code_new = phone[1:4]
+        self.__code_new = self.get_code(phone)
         self.__client = client
 
+    @staticmethod
+    def get_code(phone: str) -> str:
+        """Код оператора из номера телефона"""
+        return phone[1:4]
+
+    @staticmethod
+    def get_or_create_codes(codes: Iterable[str]) -> Dict[str, OperatorCode]:
+        """Получить или создать коды оператора одним запросом и одной вставкой"""
+        codes = set(codes)
+        result = {code.code: code for code in OperatorCode.objects.filter(code__in=codes)}
+        missing = codes - result.keys()
+        if missing:
+            OperatorCode.objects.bulk_create((OperatorCode(code=code) for code in missing), ignore_conflicts=True)
+            for code in OperatorCode.objects.filter(code__in=missing):
+                result[code.code] = code
+            logger.info(f'create operator codes, params: {sorted(missing)}')
+        return result
+
     def get_or_create_operator_code(self) -> OperatorCode:
         """Получить или создать объект"""
         code, created = OperatorCode.objects.get_or_create(code=self.__code_new)
@@ -21,6 +50,209 @@ class OperatorCodeDB:
 
     def get_operator_code(self) -> OperatorCode:
         """Получить объект"""
-        if self.__client.phone[1:4] == self.__code_new:
+        if self.get_code(self.__client.phone) == self.__code_new:
             return self.__client.code
         return self.get_or_create_operator_code()
+
+
+class ClientBulkValidator:
+    """Проверка списка клиентов для массовой загрузки: корректные строки сохраняются,
+    ошибки возвращаются по индексам строк"""
+
+    def __init__(self, data):
+        self.__data = data
+
+    def validate(self) -> Tuple[List[Dict], List[Dict]]:
+        # serializers импортирует services
+        from .serializers import ClientBulkItemSerializer
+
+        if not isinstance(self.__data, list):
+            raise serializers.ValidationError('Expected a list of clients')
+        if len(self.__data) > settings.CLIENT_BULK_MAX_SIZE:
+            raise serializers.ValidationError(f'No more than {settings.CLIENT_BULK_MAX_SIZE} clients per request')
+
+        rows, errors = [], []
+        phones = set()
+        for index, item in enumerate(self.__data):
+            serializer = ClientBulkItemSerializer(data=item)
+            if not serializer.is_valid():
+                errors.append({'index': index, 'errors': serializer.errors})
+            elif serializer.validated_data['phone'] in phones:
+                errors.append({'index': index, 'errors': {'phone': ['Duplicate phone in request']}})
+            else:
+                phones.add(serializer.validated_data['phone'])
+                rows.append((index, serializer.validated_data))
+
+        # Тэги проверяются одним запросом
+        tag_ids = {row['tag'] for _, row in rows if row.get('tag')}
+        missing_tags = tag_ids - set(Tag.objects.filter(id__in=tag_ids).values_list('id', flat=True))
+        if missing_tags:
+            for index, row in rows:
+                if row.get('tag') in missing_tags:
+                    error = f'Invalid pk "{row["tag"]}" - object does not exist.'
+                    errors.append({'index': index, 'errors': {'tag': [error]}})
+            rows = [(index, row) for index, row in rows if row.get('tag') not in missing_tags]
+
+        errors.sort(key=lambda error: error['index'])
+        return [row for _, row in rows], errors
+
+
+class ClientBulkDB:
+    """Массовое создание и обновление клиентов по номеру телефона"""
+
+    def __init__(self, batch_size: int = None):
+        self.__batch_size = batch_size or settings.CLIENT_BULK_BATCH_SIZE
+
+    def save(self, rows: List[Dict]) -> Tuple[int, int]:
+        """Upsert проверенных строк (phone, tag, time_zone), вернуть количество созданных и обновленных"""
+        created = updated = 0
+        qn = connection.ops.quote_name
+        with transaction.atomic(), connection.cursor() as cursor:
+            codes = OperatorCodeDB.get_or_create_codes(OperatorCodeDB.get_code(row['phone']) for row in rows)
+            for start in range(0, len(rows), self.__batch_size):
+                batch = rows[start:start + self.__batch_size]
+                params = [value for row in batch
+                          for value in (row['phone'], codes[OperatorCodeDB.get_code(row['phone'])].id,
+                                        row.get('tag'), row['time_zone'])]
+                # xmax = 0 у вставленной строки: счетчики берутся из самого upsert
+                cursor.execute(
+                    f'INSERT INTO {qn(Client._meta.db_table)} (phone, code_id, tag_id, time_zone) '
+                    f'VALUES {", ".join(["(%s, %s, %s::bigint, %s)"] * len(batch))} '
+                    f'ON CONFLICT (phone) DO UPDATE SET tag_id = EXCLUDED.tag_id, time_zone = EXCLUDED.time_zone '
+                    f'RETURNING (xmax = 0)',
+                    params
+                )
+                inserted = sum(row[0] for row in cursor.fetchall())
+                created += inserted
+                updated += len(batch) - inserted
+        logger.info(f'bulk save clients, created={created}, updated={updated}')
+        return created, updated
+
+
+class ClientFileImport:
+    """Загрузка клиентов из файла CSV/NDJSON (можно .gz) частями:
+    COPY частей во временную таблицу и слияние с таблицей клиентов"""
+    staging_table = 'client_import_staging'
+    rejected_fields = ('line', 'error', 'data')
+    phone_re = re.compile(r'7\d{10}')
+
+    def __init__(self, client_import: ClientImport, chunk_size: int = None):
+        self.__import = client_import
+        self.__chunk_size = chunk_size or settings.CLIENT_IMPORT_CHUNK_SIZE
+        self.__codes: Dict[str, int] = {}
+        self.__tags: Dict[str, int] = {}
+
+    def run(self) -> None:
+        client_import = self.__import
+        path = Path(client_import.file)
+        rejected_path = settings.FOLDER_IMPORTS / f'{client_import.id}_rejected.csv'
+        client_import.rejected_file = str(rejected_path)
+        client_import.bytes_total = path.stat().st_size
+        self.__tags = dict(Tag.objects.values_list('name', 'id'))
+        logger.info(f'[import_id={client_import.id}]: start import clients, file={path.name}')
+
+        with open(path, 'rb') as raw, open(rejected_path, 'w', newline='') as rejected_file:
+            rejected = csv.writer(rejected_file)
+            rejected.writerow(self.rejected_fields)
+            stream = gzip.GzipFile(fileobj=raw) if path.suffix == '.gz' else raw
+            text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+
+            chunk = []
+            for line, item in self._iter_items(text):
+                client_import.rows_total += 1
+                row, error = self._normalize(item)
+                if error:
+                    client_import.rows_rejected += 1
+                    rejected.writerow((line, error, item if isinstance(item, str) else
+                                       json.dumps(item, ensure_ascii=False)))
+                    continue
+                chunk.append((line, *row))
+                if len(chunk) >= self.__chunk_size:
+                    rejected_file.flush()
+                    self._save(chunk, raw.tell())
+                    chunk = []
+            rejected_file.flush()
+            self._save(chunk, raw.tell())
+
+        logger.info(f'[import_id={client_import.id}]: finish import clients, total={client_import.rows_total}, '
+                    f'created={client_import.rows_created}, updated={client_import.rows_updated}, '
+                    f'rejected={client_import.rows_rejected}')
+
+    def _iter_items(self, text: io.TextIOWrapper) -> Iterator[Tuple[int, Any]]:
+        """Номер строки и запись файла (dict или исходная строка, если ее не удалось разобрать)"""
+        if self.__import.file_format == 'csv':
+            reader = csv.DictReader(text)
+            for item in reader:
+                yield reader.line_num, item
+            return
+
+        for line, value in enumerate(text, 1):
+            value = value.strip()
+            if not value:
+                continue
+            try:
+                yield line, json.loads(value)
+            except ValueError:
+                yield line, value
+
+    def _normalize(self, item: Any) -> Tuple[Tuple | None, str | None]:
+        """Телефон приводится к 7XXXXXXXXXX, код оператора - как в OperatorCodeDB"""
+        if not isinstance(item, dict):
+            return None, 'Invalid record'
+
+        phone = re.sub(r'\D', '', str(item.get('phone') or ''))
+        if len(phone) == 10:
+            phone = '7' + phone
+        elif len(phone) == 11 and phone[0] == '8':
+            phone = '7' + phone[1:]
+        if not self.phone_re.fullmatch(phone):
+            return None, 'Invalid phone'
+
+        time_zone = str(item.get('time_zone') or '').strip()
+        if time_zone not in get_time_zones():
+            return None, 'Invalid time zone'
+
+        tag = str(item.get('tag') or '').strip()
+        tag_id = None
+        if tag:
+            tag_id = self.__tags.get(tag)
+            if tag_id is None:
+                return None, 'Unknown tag'
+        return (phone, OperatorCodeDB.get_code(phone), tag_id, time_zone), None
+
+    def _save(self, chunk: List[Tuple], bytes_read: int) -> None:
+        """COPY части во временную таблицу, upsert по телефону и сохранение прогресса в одной транзакции"""
+        missing = {row[2] for row in chunk} - self.__codes.keys()
+        if missing:
+            self.__codes.update((code, obj.id) for code, obj in OperatorCodeDB.get_or_create_codes(missing).items())
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for line, phone, code, tag_id, time_zone in chunk:
+            writer.writerow((line, phone, self.__codes[code], '' if tag_id is None else tag_id, time_zone))
+        buffer.seek(0)
+
+        qn = connection.ops.quote_name
+        staging = qn(self.staging_table)
+        table = qn(Client._meta.db_table)
+        client_import = self.__import
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'CREATE TEMP TABLE IF NOT EXISTS {staging} (line bigint, phone varchar(11), '
+                           f'code_id bigint, tag_id bigint, time_zone varchar(100)) ON COMMIT DELETE ROWS')
+            cursor.execute(f'TRUNCATE {staging}')
+            cursor.copy_expert(f'COPY {staging} (line, phone, code_id, tag_id, time_zone) '
+                               f'FROM STDIN WITH (FORMAT csv)', buffer)
+            # При повторе телефона в части побеждает последняя строка файла
+            cursor.execute(
+                f'INSERT INTO {table} (phone, code_id, tag_id, time_zone) '
+                f'SELECT DISTINCT ON (phone) phone, code_id, tag_id, time_zone FROM {staging} '
+                f'ORDER BY phone, line DESC '
+                f'ON CONFLICT (phone) DO UPDATE SET tag_id = EXCLUDED.tag_id, time_zone = EXCLUDED.time_zone '
+                f'RETURNING (xmax = 0)'
+            )
+            inserted = [row[0] for row in cursor.fetchall()]
+            client_import.rows_created += sum(inserted)
+            client_import.rows_updated += len(inserted) - sum(inserted)
+            client_import.bytes_read = bytes_read
+            client_import.save(update_fields=['rejected_file', 'bytes_total', 'bytes_read', 'rows_total',
+                                              'rows_created', 'rows_updated', 'rows_rejected'])
@@ -0,0 +1,26 @@
+from django.utils import timezone
+from celery import shared_task
+import logging
+from .models import ClientImport
+from .services import ClientFileImport
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task(name='import_clients')
+def import_clients(import_id: int) -> None:
+    """Загрузка клиентов из файла"""
+    client_import = ClientImport.objects.get(pk=import_id)
+    client_import.status = 1
+    client_import.save(update_fields=['status'])
+
+    try:
+        ClientFileImport(client_import).run()
+    except Exception as exc:
+        client_import.status = 3
+        client_import.error = f'{exc.__class__.__name__}: {exc}'
+        logger.exception(f'[import_id={import_id}]: import clients failed')
+    else:
+        client_import.status = 2
+    client_import.finished_at = timezone.now()
+    client_import.save(update_fields=['status', 'error', 'finished_at'])
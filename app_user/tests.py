@@ -1,12 +1,25 @@
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db.models import Sum
+from django.test import override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase, APIClient
+from pathlib import Path
+from unittest import mock
+import csv
+import gzip
+import io
+import json
 import random
+import tempfile
 import uuid
-from .models import Client, OperatorCode, Tag
-from app_mailing.models import Mailing, Message
+from .models import Client, ClientImport, OperatorCode, Tag
+from .services import ClientBulkDB
+from .tasks import import_clients
+from app_mailing.models import Mailing, MailingStats, Message
 
 
 class AuthAPITestCase(APITestCase):
@@ -159,3 +172,191 @@ class ClientTest(AuthAPITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(len(data.get('phone')), 2)
         self.assertTrue(data.get('time_zone'))
+
+    def test_get_endpoints_client_cursor_pagination(self):
+        client = self._authorization_admin()
+        ids = []
+        url = f'{self.__url_client}?pagination=cursor&page_size=5'
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            ids.extend(row['id'] for row in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(ids, list(Client.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_get_endpoints_client_estimated_count(self):
+        client = self._authorization_admin()
+        response = client.get(self.__url_client, {'pagination': 'cursor', 'count': 'estimate'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsInstance(response.data['count'], int)
+        self.assertGreater(response.data['count'], 0)
+
+    def test_get_endpoints_client_filters(self):
+        client = self._authorization_admin()
+        client_obj = Client.objects.select_related('code').first()
+
+        response = client.get(self.__url_client, {'phone': client_obj.phone[:8], 'page_size': 100})
+        self.assertEqual({row['id'] for row in response.data['results']},
+                         set(Client.objects.filter(phone__startswith=client_obj.phone[:8]).values_list('id', flat=True)))
+
+        params = {'tag': client_obj.tag_id, 'code': client_obj.code.code, 'id_min': client_obj.id,
+                  'time_zone': client_obj.time_zone, 'page_size': 100}
+        response = client.get(self.__url_client, params)
+        expected = Client.objects.filter(tag=client_obj.tag, code=client_obj.code, id__gte=client_obj.id)
+        self.assertEqual([row['id'] for row in response.data['results']],
+                         list(expected.values_list('id', flat=True)))
+
+        response = client.get(self.__url_client, {'tag': ','.join(str(tag.id) for tag in Tag.objects.all()),
+                                                  'id_max': client_obj.id})
+        self.assertEqual([row['id'] for row in response.data['results']], [client_obj.id])
+
+    def test_get_endpoints_client_filters_validation(self):
+        client = self._authorization_admin()
+        for params in ({'phone': '8900'}, {'tag': 'a'}, {'code': '9'}, {'id_min': 5, 'id_max': 1}):
+            response = client.get(self.__url_client, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_post_endpoints_client_bulk(self):
+        client = self._authorization_admin()
+        client_obj = Client.objects.first()
+        tag = Tag.objects.first()
+        data = [
+            {'phone': client_obj.phone, 'tag': tag.id, 'time_zone': 'Asia/Tokyo'},
+            {'phone': '79991234567', 'tag': tag.id, 'time_zone': 'Europe/Minsk'},
+            {'phone': '79991234568', 'tag': None, 'time_zone': 'Europe/Minsk'},
+            {'phone': '69991234569', 'time_zone': 'Europe/Min'},
+            {'phone': '79991234567', 'time_zone': 'Europe/Minsk'},
+            {'phone': '79991234570', 'tag': 1000, 'time_zone': 'Europe/Minsk'},
+        ]
+        code_cnt = OperatorCode.objects.count()
+        response = client.post(reverse('client-bulk'), data=data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['updated']), (2, 1))
+        self.assertEqual([error['index'] for error in response.data['errors']], [3, 4, 5])
+        self.assertEqual(set(response.data['errors'][0]['errors']), {'phone', 'time_zone'})
+
+        client_obj.refresh_from_db()
+        self.assertEqual((client_obj.tag, client_obj.time_zone), (tag, 'Asia/Tokyo'))
+        new_client = Client.objects.get(phone='79991234567')
+        self.assertEqual(new_client.code.code, '999')
+        self.assertEqual(OperatorCode.objects.count(), code_cnt + 1)
+
+    def test_client_bulk_db_counts_from_upsert(self):
+        rows = [{'phone': Client.objects.first().phone, 'tag': None, 'time_zone': 'Asia/Tokyo'},
+                {'phone': '79991234567', 'tag': None, 'time_zone': 'Europe/Minsk'},
+                {'phone': '79991234568', 'tag': Tag.objects.first().id, 'time_zone': 'Europe/Minsk'}]
+        self.assertEqual(ClientBulkDB(batch_size=2).save(rows), (2, 1))
+        self.assertEqual(ClientBulkDB(batch_size=2).save(rows), (0, 3))
+        self.assertEqual(Client.objects.get(phone='79991234568').tag, Tag.objects.first())
+
+    def test_post_endpoints_client_bulk_limit(self):
+        client = self._authorization_admin()
+        with self.settings(CLIENT_BULK_MAX_SIZE=1):
+            response = client.post(reverse('client-bulk'), format='json',
+                                   data=[{'phone': f'7999123456{i}', 'time_zone': 'Europe/Minsk'} for i in range(2)])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ClientImportTest(AuthAPITestCase):
+    __url_import = reverse('clientimport-list')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_users()
+        cls._create_data_clients()
+
+    def setUp(self) -> None:
+        self.folder = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(FOLDER_IMPORTS=Path(self.folder.name), CLIENT_IMPORT_CHUNK_SIZE=2)
+        self.settings_override.enable()
+        self.client_admin = self._authorization_admin()
+
+    def tearDown(self) -> None:
+        self.settings_override.disable()
+        self.folder.cleanup()
+
+    def _upload(self, name: str, content: bytes):
+        with mock.patch('app_user.tasks.import_clients.apply_async') as apply_async:
+            apply_async.side_effect = lambda kwargs: import_clients.apply(kwargs=kwargs)
+            return self.client_admin.post(self.__url_import, {'upload': SimpleUploadedFile(name, content)},
+                                          format='multipart')
+
+    def test_import_csv(self):
+        client_obj = Client.objects.first()
+        tag = Tag.objects.first()
+        content = (
+            'phone,tag,time_zone\n'
+            f'{client_obj.phone},{tag.name},Asia/Tokyo\n'
+            '8 (999) 123-45-67,,Europe/Minsk\n'
+            '9991234568,tag2,Europe/Minsk\n'
+            '123,tag1,Europe/Minsk\n'
+            '79991234569,unknown,Europe/Minsk\n'
+            '79991234570,,Europe/Min\n'
+            '79991234567,tag3,Europe/Minsk\n'
+        ).encode()
+        response = self._upload('clients.csv', content)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client_admin.get(reverse('clientimport-detail', args=[response.data['id']]))
+        data = response.data
+        self.assertEqual(data['status'], 2)
+        self.assertEqual((data['rows_total'], data['rows_rejected']), (7, 3))
+        self.assertEqual((data['rows_created'], data['rows_updated']), (2, 2))
+        self.assertEqual(data['bytes_read'], len(content))
+
+        client_obj.refresh_from_db()
+        self.assertEqual((client_obj.tag, client_obj.time_zone), (tag, 'Asia/Tokyo'))
+        new_client = Client.objects.get(phone='79991234567')
+        self.assertEqual((new_client.code.code, new_client.tag.name), ('999', 'tag3'))
+
+        response = self.client_admin.get(reverse('clientimport-rejected', args=[data['id']]))
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([(row['line'], row['error']) for row in rows],
+                         [('5', 'Invalid phone'), ('6', 'Unknown tag'), ('7', 'Invalid time zone')])
+
+    def test_import_ndjson_gz(self):
+        lines = [json.dumps({'phone': f'7999765432{i}', 'tag': 'tag1', 'time_zone': 'Europe/Minsk'})
+                 for i in range(5)] + ['{broken']
+        response = self._upload('clients.ndjson.gz', gzip.compress('\n'.join(lines).encode()))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        client_import = ClientImport.objects.get(pk=response.data['id'])
+        self.assertEqual((client_import.status, client_import.rows_created, client_import.rows_rejected), (2, 5, 1))
+        self.assertEqual(Client.objects.filter(phone__startswith='7999765432').count(), 5)
+
+    def test_import_unknown_format(self):
+        response = self._upload('clients.txt', b'phone')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AddDataCommandTest(APITestCase):
+    def _call(self, **options) -> None:
+        call_command('add_data', stdout=io.StringIO(), **options)
+
+    def test_add_data_is_deterministic_and_rerunnable(self):
+        options = {'clients': 300, 'tags': 4, 'codes': 3, 'code_start': 901, 'seed': 7,
+                   'code_distribution': 'zipf:1.5', 'time_zones': 'Europe/Minsk:3,Asia/Tokyo:1', 'chunk_size': 100}
+        self._call(**options)
+        phones = set(Client.objects.values_list('phone', flat=True))
+        self.assertEqual(len(phones), 300)
+        self.assertEqual(Tag.objects.count(), 4)
+        counts = {code: Client.objects.filter(code__code=code).count() for code in ('901', '902', '903')}
+        self.assertGreater(counts['901'], counts['903'])
+        self.assertEqual(set(Client.objects.values_list('time_zone', flat=True)), {'Europe/Minsk', 'Asia/Tokyo'})
+
+        self._call(**options)
+        self.assertEqual(set(Client.objects.values_list('phone', flat=True)), phones)
+
+        self._call(**{**options, 'seed': 8})
+        self.assertEqual(Client.objects.count(), 600)
+
+    def test_add_data_mailings(self):
+        self._call(clients=100, mailings=3, messages=50, status_mix='sent:1,failed:1', seed=1)
+        self.assertEqual(Mailing.objects.count(), 3)
+        self.assertEqual(Message.objects.count(), 150)
+        self.assertFalse(Message.objects.filter(status__isnull=True).exists())
+        stats = MailingStats.objects.aggregate(sent=Sum('sent'), failed=Sum('failed'))
+        self.assertEqual(stats['sent'], Message.objects.filter(status=1).count())
+        self.assertEqual(stats['sent'] + stats['failed'], 150)
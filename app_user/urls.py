@@ -1,10 +1,11 @@
 from django.urls import path, include
 from rest_framework import routers
-from .views import ClientViewSet, TagViewSet
+from .views import ClientViewSet, TagViewSet, ClientImportViewSet
 
 router = routers.DefaultRouter()
 router.register('client', ClientViewSet)
 router.register('tag', TagViewSet)
+router.register('client-import', ClientImportViewSet)
 
 urlpatterns = [
     path('', include(router.urls))
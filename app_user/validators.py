@@ -1,7 +1,15 @@
 from django.core.exceptions import ValidationError
+from functools import lru_cache
+from typing import FrozenSet
 import zoneinfo
 
 
+@lru_cache(maxsize=1)
+def get_time_zones() -> FrozenSet[str]:
+    """Часовые пояса: available_timezones() обходит базу zoneinfo на диске при каждом вызове"""
+    return frozenset(zoneinfo.available_timezones())
+
+
 def validate_time_zone(value):
-    if value not in zoneinfo.available_timezones():
+    if value not in get_time_zones():
         raise ValidationError('Please enter a valid time zone, e.g. Europe/Minsk')
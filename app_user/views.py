@@ -1,21 +1,27 @@
-from rest_framework.viewsets import ModelViewSet
+from django.http import FileResponse, Http404
+from rest_framework.viewsets import ModelViewSet, GenericViewSet
+from rest_framework.mixins import CreateModelMixin, ListModelMixin, RetrieveModelMixin
+from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import IsAdminUser
 from rest_framework.decorators import action
 from rest_framework.response import Response
 import logging
-from .models import Client, OperatorCode, Tag
-from .serializers import ClientSerializer, OperatorCodeSerializer, TagSerializer
-from .paginations import CustomPagination
+from .models import Client, ClientImport, OperatorCode, Tag
+from .serializers import ClientSerializer, OperatorCodeSerializer, TagSerializer, ClientImportSerializer
+from .services import ClientBulkDB, ClientBulkValidator
+from .paginations import CustomPagination, CursorPaginationMixin
+from .filters import ClientFilterBackend
 
 logger = logging.getLogger(__name__)
 
 
-class ClientViewSet(ModelViewSet):
+class ClientViewSet(CursorPaginationMixin, ModelViewSet):
     """Информация о клиенте"""
     queryset = Client.objects.all()
     serializer_class = ClientSerializer
     permission_classes = (IsAdminUser,)
     pagination_class = CustomPagination
+    filter_backends = (ClientFilterBackend,)
 
     @action(methods=['get'], detail=False)
     def code(self, request) -> Response:
@@ -23,6 +29,13 @@ class ClientViewSet(ModelViewSet):
         code = OperatorCode.objects.all()
         return Response(OperatorCodeSerializer(code, many=True).data)
 
+    @action(methods=['post'], detail=False)
+    def bulk(self, request) -> Response:
+        """Массовое создание и обновление клиентов по номеру телефона, ошибки по индексам строк"""
+        rows, errors = ClientBulkValidator(request.data).validate()
+        created, updated = ClientBulkDB().save(rows) if rows else (0, 0)
+        return Response({'created': created, 'updated': updated, 'errors': errors})
+
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
         response = super().destroy(request, *args, **kwargs)
@@ -30,9 +43,27 @@ class ClientViewSet(ModelViewSet):
         return response
 
 
-class TagViewSet(ModelViewSet):
+class TagViewSet(CursorPaginationMixin, ModelViewSet):
     """Тэг клиента"""
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (IsAdminUser,)
     pagination_class = CustomPagination
+
+
+class ClientImportViewSet(CreateModelMixin, ListModelMixin, RetrieveModelMixin, GenericViewSet):
+    """Загрузка клиентов из файла CSV/NDJSON (можно .gz) и ее прогресс"""
+    queryset = ClientImport.objects.all()
+    serializer_class = ClientImportSerializer
+    permission_classes = (IsAdminUser,)
+    pagination_class = CustomPagination
+    parser_classes = (MultiPartParser,)
+
+    @action(methods=['get'], detail=True)
+    def rejected(self, request, pk=None):
+        """Отклоненные строки файла: номер строки, причина, данные"""
+        instance = self.get_object()
+        if not instance.rejected_file:
+            raise Http404
+        return FileResponse(open(instance.rejected_file, 'rb'), as_attachment=True,
+                            filename=f'import_{instance.id}_rejected.csv')
@@ -11,8 +11,17 @@ app.autodiscover_tasks()
 
 
 app.conf.beat_schedule = {
+    'rollup_statistics': {
+        'task': 'rollup_statistics',
+        'schedule': crontab(minute='*/5')
+    },
+    'refresh_breakdown': {
+        'task': 'refresh_breakdown',
+        'schedule': crontab(minute='*/10')
+    },
+    # После полуночи с запасом на задержку rollup (STATISTICS_ROLLUP_LAG)
     'send_statistics_every_day': {
         'task': 'send_statistics',
-        'schedule': crontab(minute=0, hour=0)
+        'schedule': crontab(minute=15, hour=0)
     }
 }
@@ -0,0 +1,132 @@
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from weakref import WeakSet
+
+# Стандартные атрибуты LogRecord, остальные пришли через extra
+RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class QueueFileHandler(logging.handlers.QueueHandler):
+    """Неблокирующая запись в файл: записи ставятся в очередь, форматирует и пишет
+    фоновый поток QueueListener. После fork поток и очередь создаются заново"""
+    _handlers = WeakSet()
+
+    def __init__(self, filename: str, mode: str = 'a', encoding: str = None, queue_size: int = 10000):
+        super().__init__(queue.Queue(queue_size))
+        self.__file_handler = logging.FileHandler(filename, mode=mode, encoding=encoding, delay=True)
+        self.__queue_size = queue_size
+        self.__listener = None
+        self.__pid = None
+        self.__start_lock = threading.Lock()
+        self.__dropped = 0
+        self._handlers.add(self)
+
+    @property
+    def dropped(self) -> int:
+        """Записи, отброшенные при переполнении очереди"""
+        return self.__dropped
+
+    def setFormatter(self, fmt: logging.Formatter) -> None:
+        # Форматирование выполняется в фоновом потоке
+        self.__file_handler.setFormatter(fmt)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Сообщение форматируется лениво в фоновом потоке, запись передается как есть
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.__pid != os.getpid():
+            self._start()
+        # Счетчик отброшенных записей меняют потоки отправки: чтение и сброс под блокировкой
+        # обработчика (RLock, handle() уже держит ее при вызове emit)
+        with self.lock:
+            try:
+                if self.__dropped:
+                    self.queue.put_nowait(self._dropped_record(record))
+                    self.__dropped = 0
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.__dropped += 1
+
+    def flush(self) -> None:
+        """Дождаться записи поставленных в очередь записей"""
+        if self.__pid == os.getpid():
+            self.queue.join()
+        self.__file_handler.flush()
+
+    def close(self) -> None:
+        if self.__listener is not None and self.__pid == os.getpid():
+            self.__listener.stop()
+        self.__listener = None
+        self.__pid = None
+        self.__file_handler.close()
+        super().close()
+
+    def reset(self) -> None:
+        """Сбросить очередь и поток, унаследованные от родительского процесса"""
+        self.queue = queue.Queue(self.__queue_size)
+        self.__listener = None
+        self.__pid = None
+        self.__start_lock = threading.Lock()
+
+    def _start(self) -> None:
+        with self.__start_lock:
+            if self.__pid == os.getpid():
+                return
+            self.__listener = logging.handlers.QueueListener(self.queue, self.__file_handler)
+            self.__listener.start()
+            self.__pid = os.getpid()
+
+    def _dropped_record(self, record: logging.LogRecord) -> logging.LogRecord:
+        return logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                 'log queue is full, dropped %s records', (self.__dropped,), None)
+
+
+def reset_queue_handlers() -> None:
+    for handler in list(QueueFileHandler._handlers):
+        handler.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_queue_handlers)
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись одной строкой JSON: время, уровень, логгер, сообщение и поля из extra
+    (mailing_id, message_id, client_id, ...)"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class MessageSamplingFilter(logging.Filter):
+    """Выборка записей по отдельным сообщениям (с message_id в extra) ниже ERROR:
+    для попавшего в выборку сообщения сохраняются все записи"""
+    # Мультипликативный хеш Кнута: равномерная выборка по последовательным id
+    multiplier = 2654435761
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.__threshold = int(max(0.0, min(rate, 1.0)) * 2 ** 32)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message_id = getattr(record, 'message_id', None)
+        if message_id is None or record.levelno >= logging.ERROR:
+            return True
+        return (int(message_id) * self.multiplier) % 2 ** 32 < self.__threshold
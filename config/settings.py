@@ -138,7 +138,39 @@ PROBE_SERVER_TOKEN = env.str('PROBE_SERVER_TOKEN')
 PROBE_SERVER_URL = env.str('PROBE_SERVER_URL')
 PROBE_SERVER_TIMEOUT = env.int('PROBE_SERVER_TIMEOUT')
 
-CELERY_BROKER_URL = 'redis://redis_db'
+PROBE_SERVER_POOL_CONNECTIONS = env.int('PROBE_SERVER_POOL_CONNECTIONS', default=1)
+PROBE_SERVER_POOL_MAXSIZE = env.int('PROBE_SERVER_POOL_MAXSIZE', default=10)
+
+MAILING_CONCURRENCY = env.int('MAILING_CONCURRENCY', default=10)
+PROBE_RATE_LIMIT = env.float('PROBE_RATE_LIMIT', default=0)
+PROBE_RATE_LIMIT_BURST = env.int('PROBE_RATE_LIMIT_BURST', default=0)
+PROBE_RATE_LIMITS_BY_CODE = env.dict('PROBE_RATE_LIMITS_BY_CODE', cast={'value': float}, default={})
+
+PROBE_CIRCUIT_FAILURE_THRESHOLD = env.int('PROBE_CIRCUIT_FAILURE_THRESHOLD', default=0)
+PROBE_CIRCUIT_OPEN_TIMEOUT = env.int('PROBE_CIRCUIT_OPEN_TIMEOUT', default=30)
+PROBE_CIRCUIT_HALF_OPEN_PROBES = env.int('PROBE_CIRCUIT_HALF_OPEN_PROBES', default=3)
+# Таймаут Redis для rate limiter и circuit breaker, сек: при ошибке запрос не ограничивается
+PROBE_LIMITER_REDIS_TIMEOUT = env.float('PROBE_LIMITER_REDIS_TIMEOUT', default=1.0)
+
+MAILING_WORKERS = env.int('MAILING_WORKERS', default=1)
+MESSAGE_CLAIM_SIZE = env.int('MESSAGE_CLAIM_SIZE', default=100)
+MESSAGE_LEASE_TIMEOUT = env.int('MESSAGE_LEASE_TIMEOUT', default=300)
+MESSAGE_LEASE_POLL_INTERVAL = env.int('MESSAGE_LEASE_POLL_INTERVAL', default=5)
+MESSAGE_CREATE_CHUNK_SIZE = env.int('MESSAGE_CREATE_CHUNK_SIZE', default=100000)
+MESSAGE_STREAM_WINDOW = env.int('MESSAGE_STREAM_WINDOW', default=1000)
+MESSAGE_MAX_ATTEMPTS = env.int('MESSAGE_MAX_ATTEMPTS', default=5)
+MESSAGE_RETRY_BACKOFF = env.int('MESSAGE_RETRY_BACKOFF', default=10)
+MESSAGE_RETRY_BACKOFF_MAX = env.int('MESSAGE_RETRY_BACKOFF_MAX', default=600)
+MESSAGE_STATUS_BUFFER_SIZE = env.int('MESSAGE_STATUS_BUFFER_SIZE', default=500)
+MESSAGE_STATUS_FLUSH_INTERVAL = env.int('MESSAGE_STATUS_FLUSH_INTERVAL', default=1000)
+
+CLIENT_BULK_MAX_SIZE = env.int('CLIENT_BULK_MAX_SIZE', default=10000)
+CLIENT_BULK_BATCH_SIZE = env.int('CLIENT_BULK_BATCH_SIZE', default=1000)
+CLIENT_IMPORT_CHUNK_SIZE = env.int('CLIENT_IMPORT_CHUNK_SIZE', default=50000)
+
+REDIS_URL = env.str('REDIS_URL', default='redis://redis_db')
+
+CELERY_BROKER_URL = REDIS_URL
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = env.str('EMAIL_HOST')
@@ -166,22 +198,39 @@ DJOSER = {
     'TOKEN_MODEL': None,
 }
 
+LOG_FORMAT = env.str('LOG_FORMAT', default='json')
+LOG_QUEUE_SIZE = env.int('LOG_QUEUE_SIZE', default=10000)
+LOG_MESSAGE_SAMPLE_RATE = env.float('LOG_MESSAGE_SAMPLE_RATE', default=0.01)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
         'base': {
             'format': '[%(asctime)s] | [%(levelname)s] | %(message)s'
+        },
+        'json': {
+            '()': 'config.log.JsonFormatter'
+        }
+    },
+    'filters': {
+        # Записи по отдельным сообщениям (message_id в extra) пишутся для доли сообщений
+        'message_sampling': {
+            '()': 'config.log.MessageSamplingFilter',
+            'rate': LOG_MESSAGE_SAMPLE_RATE,
         }
     },
     'handlers': {
+        # Запись в файл фоновым потоком, вызывающий поток только ставит запись в очередь
         'file': {
-            'class': 'logging.FileHandler',
+            'class': 'config.log.QueueFileHandler',
             'level': 'INFO',
-            'formatter': 'base',
+            'formatter': 'json' if LOG_FORMAT == 'json' else 'base',
+            'filters': ['message_sampling'],
             'filename': 'info.log',
             'mode': 'a',
             'encoding': 'UTF-8',
+            'queue_size': LOG_QUEUE_SIZE,
         }
     },
     'loggers': {
@@ -197,3 +246,20 @@ LOGGING = {
 }
 
 FOLDER_STATISTICS = BASE_DIR / 'statistics'
+FOLDER_IMPORTS = BASE_DIR / 'imports'
+FOLDER_PROFILES = Path(env.str('FOLDER_PROFILES', default=str(BASE_DIR / 'profiles')))
+STATISTICS_EXPORT_CHUNK_SIZE = env.int('STATISTICS_EXPORT_CHUNK_SIZE', default=2000)
+STATISTICS_ROLLUP_LAG = env.int('STATISTICS_ROLLUP_LAG', default=300)
+STATISTICS_ROLLUP_WINDOW = env.int('STATISTICS_ROLLUP_WINDOW', default=24)
+
+# Каталог файлов метрик, общий для web и воркеров Celery (переменная окружения читается
+# prometheus_client при импорте), пусто - метрики только текущего процесса
+PROMETHEUS_MULTIPROC_DIR = env.str('PROMETHEUS_MULTIPROC_DIR', default='')
+PROMETHEUS_WORKER_PORT = env.int('PROMETHEUS_WORKER_PORT', default=0)
+# Токен для /metrics/ (Authorization: Bearer <token>), пусто - метрики только для админа
+PROMETHEUS_METRICS_TOKEN = env.str('PROMETHEUS_METRICS_TOKEN', default='')
+
+# Доля запусков задач рассылки и статистики с семплирующим профилированием (0 - только рассылки
+# с флагом profile), интервал семплирования, сек
+PROFILE_SAMPLE_RATE = env.float('PROFILE_SAMPLE_RATE', default=0)
+PROFILE_INTERVAL = env.float('PROFILE_INTERVAL', default=0.01)
@@ -20,6 +20,8 @@ from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 
+from app_mailing.views import metrics_view
+
 schema_view = get_schema_view(
     openapi.Info(
         title="Notification Service",
@@ -38,4 +40,5 @@ urlpatterns = [
     path('api/v1/notification/', include('app_mailing.urls')),
     path('api/v1/drf-auth/', include('rest_framework.urls')),
     path('docs/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
+    path('metrics/', metrics_view, name='metrics'),
 ]